@@ -0,0 +1,192 @@
+# -*- coding: UTF-8 -*-
+"""
+Alarm scheduler used by yokadid. Keeps the upcoming alarms of the tasks in a
+heap, so that the daemon can sleep until the next one.
+
+@author: Aurélien Gâteau <mail@agateau.com>
+@license: GPL v3 or later
+"""
+import heapq
+import os
+import signal
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from yokadi.core.db import Project, Task
+
+# Alarm triggered ALARM_DELAY hours before the due date
+DELAY_ALARM = "delay"
+# Alarm triggered once the due date has been reached
+DUE_ALARM = "due"
+
+
+class AlarmScheduler(object):
+    """Computes when alarms must be triggered.
+
+    A task gets a delay alarm when its due date is less than `delta` away and
+    a due alarm once its due date has been reached. Alarms are triggered again
+    every `suspend`, as long as the due date of the task does not change.
+    """
+    def __init__(self, delta, suspend):
+        """
+        @param delta: how long before the due date the delay alarm is triggered
+        @type delta: timedelta
+        @param suspend: delay between two alarms of the same kind
+        @type suspend: timedelta
+        """
+        self.delta = delta
+        self.suspend = suspend
+        # Heap of (alarmDate, taskId, kind)
+        self._heap = []
+        # taskId => dueDate
+        self._dueDates = {}
+        # For each alarm kind: taskId => (dueDate, triggerDate) of the last alarm
+        self._triggered = {DELAY_ALARM: {}, DUE_ALARM: {}}
+
+    def update(self, dueDates):
+        """Replace the watched tasks. Alarms already triggered are remembered,
+        so that they are not triggered again before `suspend`
+        @param dueDates: iterable of (taskId, dueDate)"""
+        self._dueDates = dict(dueDates)
+        for triggered in self._triggered.values():
+            for taskId in set(triggered).difference(self._dueDates):
+                del triggered[taskId]
+        self._heap = [self._getNextAlarm(taskId, dueDate) for taskId, dueDate in self._dueDates.items()]
+        heapq.heapify(self._heap)
+
+    def getNextDate(self):
+        """@return: the date of the next alarm, or None if there is none"""
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+    def popAlarms(self, now):
+        """Returns the alarms which must be triggered at `now`, and schedule
+        the next ones
+        @return: list of (taskId, kind)"""
+        alarms = []
+        while self._heap and self._heap[0][0] <= now:
+            _, taskId, kind = heapq.heappop(self._heap)
+            dueDate = self._dueDates[taskId]
+            # The daemon may have been sleeping through the whole delay
+            # period, for example if the computer was suspended
+            if kind == DELAY_ALARM and now >= dueDate:
+                kind = DUE_ALARM
+            self._triggered[kind][taskId] = (dueDate, now)
+            alarms.append((taskId, kind))
+        # Schedule the next alarms once the loop is over: with a null suspend
+        # delay they would be due immediately
+        for taskId, kind in alarms:
+            heapq.heappush(self._heap, self._getNextAlarm(taskId, self._dueDates[taskId]))
+        return alarms
+
+    def _getNextAlarm(self, taskId, dueDate):
+        dueTriggerDate = self._getLastTriggerDate(DUE_ALARM, taskId, dueDate)
+        if dueTriggerDate is not None:
+            return (dueTriggerDate + self.suspend, taskId, DUE_ALARM)
+
+        delayTriggerDate = self._getLastTriggerDate(DELAY_ALARM, taskId, dueDate)
+        if delayTriggerDate is None:
+            delayDate = dueDate - self.delta
+        else:
+            delayDate = delayTriggerDate + self.suspend
+        if delayDate < dueDate:
+            return (delayDate, taskId, DELAY_ALARM)
+        return (dueDate, taskId, DUE_ALARM)
+
+    def _getLastTriggerDate(self, kind, taskId, dueDate):
+        """@return: when the alarm of this kind was last triggered for
+        dueDate, or None"""
+        triggered = self._triggered[kind].get(taskId)
+        if triggered is None or triggered[0] != dueDate:
+            return None
+        return triggered[1]
+
+
+def getPendingDueDates(session):
+    """@return: a query returning (taskId, dueDate) for all tasks which can
+    trigger an alarm"""
+    return session.query(Task.id, Task.dueDate).join(Project) \
+        .filter(Task.dueDate != None, Task.status != "done", Project.active == True)  # noqa
+
+
+class AlarmRunner(object):
+    """Runs alarm commands in a pool of threads, so that slow or hung
+    commands do not block the event loop"""
+    def __init__(self, maxRunning, timeout):
+        """
+        @param maxRunning: maximum number of commands running at the same time.
+        Other commands wait for one of them to finish
+        @param timeout: number of seconds after which a command is killed, or
+        None to let commands run until they exit
+        """
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=maxRunning, thread_name_prefix="alarm")
+        # Ids of the tasks whose command is queued or running
+        self._pendingTaskIds = set()
+        # Futures of the queued and running commands
+        self._futures = set()
+        self._lock = Lock()
+
+    def run(self, taskId, cmd):
+        """Queue cmd. It is not queued if a command for the same task is still
+        pending
+        @return: a Future, or None if cmd has not been queued"""
+        with self._lock:
+            if taskId in self._pendingTaskIds:
+                print("Command for task %d is still running, skipping alarm" % taskId)
+                return None
+            self._pendingTaskIds.add(taskId)
+            future = self._executor.submit(self._runCommand, taskId, cmd)
+            self._futures.add(future)
+        future.add_done_callback(self._onDone)
+        return future
+
+    def shutdown(self, wait=True):
+        """Drop queued commands and wait for the running ones"""
+        # Do not use the cancel_futures argument of shutdown(): it requires
+        # Python 3.9
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+        self._executor.shutdown(wait=wait)
+
+    def _onDone(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def _runCommand(self, taskId, cmd):
+        try:
+            # Start the command in its own process group, so that the whole
+            # group can be killed if the command times out. Killing the shell
+            # would leave its children running
+            process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                       stdin=subprocess.DEVNULL, start_new_session=True)
+            killed = False
+            try:
+                output, _ = process.communicate(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                    killed = True
+                except ProcessLookupError:
+                    # The command exited between the timeout and the kill
+                    pass
+                output, _ = process.communicate()
+            if killed:
+                message = "Command for task %d killed after %s seconds" % (taskId, self.timeout)
+            else:
+                message = "Command for task %d exited with code %d" % (taskId, process.returncode)
+            output = output.decode(errors="replace").rstrip()
+            if output:
+                message += ". Output:\n" + output
+            # Print everything at once to avoid mixing the logs of different
+            # commands
+            print(message)
+            return process.returncode
+        finally:
+            with self._lock:
+                self._pendingTaskIds.discard(taskId)
+# vi: ts=4 sw=4 et
@@ -41,6 +41,10 @@ def getRuntimeDir():
     return value
 
 
+def getServerSocketPath():
+    return os.path.join(getRuntimeDir(), "yokadi.sock")
+
+
 def getLogDir():
     return getCacheDir()
 
@@ -6,17 +6,15 @@ Database access layer using SQL Alchemy
 @license: GPL v3 or later
 """
 
-import json
 import os
 from datetime import datetime
 from uuid import uuid1
 
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import create_engine, event, inspect
 from sqlalchemy.ext.associationproxy import association_proxy
-from sqlalchemy.orm import scoped_session, sessionmaker, relationship, declarative_base
+from sqlalchemy.orm import Session, scoped_session, sessionmaker, relationship, declarative_base
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy import Column, Integer, Boolean, Unicode, DateTime, Enum, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, Integer, Boolean, Unicode, DateTime, Enum, ForeignKey, Index, UniqueConstraint, text
 from sqlalchemy.types import TypeDecorator, VARCHAR
 
 from yokadi.core.recurrencerule import RecurrenceRule
@@ -25,9 +23,40 @@ from yokadi.core.yokadiexception import YokadiException
 # Yokadi database version needed for this code
 # If database config key DB_VERSION differs from this one a database migration
 # is required
-DB_VERSION = 12
+DB_VERSION = 16
 DB_VERSION_KEY = "DB_VERSION"
 
+# Name of the archive database once attached to a connection, see
+# Database.attachArchive()
+ARCHIVE_SCHEMA = "archive"
+
+# Config key => SQLite pragma it defines. Pragmas are applied to each new
+# connection
+PRAGMA_CONFIG_KEYS = {
+    "SQLITE_JOURNAL_MODE": "journal_mode",
+    "SQLITE_SYNCHRONOUS": "synchronous",
+    "SQLITE_MMAP_SIZE": "mmap_size",
+    "SQLITE_CACHE_SIZE": "cache_size",
+    "SQLITE_TEMP_STORE": "temp_store",
+    "SQLITE_BUSY_TIMEOUT": "busy_timeout",
+}
+
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": "268435456",
+    "cache_size": "-16000",
+    "temp_store": "MEMORY",
+    "busy_timeout": "5000",
+}
+
+# Allowed values for pragmas which are not integers
+_PRAGMA_CHOICES = {
+    "journal_mode": ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"),
+    "synchronous": ("OFF", "NORMAL", "FULL", "EXTRA"),
+    "temp_store": ("DEFAULT", "FILE", "MEMORY"),
+}
+
 
 class DbUserException(Exception):
     """
@@ -98,6 +127,7 @@ class TaskKeyword(Base):
 
     __table_args__ = (
         UniqueConstraint("task_id", "keyword_id", name="task_keyword_uc"),
+        Index("ix_task_keyword_keyword_id_task_id", "keyword_id", "task_id"),
     )
 
     def __repr__(self):
@@ -108,21 +138,17 @@ class RecurrenceRuleColumnType(TypeDecorator):
     """Represents an ydateutils.RecurrenceRule column
     """
     impl = VARCHAR
+    cache_ok = True
 
     def process_bind_param(self, value, dialect):
         if value:
-            value = json.dumps(value.toDict())
-        else:
-            value = ""
-        return value
+            return value.toJson()
+        return ""
 
     def process_result_value(self, value, dialect):
-        if value:
-            dct = json.loads(value)
-            value = RecurrenceRule.fromDict(dct)
-        else:
-            value = RecurrenceRule()
-        return value
+        # Rules are interned and decoded strings are remembered, so this does
+        # not run json.loads() for each row
+        return RecurrenceRule.fromJson(value or "")
 
 
 class Task(Base):
@@ -131,16 +157,38 @@ class Task(Base):
     uuid = Column(Unicode, unique=True, default=uuidGenerator, nullable=False)
     title = Column(Unicode)
     creationDate = Column("creation_date", DateTime, nullable=False, default=datetime.now)
+    # Date of the last change of the task or of its keywords. Maintained by
+    # _updateTaskUpdateDates()
+    updateDate = Column("update_date", DateTime, nullable=False, default=datetime.now)
     dueDate = Column("due_date", DateTime, default=None)
     doneDate = Column("done_date", DateTime, default=None)
     description = Column(Unicode, default="", nullable=False)
     urgency = Column(Integer, default=0, nullable=False)
     status = Column(Enum("new", "started", "done"), default="new")
     recurrence = Column(RecurrenceRuleColumnType, nullable=False, default=RecurrenceRule())
+    # Denormalized copy of the presence of the NOTE_KEYWORD keyword, so that
+    # tasks and notes can be told apart without a join. Maintained by
+    # setKeywordDict(), toNote() and toTask()
+    noteFlag = Column("is_note", Boolean, nullable=False, default=False)
     projectId = Column("project_id", Integer, ForeignKey("project.id"), nullable=False)
     taskKeywords = relationship("TaskKeyword", cascade="all", backref="task", cascade_backrefs=False)
     lock = relationship("TaskLock", cascade="all", backref="task", cascade_backrefs=False)
 
+    __table_args__ = (
+        # t_list
+        Index("ix_task_project_id_status", "project_id", "status"),
+        # t_purge, t_list --done
+        Index("ix_task_status_done_date", "status", "done_date"),
+        # yokadid, iCal export, t_list --due
+        Index("ix_task_due_date_not_done", "due_date", sqlite_where=text("status != 'done'")),
+        # t_list, n_list
+        Index("ix_task_is_note", "is_note"),
+    )
+
+    # Cache for getKeywordDict(), reset whenever keywords change or the
+    # instance is expired
+    _keywordDictCache = None
+
     def setKeywordDict(self, dct):
         """
         Defines keywords of a task.
@@ -149,20 +197,51 @@ class Task(Base):
         session = getSession()
         for taskKeyword in self.taskKeywords:
             session.delete(taskKeyword)
+        # Flush the deletions before adding the new keywords, otherwise the
+        # unit of work would insert them first and fail on a duplicate key
+        if self.taskKeywords:
+            session.flush()
+
+        for name, value in list(dct.items()):
+            keyword = getFromName(Keyword, name)
+            if keyword is None:
+                raise YokadiException("Keyword %s does not exist" % name)
+            session.add(TaskKeyword(task=self, keyword=keyword, value=value))
+        self.noteFlag = NOTE_KEYWORD in dct
+        self._keywordDictCache = None
 
+    def updateKeywordDict(self, dct):
+        """
+        Adds keywords to the task, or changes their value. Other keywords are
+        kept. Unlike setKeywordDict(), does not flush the session.
+        Dict is of the form: keywordName => value
+        """
+        taskKeywords = dict((x.keyword.name, x) for x in self.taskKeywords)
+        session = getSession()
         for name, value in list(dct.items()):
-            keyword = session.query(Keyword).filter_by(name=name).one()
+            taskKeyword = taskKeywords.get(name)
+            if taskKeyword is not None:
+                taskKeyword.value = value
+                continue
+            keyword = getFromName(Keyword, name)
+            if keyword is None:
+                raise YokadiException("Keyword %s does not exist" % name)
             session.add(TaskKeyword(task=self, keyword=keyword, value=value))
+        if NOTE_KEYWORD in dct:
+            self.noteFlag = True
+        self._keywordDictCache = None
 
     def getKeywordDict(self):
         """
         Returns all keywords of a task as a dict of the form:
         keywordName => value
         """
-        dct = {}
-        for taskKeyword in self.taskKeywords:
-            dct[taskKeyword.keyword.name] = taskKeyword.value
-        return dct
+        if self._keywordDictCache is None:
+            dct = {}
+            for taskKeyword in self.taskKeywords:
+                dct[taskKeyword.keyword.name] = taskKeyword.value
+            self._keywordDictCache = dct
+        return dict(self._keywordDictCache)
 
     def getKeywordsAsString(self):
         """
@@ -203,34 +282,77 @@ class Task(Base):
 
     @staticmethod
     def getNoteKeyword(session):
-        return session.query(Keyword).filter_by(name=NOTE_KEYWORD).one()
+        return session.get(Keyword, getIdFromName(Keyword, NOTE_KEYWORD))
 
     def toNote(self, session):
-        session.add(TaskKeyword(task=self, keyword=Task.getNoteKeyword(session), value=None))
-        try:
-            session.flush()
-        except IntegrityError:
-            # Already a note
-            session.rollback()
+        if self.isNote(session):
             return
+        session.add(TaskKeyword(task=self, keyword=Task.getNoteKeyword(session), value=None))
+        self.noteFlag = True
 
     def toTask(self, session):
-        noteKeyword = Task.getNoteKeyword(session)
+        if not self.isNote(session):
+            return
+        noteKeywordId = getIdFromName(Keyword, NOTE_KEYWORD)
         try:
-            taskKeyword = session.query(TaskKeyword).filter_by(task=self, keyword=noteKeyword).one()
+            taskKeyword = session.query(TaskKeyword).filter_by(task=self, keywordId=noteKeywordId).one()
         except NoResultFound:
-            # Already a task
-            return
-        session.delete(taskKeyword)
+            pass
+        else:
+            session.delete(taskKeyword)
+        self.noteFlag = False
 
     def isNote(self, session):
-        noteKeyword = Task.getNoteKeyword(session)
-        return any((x.keyword == noteKeyword for x in self.taskKeywords))
+        # noteFlag is None until a new task has been flushed
+        return bool(self.noteFlag)
 
     def __repr__(self):
         return "<Task id={} title={}>".format(self.id, self.title)
 
 
+@event.listens_for(Task, "expire")
+@event.listens_for(Task, "refresh")
+@event.listens_for(Task.taskKeywords, "append")
+@event.listens_for(Task.taskKeywords, "remove")
+@event.listens_for(Task.taskKeywords, "bulk_replace")
+def _resetKeywordDictCache(task, *args):
+    # task is None if the instance has already been garbage collected
+    if task is not None:
+        task._keywordDictCache = None
+
+
+@event.listens_for(TaskKeyword.value, "set")
+@event.listens_for(TaskKeyword.keywordId, "set")
+def _resetTaskKeywordDictCache(taskKeyword, *args):
+    # Do not use taskKeyword.task: it would trigger a lazy load
+    task = taskKeyword.__dict__.get("task")
+    if task is not None:
+        task._keywordDictCache = None
+
+
+@event.listens_for(Session, "before_flush")
+def _updateTaskUpdateDates(session, flushContext, instances):
+    tasks = set()
+    # session.dirty is computed on each access: only do it once
+    dirty = session.dirty
+    with session.no_autoflush:
+        for obj in session.new | dirty | session.deleted:
+            if isinstance(obj, Task):
+                if obj in dirty and not session.is_modified(obj):
+                    continue
+                tasks.add(obj)
+            elif isinstance(obj, TaskKeyword):
+                if obj.task is not None:
+                    tasks.add(obj.task)
+            elif isinstance(obj, Keyword):
+                # Renaming a keyword changes the tasks using it
+                if obj in dirty and session.is_modified(obj, include_collections=False):
+                    tasks.update(x.task for x in obj.taskKeywords)
+    now = datetime.now()
+    for task in tasks.difference(session.deleted):
+        task.updateDate = now
+
+
 class Config(Base):
     """yokadi config"""
     __tablename__ = "config"
@@ -278,6 +400,51 @@ class Alias(Base):
         alias.command = command
 
 
+# Full-text index of the tasks, used by t_list --search and t_search. Its rowid
+# is the task id. It is not a mapped class: it is created along with the
+# tables and kept up to date by triggers
+FTS_TABLE = "task_fts"
+
+# Space-separated names of the user keywords of task_fts.rowid
+_FTS_KEYWORDS_SQL = """(select coalesce(group_concat(keyword.name, ' '), '')
+    from task_keyword join keyword on keyword.id = task_keyword.keyword_id
+    where task_keyword.task_id = task_fts.rowid and keyword.name not like '\\_%' escape '\\')"""
+
+FTS_SQL = (
+    """create virtual table if not exists task_fts
+    using fts5(title, description, keywords, tokenize='unicode61 remove_diacritics 2')""",
+    """create trigger if not exists task_fts_insert after insert on task begin
+        insert into task_fts(rowid, title, description, keywords) values(new.id, new.title, new.description, '');
+    end""",
+    """create trigger if not exists task_fts_update after update of title, description on task begin
+        update task_fts set title = new.title, description = new.description where rowid = new.id;
+    end""",
+    """create trigger if not exists task_fts_delete after delete on task begin
+        delete from task_fts where rowid = old.id;
+    end""",
+    """create trigger if not exists task_keyword_fts_insert after insert on task_keyword begin
+        update task_fts set keywords = {keywords} where rowid = new.task_id;
+    end""",
+    """create trigger if not exists task_keyword_fts_update after update on task_keyword begin
+        update task_fts set keywords = {keywords} where rowid in (old.task_id, new.task_id);
+    end""",
+    """create trigger if not exists task_keyword_fts_delete after delete on task_keyword begin
+        update task_fts set keywords = {keywords} where rowid = old.task_id;
+    end""",
+    """create trigger if not exists keyword_fts_update after update of name on keyword begin
+        update task_fts set keywords = {keywords}
+            where rowid in (select task_id from task_keyword where keyword_id = new.id);
+    end""",
+)
+FTS_SQL = tuple(x.format(keywords=_FTS_KEYWORDS_SQL) for x in FTS_SQL)
+
+
+@event.listens_for(Base.metadata, "after_create")
+def _createFtsTable(target, connection, **kwargs):
+    for sql in FTS_SQL:
+        connection.exec_driver_sql(sql)
+
+
 def getConfigKey(name, environ=True):
     session = getSession()
     if environ:
@@ -296,11 +463,80 @@ def getSession():
     return _database.session
 
 
+def getIdFromName(cls, name):
+    """Returns the id of the Keyword or Project called name, using the cache
+    of the database
+    @return: the id or None if there is no such item"""
+    return _database.getIdFromName(cls, name)
+
+
+def getFromName(cls, name):
+    """Returns the Keyword or Project called name. Thanks to the name cache of
+    the database and the identity map of the session, this usually does not
+    run any query
+    @return: the instance or None if there is no such item"""
+    id = getIdFromName(cls, name)
+    if id is None:
+        return None
+    return getSession().get(cls, id)
+
+
+@event.listens_for(Keyword, "after_delete")
+@event.listens_for(Project, "after_delete")
+@event.listens_for(Keyword.name, "set")
+@event.listens_for(Project.name, "set")
+def _resetNameIdCache(*args):
+    if _database is not None:
+        _database.resetNameIdCache()
+
+
+def attachArchive(create=False):
+    """See Database.attachArchive()"""
+    return _database.attachArchive(create)
+
+
+def getArchivePath():
+    """@return: the path of the archive database, or None for an in-memory
+    database"""
+    return _database.archivePath
+
+
+def getArchivePathForDb(dbFileName):
+    """@return: the path of the archive database of the database dbFileName"""
+    return os.path.splitext(os.path.abspath(dbFileName))[0] + "-archive.db"
+
+
 def connectDatabase(dbFileName, createIfNeeded=True, memoryDatabase=False):
     global _database
     _database = Database(dbFileName, createIfNeeded, memoryDatabase)
 
 
+def checkPragmaValue(name, value):
+    """Check value is valid for the pragma config key name
+    @return: True if value is valid, else False"""
+    pragma = PRAGMA_CONFIG_KEYS[name]
+    if pragma in _PRAGMA_CHOICES:
+        return value.upper() in _PRAGMA_CHOICES[pragma]
+    try:
+        value = int(value)
+    except ValueError:
+        return False
+    # A negative cache_size is a size in KiB instead of a number of pages
+    return value >= 0 or pragma == "cache_size"
+
+
+def getPragmaWarnings():
+    """@return: a list of messages about the pragma config keys which have
+    been ignored because their value is invalid"""
+    return list(_database.pragmaWarnings)
+
+
+def reloadPragmas():
+    """Apply the pragma config keys again. Must be called after they have been
+    changed"""
+    _database.loadPragmas()
+
+
 class Database(object):
     def __init__(self, dbFileName, createIfNeeded=True, memoryDatabase=False, updateMode=False):
         """Connect to database and create it if needed
@@ -325,6 +561,26 @@ class Database(object):
         self.engine = create_engine(connectionString, echo=echo)
         self.session = scoped_session(sessionmaker(bind=self.engine))
 
+        # Maps Keyword and Project to a dict of name => id. Only existing
+        # names are stored, so adding items does not invalidate it, but
+        # renaming, removing or rolling back does
+        self._nameIdCache = {Keyword: {}, Project: {}}
+        event.listen(self.session, "after_rollback", self._onRollback)
+
+        # Keep SQLite defaults when updating: the update process copies the
+        # database file, it must not be left in WAL mode
+        self.pragmas = {} if updateMode else dict(DEFAULT_PRAGMAS)
+        # Messages about invalid pragma config keys, see loadPragmas()
+        self.pragmaWarnings = []
+        self.memoryDatabase = memoryDatabase
+        event.listen(self.engine, "connect", self._applyPragmas)
+
+        # Database receiving old done tasks, see attachArchive()
+        if memoryDatabase:
+            self.archivePath = None
+        else:
+            self.archivePath = getArchivePathForDb(dbFileName)
+
         if not os.path.exists(dbFileName) or memoryDatabase:
             if not createIfNeeded:
                 raise DbUserException("Database file (%s) does not exist or is not readable." % dbFileName)
@@ -340,11 +596,101 @@ class Database(object):
 
         if not updateMode:
             self.checkVersion()
+            self.loadPragmas()
+
+    def _applyPragmas(self, dbapiConnection, connectionRecord):
+        cursor = dbapiConnection.cursor()
+        for name, value in self.pragmas.items():
+            # Pragmas do not support bound parameters. Values are safe, they
+            # have been checked by checkPragmaValue()
+            cursor.execute("pragma %s = %s" % (name, value))
+        cursor.close()
+
+    def loadPragmas(self):
+        """Read pragma values from the config table. If they changed, reconnect
+        so that they get applied"""
+        pragmas = dict(DEFAULT_PRAGMAS)
+        self.pragmaWarnings = []
+        for config in self.session.query(Config).filter(Config.name.in_(PRAGMA_CONFIG_KEYS)):
+            if checkPragmaValue(config.name, config.value):
+                pragmas[PRAGMA_CONFIG_KEYS[config.name]] = config.value
+            else:
+                self.pragmaWarnings.append("Ignoring invalid value '%s' for %s" % (config.value, config.name))
+        if pragmas == self.pragmas:
+            return
+        self.pragmas = pragmas
+        if self.memoryDatabase:
+            # Reconnecting would destroy the database, apply the pragmas to the
+            # current connection instead
+            self._applyPragmas(self.session.connection().connection.dbapi_connection, None)
+        else:
+            self.session.close()
+            self.engine.dispose()
+
+    def getIdFromName(self, cls, name):
+        """Returns the id of the Keyword or Project called name
+        @return: the id or None if there is no such item"""
+        cache = self._nameIdCache[cls]
+        try:
+            return cache[name]
+        except KeyError:
+            pass
+        id = self.session.query(cls.id).filter_by(name=name).scalar()
+        if id is not None:
+            cache[name] = id
+        return id
+
+    def resetNameIdCache(self):
+        for cache in self._nameIdCache.values():
+            cache.clear()
+
+    def _onRollback(self, session):
+        self.resetNameIdCache()
 
     def createTables(self):
         """Create all defined tables"""
         Base.metadata.create_all(self.engine)
 
+    def attachArchive(self, create=False):
+        """Attach the archive database to the connection of the session, as
+        the ARCHIVE_SCHEMA database. Must be called outside of a transaction
+        @param create: if True, create the archive database if it does not
+        exist yet
+        @return: True if the archive database is attached, False if it does
+        not exist"""
+        if self.archivePath is None:
+            raise YokadiException("Archiving is not possible with an in-memory database")
+        connection = self.session.connection()
+        if ARCHIVE_SCHEMA in [x[1] for x in connection.exec_driver_sql("pragma database_list")]:
+            return True
+        if not os.path.exists(self.archivePath):
+            if not create:
+                return False
+            self._createArchive()
+
+        connection.exec_driver_sql("attach database ? as %s" % ARCHIVE_SCHEMA, (self.archivePath,))
+        version = connection.exec_driver_sql("select value from %s.config where name = ?" % ARCHIVE_SCHEMA,
+                                             (DB_VERSION_KEY,)).scalar()
+        if version != str(DB_VERSION):
+            connection.exec_driver_sql("detach database %s" % ARCHIVE_SCHEMA)
+            msg = "Archive database {} has version {} but Yokadi wants version {}.\n".format(
+                self.archivePath, version, DB_VERSION)
+            msg += "Please run Yokadi with the --update option to update your database."
+            raise DbUserException(msg)
+        return True
+
+    def _createArchive(self):
+        """Create an empty archive database, with the same schema as the main
+        one"""
+        engine = create_engine("sqlite:///" + self.archivePath)
+        try:
+            Base.metadata.create_all(engine)
+            with engine.begin() as connection:
+                connection.execute(Config.__table__.insert(), dict(name=DB_VERSION_KEY, value=str(DB_VERSION),
+                                                                   system=True, desc="Database schema release number"))
+        finally:
+            engine.dispose()
+
     def getVersion(self):
         if not self._hasConfigTable():
             # There was no Config table in v1
@@ -386,11 +732,30 @@ def setDefaultConfig():
              False, "Command executed by Yokadi Daemon when a tasks due date is reached soon (see ALARM_DELAY"),
         "ALARM_DELAY": ("8", False, "Delay (in hours) before due date to launch the alarm (see ALARM_CMD)"),
         "ALARM_SUSPEND": ("1", False, "Delay (in hours) before an alarm trigger again"),
+        "ALARM_CMD_TIMEOUT": ("3600", False, "Time (in seconds) after which Yokadi Daemon kills an alarm command."
+                                             " Must be longer than the popups of ALARM_DELAY_CMD and ALARM_DUE_CMD."
+                                             " 0 disables the timeout"),
         "PURGE_DELAY": ("90", False, "Default delay (in days) for the t_purge command"),
+        "ARCHIVE_DELAY": ("0", False, "Delay (in days) after which done tasks are moved to the archive database"
+                                      " when Yokadi starts. 0 disables automatic archiving"),
+        "SQLITE_JOURNAL_MODE": (DEFAULT_PRAGMAS["journal_mode"], False,
+                                "SQLite journal mode. WAL lets yokadid and the CLI access the database concurrently"),
+        "SQLITE_SYNCHRONOUS": (DEFAULT_PRAGMAS["synchronous"], False,
+                               "SQLite synchronous mode. NORMAL is safe in WAL mode and avoids an fsync per commit"),
+        "SQLITE_MMAP_SIZE": (DEFAULT_PRAGMAS["mmap_size"], False,
+                             "Max number of bytes of the database SQLite maps in memory (0 to disable)"),
+        "SQLITE_CACHE_SIZE": (DEFAULT_PRAGMAS["cache_size"], False,
+                              "SQLite page cache size, in pages if positive, in KiB if negative"),
+        "SQLITE_TEMP_STORE": (DEFAULT_PRAGMAS["temp_store"], False,
+                              "Where SQLite stores temporary tables and indexes: DEFAULT, FILE or MEMORY"),
+        "SQLITE_BUSY_TIMEOUT": (DEFAULT_PRAGMAS["busy_timeout"], False,
+                                "Time (in milliseconds) to wait for a locked database before failing"),
     }
 
     session = getSession()
+    # Look for all the keys at once: this runs at each start
+    existingNames = {x for x, in session.query(Config.name).filter(Config.name.in_(defaultConfig))}
     for name, value in defaultConfig.items():
-        if session.query(Config).filter_by(name=name).count() == 0:
+        if name not in existingNames:
             session.add(Config(name=name, value=value[0], system=value[1], desc=value[2]))
 # vi: ts=4 sw=4 et
@@ -7,15 +7,21 @@ Database utilities.
 @license: GPL v3 or later
 """
 from datetime import datetime, timedelta
+import heapq
+from collections import namedtuple
+from itertools import groupby, islice
+import json
 import os
 
-from sqlalchemy import and_
-from sqlalchemy.orm import aliased
-from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
+from sqlalchemy import Column, Integer, MetaData, Table, and_, case, delete, func, insert, literal_column, null, \
+    select, text, update
+from sqlalchemy.orm import aliased, joinedload, selectinload
+from sqlalchemy.orm.exc import NoResultFound
 
 from yokadi.ycli import tui
 from yokadi.core import db
-from yokadi.core.db import Keyword, Project, Task, TaskKeyword, TaskLock
+from yokadi.core.db import NOTE_KEYWORD, Keyword, Project, Task, TaskKeyword, TaskLock
+from yokadi.core.recurrencerule import RecurrenceRule
 from yokadi.core.yokadiexception import YokadiException
 
 
@@ -50,6 +56,96 @@ def addTask(projectName, title, keywordDict=None, interactive=True):
     return task
 
 
+# Task attributes which can be set by addTasks(), with their default value
+BULK_TASK_DEFAULTS = dict(
+    description="",
+    urgency=0,
+    status="new",
+    dueDate=None,
+    doneDate=None,
+)
+
+
+def addTasks(entries, chunkSize=1000):
+    """Adds tasks in bulk. Missing projects and keywords are created. Tasks are
+    committed every chunkSize tasks.
+    @param entries: iterable of dicts. Mandatory keys are "project" (project
+    name) and "title". Optional keys are "keywords" (dict of keywordName =>
+    value), "creationDate" and the keys of BULK_TASK_DEFAULTS
+    @param chunkSize: number of tasks inserted per transaction
+    @return: number of added tasks"""
+    session = db.getSession()
+    projectIds = dict(session.query(Project.name, Project.id))
+    keywordIds = dict(session.query(Keyword.name, Keyword.id))
+
+    count = 0
+    entries = iter(entries)
+    while True:
+        chunk = list(islice(entries, chunkSize))
+        if not chunk:
+            break
+        _addTaskChunk(session, chunk, projectIds, keywordIds)
+        session.commit()
+        count += len(chunk)
+    return count
+
+
+def checkItemName(cls, name):
+    """Raises a YokadiException if name cannot be used for a new cls (Project
+    or Keyword) instance. Names must be usable on the command line: they must
+    be non-empty strings without spaces"""
+    if not isinstance(name, str) or not name or any(x.isspace() for x in name):
+        raise YokadiException("Invalid %s name: %r" % (cls.__tablename__, name))
+
+
+def _createMissingItems(session, cls, idDict, names):
+    """Creates cls (Project or Keyword) instances for names not in idDict, and
+    adds them to idDict"""
+    missingNames = sorted(set(names).difference(idDict))
+    if not missingNames:
+        return
+    for name in missingNames:
+        checkItemName(cls, name)
+    rows = session.execute(insert(cls).returning(cls.id, cls.name), [dict(name=x) for x in missingNames])
+    for itemId, name in rows:
+        idDict[name] = itemId
+        tui.info("Added %s '%s'" % (cls.__tablename__, name))
+
+
+def _addTaskChunk(session, chunk, projectIds, keywordIds):
+    _createMissingItems(session, Project, projectIds, [x["project"] for x in chunk])
+    _createMissingItems(session, Keyword, keywordIds, [k for x in chunk for k in x.get("keywords", {})])
+
+    now = datetime.now().replace(second=0, microsecond=0)
+    taskRows = []
+    for entry in chunk:
+        row = dict(BULK_TASK_DEFAULTS)
+        row.update((k, v) for k, v in entry.items() if k in BULK_TASK_DEFAULTS and v is not None)
+        if row["status"] == "done" and row["doneDate"] is None:
+            row["doneDate"] = now
+        row["title"] = entry["title"]
+        row["projectId"] = projectIds[entry["project"]]
+        row["creationDate"] = entry.get("creationDate") or now
+        row["uuid"] = db.uuidGenerator()
+        row["noteFlag"] = NOTE_KEYWORD in entry.get("keywords", {})
+        taskRows.append(row)
+
+    # Asking for sorted RETURNING rows makes SQLAlchemy fall back to one
+    # INSERT per row, so map the returned ids using the uuids instead
+    query = insert(Task).returning(Task.uuid, Task.id)
+    taskIds = dict(session.execute(query, taskRows).all())
+
+    taskKeywordRows = []
+    for row, entry in zip(taskRows, chunk):
+        taskId = taskIds[row["uuid"]]
+        for name, value in entry.get("keywords", {}).items():
+            taskKeywordRows.append(dict(task_id=taskId, keyword_id=keywordIds[name], value=value))
+    if taskKeywordRows:
+        # Use a Core insert: the ORM one would return the primary key of each
+        # row, inserting them one at a time
+        session.execute(insert(TaskKeyword.__table__), taskKeywordRows)
+
+
 def getTaskFromId(tid):
     """Returns a task given its id, or raise a YokadiException if it does not
     exist.
@@ -73,22 +169,43 @@ def getTaskFromId(tid):
     return task
 
 
+# Number of ids per IN query in getTasksFromIds(). Old SQLite versions do
+# not accept more than 999 variables per statement
+ID_QUERY_CHUNK_SIZE = 900
+
+
+def getTasksFromIds(ids):
+    """Returns the tasks matching a list of ids. Tasks are loaded with their
+    project and keywords, using one query per ID_QUERY_CHUNK_SIZE ids.
+    @param ids: list of task ids, as int
+    @return: (tasks, missingIds): the tasks, in the order of ids and without
+    duplicates, and the ids which do not match any task"""
+    session = db.getSession()
+    ids = list(dict.fromkeys(ids))
+    taskDict = {}
+    for start in range(0, len(ids), ID_QUERY_CHUNK_SIZE):
+        query = session.query(Task).filter(Task.id.in_(ids[start:start + ID_QUERY_CHUNK_SIZE]))
+        taskDict.update((x.id, x) for x in eagerLoadTaskRelations(query))
+    tasks = [taskDict[x] for x in ids if x in taskDict]
+    missingIds = [x for x in ids if x not in taskDict]
+    return tasks, missingIds
+
+
 def getOrCreateKeyword(keywordName, interactive=True):
     """Get a keyword by its name. Create it if needed
     @param keywordName: keyword name as a string
     @param interactive: Ask user before creating keyword (this is the default)
     @type interactive: Bool
     @return: Keyword instance or None if user cancel creation"""
-    session = db.getSession()
-    try:
-        return session.query(Keyword).filter_by(name=keywordName).one()
-    except (NoResultFound, MultipleResultsFound):
-        if interactive and not tui.confirm("Keyword '%s' does not exist, create it" % keywordName):
-            return None
-        keyword = Keyword(name=keywordName)
-        session.add(keyword)
-        print("Added keyword '%s'" % keywordName)
+    keyword = db.getFromName(Keyword, keywordName)
+    if keyword is not None:
         return keyword
+    if interactive and not tui.confirm("Keyword '%s' does not exist, create it" % keywordName):
+        return None
+    keyword = Keyword(name=keywordName)
+    db.getSession().add(keyword)
+    print("Added keyword '%s'" % keywordName)
+    return keyword
 
 
 def getOrCreateProject(projectName, interactive=True, createIfNeeded=True):
@@ -99,25 +216,28 @@ def getOrCreateProject(projectName, interactive=True, createIfNeeded=True):
     @param createIfNeeded: create project if it does not exist (this is the default)
     @type createIfNeeded: Bool
     @return: Project instance or None if user cancel creation or createIfNeeded is False"""
-    session = db.getSession()
-    try:
-        return session.query(Project).filter_by(name=projectName).one()
-    except (NoResultFound, MultipleResultsFound):
-        if not createIfNeeded:
-            return None
-        if interactive and not tui.confirm("Project '%s' does not exist, create it" % projectName):
-            return None
-        project = Project(name=projectName)
-        session.add(project)
-        print("Added project '%s'" % projectName)
+    project = db.getFromName(Project, projectName)
+    if project is not None:
         return project
+    if not createIfNeeded:
+        return None
+    if interactive and not tui.confirm("Project '%s' does not exist, create it" % projectName):
+        return None
+    project = Project(name=projectName)
+    db.getSession().add(project)
+    print("Added project '%s'" % projectName)
+    return project
 
 
 def createMissingKeywords(lst, interactive=True):
     """Create all keywords from lst which does not exist
     @param lst: list of keyword
     @return: True, if ok, False if user canceled"""
+    lst = list(lst)
+    existingNames = {x for x, in db.getSession().query(Keyword.name).filter(Keyword.name.in_(lst))}
     for keywordName in lst:
+        if keywordName in existingNames:
+            continue
         if not getOrCreateKeyword(keywordName, interactive=interactive):
             return False
     return True
@@ -128,15 +248,421 @@ def getKeywordFromName(name):
     raises a YokadiException if not found
     @param name: the keyword name
     @return: The keyword"""
-    session = db.getSession()
     if not name:
         raise YokadiException("No keyword supplied")
     if name.startswith("@"):
         name = name[1:]
-    lst = session.query(Keyword).filter_by(name=name).all()
-    if len(lst) == 0:
+    keyword = db.getFromName(Keyword, name)
+    if keyword is None:
         raise YokadiException("No keyword named '%s' found" % name)
-    return lst[0]
+    return keyword
+
+
+def eagerLoadTaskRelations(query):
+    """Make query load the project and the keywords of the tasks it returns in
+    bulk, so that rendering the tasks does not run queries for each task
+    @param query: a query returning Task instances
+    @return: a new query"""
+    return query.options(joinedload(Task.project),
+                         selectinload(Task.taskKeywords).joinedload(TaskKeyword.keyword))
+
+
+# Number of tasks loaded at once by iterTaskGroups() in lazy mode
+LAZY_LOAD_BATCH_SIZE = 200
+
+
+class TaskRow(object):
+    """Read-only snapshot of a task, used to render task lists without
+    creating Task instances. Provides the attributes and keyword methods of
+    Task used by the list renderers. See iterTaskRows()"""
+    __slots__ = ("id", "title", "description", "urgency", "status", "creationDate", "dueDate", "doneDate",
+                 "project", "_keywordDict")
+
+    def __init__(self, id, title, description, urgency, status, creationDate, dueDate, doneDate, project,
+                 keywordDict):
+        self.id = id
+        self.title = title
+        self.description = description
+        self.urgency = urgency
+        self.status = status
+        self.creationDate = creationDate
+        self.dueDate = dueDate
+        self.doneDate = doneDate
+        # Name of the project
+        self.project = project
+        self._keywordDict = keywordDict
+
+    def withDueDate(self, dueDate):
+        """Returns a copy of the row with a different due date"""
+        return TaskRow(self.id, self.title, self.description, self.urgency, self.status, self.creationDate, dueDate,
+                       self.doneDate, self.project, self._keywordDict)
+
+    def getKeywordDict(self):
+        """Same as Task.getKeywordDict()"""
+        return dict(self._keywordDict)
+
+    def getKeywordsAsString(self):
+        """Same as Task.getKeywordsAsString()"""
+        return ", ".join("%s=%s" % k for k in self._keywordDict.items())
+
+    def getUserKeywordsNameAsString(self):
+        """Same as Task.getUserKeywordsNameAsString()"""
+        return " ".join("@" + k for k in sorted(self._keywordDict) if not k.startswith("_"))
+
+    def __repr__(self):
+        return "<TaskRow id={} title={}>".format(self.id, self.title)
+
+
+def _getTaskRowColumns():
+    """Returns the columns needed to create TaskRow instances. Keywords are
+    aggregated in a JSON object, so that each task is returned as a single
+    row"""
+    keywords = select(func.json_group_object(Keyword.name, TaskKeyword.value)).select_from(TaskKeyword) \
+        .join(Keyword, TaskKeyword.keywordId == Keyword.id) \
+        .where(TaskKeyword.taskId == Task.id) \
+        .scalar_subquery()
+    return [Task.id, Task.title, Task.description, Task.urgency, Task.status, Task.creationDate, Task.dueDate,
+            Task.doneDate, Project.name, keywords]
+
+
+def _createTaskRow(row):
+    return TaskRow(*row[:9], json.loads(row[9]) if row[9] else {})
+
+
+def iterTaskRows(filters, order, limit=None):
+    """Fetch the tasks matching filters as TaskRow instances
+    @param filters: list of DbFilter or KeywordFilter instances
+    @param order: ordering of tasks, in sqlalchemy format
+    @param limit: max number of tasks or None for no limit
+    @return: a generator of TaskRow instances"""
+    session = db.getSession()
+    query = session.query(*_getTaskRowColumns()).join(Project, Task.project) \
+        .filter(*getFilterConditions(filters)).order_by(*order)
+    if limit is not None:
+        query = query.limit(limit)
+    for row in query.yield_per(LAZY_LOAD_BATCH_SIZE):
+        yield _createTaskRow(row)
+
+
+def iterTaskOccurrences(filters, endDate):
+    """Fetch the tasks matching filters which are not done and are due
+    before endDate, sorted by due date. Recurrent tasks are yielded once for
+    each of their occurrences before endDate. Occurrences are computed while
+    iterating, so memory use does not depend on the length of the period
+    @param filters: list of DbFilter or KeywordFilter instances
+    @param endDate: end of the period (datetime)
+    @return: a generator of TaskRow instances. Each occurrence of a
+    recurrent task gets its own due date"""
+    session = db.getSession()
+    query = session.query(*_getTaskRowColumns(), Task.recurrence).join(Project, Task.project) \
+        .filter(*getFilterConditions(filters), Task.status != "done", Task.dueDate < endDate)
+
+    rows = (_createTaskRow(x) for x in query.order_by(Task.dueDate, Task.id).yield_per(LAZY_LOAD_BATCH_SIZE))
+    # Each recurrent task yields its next occurrences. The first one is
+    # the stored due date, already returned by rows
+    occurrenceIterators = [_iterNextOccurrences(_createTaskRow(x), x[-1], endDate)
+                           for x in query.filter(Task.recurrence != RecurrenceRule())]
+    return heapq.merge(rows, *occurrenceIterators, key=lambda x: (x.dueDate, x.id))
+
+
+def _iterNextOccurrences(row, rule, endDate):
+    for dueDate in rule.iterNext(row.dueDate):
+        if dueDate >= endDate:
+            return
+        yield row.withDueDate(dueDate)
+
+
+def _getTaskGroupRows(groupColumn, groupIds, filters, order, limit):
+    """Returns a subquery of (taskId, groupId[, rowNumber]) rows for the tasks
+    matching filters. See iterTaskGroups()"""
+    session = db.getSession()
+    columns = [Task.id.label("taskId"), groupColumn.label("groupId")]
+    if limit is not None:
+        rowNumber = func.row_number().over(partition_by=groupColumn, order_by=order or None)
+        columns.append(rowNumber.label("rowNumber"))
+    rows = session.query(*columns)
+    if groupColumn is TaskKeyword.keywordId:
+        rows = rows.join(TaskKeyword, Task.taskKeywords)
+    return rows.filter(groupColumn.in_(groupIds), *getFilterConditions(filters)).subquery()
+
+
+def iterTaskGroups(groupColumn, groups, filters, order, limit=None, lazy=False, asRows=False, archive=False):
+    """Fetch all tasks matching filters with a single query and yield them
+    partitioned by groupColumn.
+    @param groupColumn: column used to partition tasks, either Task.projectId or TaskKeyword.keywordId
+    @param groups: list of Project or Keyword instances, in the order they must be yielded
+    @param filters: list of DbFilter or KeywordFilter instances
+    @param order: ordering of tasks inside a group, in sqlalchemy format
+    @param limit: max number of tasks per group or None for no limit
+    @param lazy: if True, tasks are loaded in batches while they are iterated
+    and taskList is an iterator, which must be consumed before moving to the
+    next group
+    @param asRows: if True, taskList contains TaskRow instances instead of
+    Task instances
+    @param archive: if True, read the tasks of the archive database, which
+    must be attached. groups must then come from getArchiveGroups() and
+    asRows must be True
+    @return: a generator of (group, taskList) tuples. Groups without tasks are skipped"""
+    assert asRows or not archive, "Archived tasks can only be returned as rows"
+    if not groups:
+        return
+    session = db.getSession()
+    groupDict = dict((x.id, x) for x in groups)
+    rows = _getTaskGroupRows(groupColumn, list(groupDict.keys()), filters, order, limit)
+
+    groupRank = case(dict((x.id, rank) for rank, x in enumerate(groups)), value=rows.c.groupId)
+    if asRows:
+        query = session.query(*_getTaskRowColumns(), rows.c.groupId).join(Project, Task.project)
+    else:
+        query = session.query(Task, rows.c.groupId)
+    query = query.join(rows, Task.id == rows.c.taskId)
+    if limit is not None:
+        query = query.filter(rows.c.rowNumber <= limit)
+    query = query.order_by(groupRank, *order)
+    if not asRows:
+        query = eagerLoadTaskRelations(query)
+    if archive:
+        query = query.execution_options(schema_translate_map=ARCHIVE_SCHEMA_MAP)
+    if lazy:
+        query = query.yield_per(LAZY_LOAD_BATCH_SIZE)
+
+    for groupId, groupRows in groupby(query, key=lambda x: x[-1]):
+        if asRows:
+            taskList = (_createTaskRow(x) for x in groupRows)
+        else:
+            taskList = (x[0] for x in groupRows)
+        if not lazy:
+            taskList = list(taskList)
+        yield groupDict[groupId], taskList
+
+
+def getTaskGroupsMaxWidths(groupColumn, groups, filters, order, limit=None, archive=False):
+    """Compute the widths needed to render the tasks iterTaskGroups() would
+    return, without loading them. Used by TextListRenderer in stream mode
+    @return: a tuple (maxTitleWidth, maxId). maxTitleWidth is the length of
+    "title (@keyword1 @keyword2)", plus one if the task has a description"""
+    if not groups:
+        return 0, 0
+    session = db.getSession()
+    rows = _getTaskGroupRows(groupColumn, [x.id for x in groups], filters, order, limit)
+
+    # Length of " (@k1 @k2)". Each keyword takes its length plus 2 ("@" and
+    # a space or the opening parenthesis), the last one is followed by ")"
+    keywordWidth = session.query(func.coalesce(func.sum(func.length(Keyword.name) + 2) + 2, 0)) \
+        .select_from(TaskKeyword).join(Keyword) \
+        .filter(TaskKeyword.taskId == Task.id, ~Keyword.name.startswith("_", autoescape=True)) \
+        .scalar_subquery()
+    descriptionWidth = case((Task.description != "", 1), else_=0)
+    query = session.query(func.max(func.length(Task.title) + keywordWidth + descriptionWidth), func.max(Task.id)) \
+        .join(rows, Task.id == rows.c.taskId)
+    if limit is not None:
+        query = query.filter(rows.c.rowNumber <= limit)
+    if archive:
+        query = query.execution_options(schema_translate_map=ARCHIVE_SCHEMA_MAP)
+    maxTitleWidth, maxId = query.one()
+    return maxTitleWidth or 0, maxId or 0
+
+
+# Number of tasks removed by each round of DELETE statements in deleteTasks()
+DELETE_CHUNK_SIZE = 500
+
+
+def deleteTasks(filters, chunkSize=DELETE_CHUNK_SIZE, onProgress=None):
+    """Delete the tasks matching filters, with their keywords and locks,
+    using set-based DELETE statements instead of loading the tasks.
+    Does not commit: all chunks are deleted in the current transaction. Task
+    instances already loaded in the session must not be used afterwards
+    @param filters: list of sqlalchemy expressions on Task columns
+    @param chunkSize: number of tasks removed by each round of statements
+    @param onProgress: callable receiving the number of tasks deleted so far
+    after each chunk, or None
+    @return: the number of deleted tasks"""
+    session = db.getSession()
+    chunk = select(Task.id).where(*filters).order_by(Task.id).limit(chunkSize).scalar_subquery()
+    # Tasks are only deleted by the last statement, so the chunk subquery
+    # returns the same ids for the three of them
+    statements = [
+        delete(TaskKeyword).where(TaskKeyword.taskId.in_(chunk)),
+        delete(TaskLock).where(TaskLock.taskId.in_(chunk)),
+        delete(Task).where(Task.id.in_(chunk)),
+    ]
+    count = 0
+    while True:
+        for statement in statements:
+            result = session.execute(statement, execution_options={"synchronize_session": False})
+        deleted = result.rowcount
+        if deleted == 0:
+            return count
+        count += deleted
+        if onProgress:
+            onProgress(count)
+
+
+# Makes queries read the tables of the archive database
+ARCHIVE_SCHEMA_MAP = {None: db.ARCHIVE_SCHEMA}
+
+# Tables of the archive database, for queries which use both databases.
+# Created on first use, copying the tables slows down startup
+_archiveMetadata = None
+
+
+def _getArchiveTable(name):
+    global _archiveMetadata
+    if _archiveMetadata is None:
+        _archiveMetadata = MetaData()
+        for table in db.Base.metadata.sorted_tables:
+            table.to_metadata(_archiveMetadata, schema=db.ARCHIVE_SCHEMA)
+    return _archiveMetadata.tables["%s.%s" % (db.ARCHIVE_SCHEMA, name)]
+
+
+class ArchiveGroup(namedtuple("ArchiveGroup", ("id", "name"))):
+    """A project or a keyword of the archive database. Archived projects and
+    keywords are not loaded as Project or Keyword instances: their ids would
+    clash with the ones of the main database in the identity map"""
+    __slots__ = ()
+
+    def __str__(self):
+        return self.name
+
+
+def getArchiveGroups(cls, names):
+    """Returns the projects or keywords of the archive database, which must
+    be attached, called like the ones in names
+    @param cls: Project or Keyword
+    @param names: list of names
+    @return: list of ArchiveGroup, in the order of names. Names which do not
+    exist in the archive database are skipped"""
+    session = db.getSession()
+    archiveTable = _getArchiveTable(cls.__tablename__)
+    idDict = dict((name, id) for id, name in
+                  session.execute(select(archiveTable.c.id, archiveTable.c.name)
+                                  .where(archiveTable.c.name.in_(names))))
+    return [ArchiveGroup(idDict[x], x) for x in names if x in idDict]
+
+
+def archiveTasks(filters):
+    """Move the tasks matching filters, with their keywords, to the archive
+    database, which is attached and created if needed. Projects and keywords
+    are matched by name, and created in the archive database if needed. Tasks
+    keep their id, unless it is already used in the archive database.
+
+    Commits twice: SQLite does not commit a transaction writing to several
+    databases atomically in WAL mode, so tasks are copied to the archive
+    database in a first transaction, then removed from the main database in a
+    second one. If the second one does not happen, archiving again removes
+    the tasks without copying them twice.
+
+    Task instances already loaded in the session must not be used afterwards
+    @param filters: list of sqlalchemy expressions on Task columns
+    @return: the number of archived tasks"""
+    session = db.getSession()
+    if not db.attachArchive():
+        db.attachArchive(create=True)
+        tui.info("Created archive database %s" % db.getArchivePath())
+    archiveProject = _getArchiveTable("project")
+    archiveKeyword = _getArchiveTable("keyword")
+    archiveTask = _getArchiveTable("task")
+    archiveTaskKeyword = _getArchiveTable("task_keyword")
+    taskIds = select(Task.id).where(*filters)
+
+    session.execute(insert(archiveProject).from_select(
+        ["uuid", "name", "active"],
+        select(Project.uuid, Project.name, Project.active)
+        .where(Project.id.in_(select(Task.projectId).where(*filters)),
+               Project.name.not_in(select(archiveProject.c.name)))))
+
+    session.execute(insert(archiveKeyword).from_select(
+        ["name"],
+        select(Keyword.name)
+        .where(Keyword.id.in_(select(TaskKeyword.keywordId).where(TaskKeyword.taskId.in_(taskIds))),
+               Keyword.name.not_in(select(archiveKeyword.c.name)))))
+
+    # Tasks are identified by their uuid, so that archiving again after an
+    # interruption does not duplicate them
+    taskTable = Task.__table__
+    taskId = case((Task.id.in_(select(archiveTask.c.id)), null()), else_=Task.id)
+    columns = ["id", "uuid", "title", "creation_date", "update_date", "due_date", "done_date", "description",
+               "urgency", "status", "recurrence", "is_note", "project_id"]
+    session.execute(insert(archiveTask).from_select(
+        columns,
+        select(taskId, *[taskTable.c[x] for x in columns[1:-1]], archiveProject.c.id)
+        .join(Project, Task.projectId == Project.id)
+        .join(archiveProject, archiveProject.c.name == Project.name)
+        .where(*filters, Task.uuid.not_in(select(archiveTask.c.uuid)))))
+
+    session.execute(insert(archiveTaskKeyword).prefix_with("OR IGNORE").from_select(
+        ["task_id", "keyword_id", "value"],
+        select(archiveTask.c.id, archiveKeyword.c.id, TaskKeyword.value)
+        .select_from(TaskKeyword)
+        .join(Task, TaskKeyword.taskId == Task.id)
+        .join(archiveTask, archiveTask.c.uuid == Task.uuid)
+        .join(Keyword, TaskKeyword.keywordId == Keyword.id)
+        .join(archiveKeyword, archiveKeyword.c.name == Keyword.name)
+        .where(*filters)))
+
+    # Only remove tasks which are in the archive database. Use their ids: the
+    # archive database may not be attached to the connection of the next
+    # transaction
+    archivedIds = [x for x, in session.execute(select(Task.id).where(
+        *filters, Task.uuid.in_(select(archiveTask.c.uuid))).order_by(Task.id))]
+    session.commit()
+
+    count = 0
+    for start in range(0, len(archivedIds), ID_QUERY_CHUNK_SIZE):
+        count += deleteTasks([Task.id.in_(archivedIds[start:start + ID_QUERY_CHUNK_SIZE])])
+    session.commit()
+    return count
+
+
+def getArchiveFilters(delay):
+    """Returns the filters matching the tasks which have been done for more
+    than delay days"""
+    return [Task.status == "done", Task.doneDate < datetime.now() - timedelta(days=delay)]
+
+
+def archiveOldTasks():
+    """Archive the tasks which have been done for more than ARCHIVE_DELAY
+    days, if ARCHIVE_DELAY is not 0. Commits if tasks have been archived, see
+    archiveTasks()
+    @return: the number of archived tasks"""
+    session = db.getSession()
+    delay = int(db.getConfigKey("ARCHIVE_DELAY", environ=False))
+    if delay <= 0:
+        return 0
+    filters = getArchiveFilters(delay)
+    if session.query(Task.id).filter(*filters).first() is None:
+        return 0
+    return archiveTasks(filters)
+
+
+def vacuumDatabase():
+    """Give the space of deleted rows back to the file system. Uses
+    incremental_vacuum if the database has been created with
+    auto_vacuum=incremental, VACUUM otherwise. Must be called outside of a
+    transaction"""
+    engine = db.getSession().get_bind()
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        # 2 is INCREMENTAL
+        if connection.exec_driver_sql("pragma auto_vacuum").scalar() == 2:
+            # Each step of the statement frees a page: fetch all its rows
+            connection.exec_driver_sql("pragma incremental_vacuum").fetchall()
+        else:
+            connection.exec_driver_sql("vacuum")
+        # In WAL mode, the database file only shrinks once the changes have
+        # been written back to it
+        connection.exec_driver_sql("pragma wal_checkpoint(truncate)").fetchall()
+
+
+def setNoteFlag(keyword, value):
+    """Set the noteFlag of all the tasks having keyword to value, with a
+    single UPDATE statement. Must be called when the NOTE_KEYWORD keyword is
+    renamed or removed. Does not commit
+    @param keyword: a Keyword instance
+    @param value: the new noteFlag (bool)"""
+    session = db.getSession()
+    taskIds = select(TaskKeyword.taskId).where(TaskKeyword.keywordId == keyword.id)
+    session.execute(update(Task).where(Task.id.in_(taskIds)).values(noteFlag=value),
+                    execution_options={"synchronize_session": "fetch"})
 
 
 def splitKeywordDict(dct):
@@ -205,6 +731,14 @@ class TaskLockManager:
             self.session.commit()
 
 
+def getFilterConditions(filters):
+    """Turn filters into conditions on Task, which can be combined in a single
+    query without joins, and thus without DISTINCT
+    @param filters: list of DbFilter, KeywordFilter or TextFilter instances
+    @return: list of sqlalchemy conditions"""
+    return [x.getCondition() for x in filters]
+
+
 class DbFilter(object):
     """
     Light wrapper around SQL Alchemy filters. Makes it possible to have the
@@ -213,6 +747,9 @@ class DbFilter(object):
     def __init__(self, condition):
         self.condition = condition
 
+    def getCondition(self):
+        return self.condition
+
     def apply(self, lst):
         return lst.filter(self.condition)
 
@@ -230,24 +767,109 @@ class KeywordFilter(object):
         return "<KeywordFilter name={} negative={} value={} valueOperator={}>".format(
             self.name, self.negative, self.value, self.valueOperator)
 
+    def getCondition(self):
+        """Returns the filter as a correlated EXISTS or NOT EXISTS condition
+        on Task. Unlike joins, it does not multiply the rows of the query it
+        is used in"""
+        taskKeywordAlias = aliased(TaskKeyword)
+        keywordAlias = aliased(Keyword)
+        condition = keywordAlias.name.like(self.name)
+        if not self.negative:
+            if self.valueOperator == "=":
+                condition = and_(condition, taskKeywordAlias.value == self.value)
+            elif self.valueOperator == "!=":
+                condition = and_(condition, taskKeywordAlias.value != self.value)
+        exists = select(taskKeywordAlias.id) \
+            .join(keywordAlias, taskKeywordAlias.keywordId == keywordAlias.id) \
+            .where(taskKeywordAlias.taskId == Task.id, condition) \
+            .correlate(Task) \
+            .exists()
+        return ~exists if self.negative else exists
+
     def apply(self, query):
         """Apply keyword filters to query
         @return: a new query"""
-        if self.negative:
-            session = db.getSession()
-            excludedTaskIds = session.query(Task.id).join(TaskKeyword).join(Keyword) \
-                .filter(Keyword.name.like(self.name))
-            return query.filter(~Task.id.in_(excludedTaskIds))
-        else:
-            keywordAlias = aliased(Keyword)
-            taskKeywordAlias = aliased(TaskKeyword)
-            query = query.outerjoin(taskKeywordAlias, Task.taskKeywords)
-            query = query.outerjoin(keywordAlias, taskKeywordAlias.keyword)
-            filter = keywordAlias.name.like(self.name)
-            if self.valueOperator == "=":
-                filter = and_(filter, taskKeywordAlias.value == self.value)
-            elif self.valueOperator == "!=":
-                filter = and_(filter, taskKeywordAlias.value != self.value)
-            return query.filter(filter)
+        return query.filter(self.getCondition())
 
+
+class TextFilter(object):
+    """Filter tasks whose title, description or keywords contain all the
+    given words, using the full-text index"""
+    def __init__(self, words):
+        """
+        @param words: list of words. A word is matched as a prefix: "sched"
+        matches "scheduler". A "word" containing spaces is matched as a phrase
+        """
+        self.words = words
+
+    def __repr__(self):
+        return "<TextFilter words={}>".format(self.words)
+
+    def getCondition(self):
+        return Task.id.in_(getTextMatchQuery(self.words))
+
+    def apply(self, query):
+        """Apply the filter to query
+        @return: a new query"""
+        return query.filter(self.getCondition())
+
+
+# Description of the full-text index, for use in queries. A Table, so that
+# queries on the archive database use its own index
+_ftsTable = Table(db.FTS_TABLE, MetaData(), Column("rowid", Integer))
+
+
+def buildFtsQuery(words):
+    """Turn a list of words into an FTS5 query matching all of them. Each
+    word is quoted, so that FTS5 operators are not interpreted
+    @return: the query, as a string"""
+    terms = []
+    for word in words:
+        word = word.strip()
+        if word:
+            terms.append('"%s"*' % word.replace('"', '""'))
+    return " AND ".join(terms)
+
+
+def getTextMatchQuery(words):
+    """@return: a select of the ids of the tasks matching words. See
+    TextFilter"""
+    ftsQuery = buildFtsQuery(words)
+    if not ftsQuery:
+        raise YokadiException("No search words supplied")
+    return select(_ftsTable.c.rowid).where(literal_column(db.FTS_TABLE).op("MATCH")(ftsQuery))
+
+
+def searchTasks(words):
+    """Search tasks using the full-text index
+    @param words: see TextFilter
+    @return: a query returning the matching tasks, most relevant first.
+    Matches in titles weigh more than matches in keywords, which weigh more
+    than matches in descriptions"""
+    session = db.getSession()
+    matches = getTextMatchQuery(words) \
+        .add_columns(func.bm25(literal_column(db.FTS_TABLE), 10.0, 1.0, 5.0).label("score")) \
+        .subquery()
+    query = session.query(Task).join(matches, Task.id == matches.c.rowid).order_by(matches.c.score, Task.id)
+    return eagerLoadTaskRelations(query)
+
+
+class DatabaseWatcher(object):
+    """Tells whether the database has been modified by another connection,
+    using SQLite data_version pragma"""
+    def __init__(self, engine):
+        # data_version is only meaningful when always read from the same
+        # connection
+        self.connection = engine.connect()
+        self.version = None
+
+    def hasChanged(self):
+        version = self.connection.execute(text("pragma data_version")).scalar()
+        self.connection.rollback()
+        changed = version != self.version
+        self.version = version
+        return changed
+
+    def close(self):
+        self.connection.close()
 # vi: ts=4 sw=4 et
@@ -4,7 +4,11 @@ Date utilities.
 @author: Aurélien Gâteau <mail@agateau.com>
 @license: GPL v3 or later
 """
-from datetime import datetime
+from calendar import monthrange
+from collections import defaultdict
+from datetime import datetime, timedelta
+from functools import lru_cache, partial
+import json
 
 from dateutil import rrule
 
@@ -16,6 +20,18 @@ FREQUENCIES = {0: "Yearly", 1: "Monthly", 2: "Weekly", 3: "Daily"}
 
 ALL_DAYS = (rrule.MO, rrule.TU, rrule.WE, rrule.TH, rrule.FR, rrule.SA, rrule.SU)
 
+# Max number of JSON strings remembered by RecurrenceRule.fromJson()
+JSON_CACHE_SIZE = 1024
+
+# Max number of rules remembered by RecurrenceRule.intern()
+INTERN_CACHE_SIZE = 1024
+
+# A compiled rrule starts at the time it has been created, and looking for
+# an occurence walks all the occurences since then. Compile it again when it
+# is older than this, so that long running processes (yokadid, yokadi
+# --serve) stay fast
+MAX_COMPILED_RULE_AGE = timedelta(days=1)
+
 
 class RecurrenceRule(object):
     """Thin wrapper around dateutil.rrule which brings:
@@ -25,6 +41,10 @@ class RecurrenceRule(object):
     - Sane defaults (byhour = byminute = bysecond = 0)
     - __eq__ operator
     - Readable name
+    - Interning (see intern()) and caching of the compiled rrule
+
+    Instances must not be modified once created: they are shared between
+    all tasks using the same rule.
 
     Dict format:
         freq: 0..3, see FREQUENCIES dict
@@ -55,12 +75,32 @@ class RecurrenceRule(object):
             self._byweekday = tuplify(byweekday)
         self._byhour = tuplify(byhour)
         self._byminute = tuplify(byminute)
+        # (rrule, start date of the rrule), see _rrule()
+        self._compiledRule = None
+
+    @staticmethod
+    def intern(rule):
+        """Returns the shared instance equal to rule, registering rule if
+        there is none yet. Only the last INTERN_CACHE_SIZE rules are
+        remembered"""
+        return _internRule(rule)
 
     @staticmethod
     def fromDict(dct):
+        """Returns the interned rule matching dct"""
         if not dct:
-            return RecurrenceRule()
-        return RecurrenceRule(**dct)
+            return RecurrenceRule.intern(RecurrenceRule())
+        return RecurrenceRule.intern(RecurrenceRule(**dct))
+
+    @staticmethod
+    @lru_cache(maxsize=JSON_CACHE_SIZE)
+    def fromJson(text):
+        """Returns the interned rule matching a JSON string created by
+        toJson(). Decoded strings are remembered, so loading many tasks with
+        the same rule only decodes it once"""
+        if not text:
+            return RecurrenceRule.fromDict({})
+        return RecurrenceRule.fromDict(json.loads(text))
 
     @staticmethod
     def fromHumaneString(line):
@@ -73,7 +113,7 @@ class RecurrenceRule(object):
         tokens[0] = tokens[0].lower()
 
         if tokens[0] == "none":
-            return RecurrenceRule()
+            return RecurrenceRule.fromDict({})
 
         if tokens[0] == "daily":
             if len(tokens) != 2:
@@ -118,14 +158,14 @@ class RecurrenceRule(object):
         else:
             raise YokadiException("Unknown frequency. Available: daily, weekly, monthly and yearly")
 
-        return RecurrenceRule(
+        return RecurrenceRule.intern(RecurrenceRule(
             freq,
             bymonth=bymonth,
             bymonthday=bymonthday,
             byweekday=byweekday,
             byhour=byhour,
             byminute=byminute,
-        )
+        ))
 
     def toDict(self):
         if not self:
@@ -140,7 +180,38 @@ class RecurrenceRule(object):
             byminute=self._byminute
         )
 
+    def toJson(self):
+        """Returns the rule as a JSON string, or an empty string if the rule
+        is not set"""
+        if not self:
+            return ""
+        return json.dumps(self.toDict())
+
+    def _getKey(self):
+        """Returns a hashable value identifying the rule"""
+        if isinstance(self._byweekday, dict):
+            byweekday = tuple(sorted(self._byweekday.items()))
+        else:
+            byweekday = self._byweekday
+        return (self._freq, self._bymonth, self._bymonthday, byweekday, self._byhour, self._byminute)
+
     def _rrule(self):
+        """Returns the dateutil rrule for this rule. It is created on first
+        call and reused afterwards, until it is older than
+        MAX_COMPILED_RULE_AGE.
+
+        The rrule does not return occurences before its start date, so the
+        dates given to it must not be before the current time: use
+        _getLowerBound()"""
+        now = datetime.now().replace(microsecond=0)
+        compiledRule = self._compiledRule
+        if compiledRule is None or now - compiledRule[1] > MAX_COMPILED_RULE_AGE:
+            # Replace the tuple at once: instances are shared between threads
+            compiledRule = (self._createRRule(now), now)
+            self._compiledRule = compiledRule
+        return compiledRule[0]
+
+    def _createRRule(self, dtstart):
         if isinstance(self._byweekday, dict):
             day = ALL_DAYS[self._byweekday["weekday"]]
             byweekday = day(self._byweekday["pos"])
@@ -154,7 +225,8 @@ class RecurrenceRule(object):
             byweekday=byweekday,
             byhour=self._byhour,
             byminute=self._byminute,
-            bysecond=0
+            bysecond=0,
+            dtstart=dtstart
         )
 
     def getNext(self, refDate=None):
@@ -164,10 +236,83 @@ class RecurrenceRule(object):
         @return: next occurence (datetime)"""
         if not self:
             return None
-        if refDate is None:
-            refDate = datetime.now()
-        refDate.replace(second=0, microsecond=0)
-        return self._rrule().after(refDate)
+        return self._rrule().after(_getLowerBound(refDate, datetime.now()))
+
+    def iterNext(self, refDate=None):
+        """Same as calling getNext() again and again with the previous
+        occurence, but the rrule occurences are only walked once
+        @param refDate: reference date used to compute the first occurence
+        @type refDate: datetime
+        @return: a generator of the occurences (datetime)"""
+        if not self:
+            return
+        date = _getLowerBound(refDate, datetime.now())
+        getNextDate = self._getArithmeticFunction()
+        if getNextDate is None:
+            yield from self._rrule().xafter(date)
+            return
+        while True:
+            date = getNextDate(date)
+            yield date
+
+    @staticmethod
+    def getNextBatch(rules, refDates):
+        """Same as calling getNext() on each rule with the matching refDate,
+        but faster for many rules: equal rules are processed together, and
+        the common daily, weekly and monthly rules are computed with plain
+        date arithmetic instead of dateutil
+        @param rules: list of RecurrenceRule instances
+        @param refDates: list of reference dates (datetime or None), with the
+        same length as rules
+        @return: list of next occurences (datetime or None)"""
+        now = datetime.now()
+        result = [None] * len(rules)
+        # rule => indexes of the rule in rules
+        indexDict = defaultdict(list)
+        for idx, rule in enumerate(rules):
+            if rule:
+                indexDict[rule].append(idx)
+        for rule, indexes in indexDict.items():
+            dates = [_getLowerBound(refDates[x], now) for x in indexes]
+            for idx, nextDate in zip(indexes, rule._getNextDates(dates)):
+                result[idx] = nextDate
+        return result
+
+    def _getNextDates(self, dates):
+        """Returns the first occurence after each date of dates"""
+        getNextDate = self._getArithmeticFunction()
+        if getNextDate is not None:
+            return [getNextDate(x) for x in dates]
+
+        # Walk the occurences only once, handling dates in chronological order
+        result = [None] * len(dates)
+        occurences = iter(self._rrule())
+        occurence = next(occurences, None)
+        for idx in sorted(range(len(dates)), key=dates.__getitem__):
+            while occurence is not None and occurence <= dates[idx]:
+                occurence = next(occurences, None)
+            if occurence is None:
+                break
+            result[idx] = occurence
+        return result
+
+    def _getArithmeticFunction(self):
+        """Returns a function computing the next occurence after a date
+        without dateutil, or None if the rule is not a simple daily, weekly or
+        monthly rule"""
+        if self._bymonth or len(self._byhour) != 1 or len(self._byminute) != 1 \
+                or isinstance(self._byweekday, dict):
+            return None
+        hour, minute = self._byhour[0], self._byminute[0]
+        if self._freq == rrule.DAILY and not self._bymonthday and not self._byweekday:
+            return partial(_getNextDaily, hour, minute)
+        if self._freq == rrule.WEEKLY and not self._bymonthday and self._byweekday \
+                and all(0 <= x <= 6 for x in self._byweekday):
+            return partial(_getNextWeekly, frozenset(self._byweekday), hour, minute)
+        if self._freq == rrule.MONTHLY and not self._byweekday and len(self._bymonthday) == 1 \
+                and 1 <= self._bymonthday[0] <= 31:
+            return partial(_getNextMonthly, self._bymonthday[0], hour, minute)
+        return None
 
     def getFrequencyAsString(self):
         """Return a string for the frequency"""
@@ -180,7 +325,12 @@ class RecurrenceRule(object):
         return dict(pos=pos, weekday=weekday)
 
     def __eq__(self, other):
-        return self.toDict() == other.toDict()
+        if not isinstance(other, RecurrenceRule):
+            return NotImplemented
+        return self._getKey() == other._getKey()
+
+    def __hash__(self):
+        return hash(self._getKey())
 
     def __bool__(self):
         return self._freq is not None
@@ -188,4 +338,47 @@ class RecurrenceRule(object):
     def __repr__(self):
         return repr(self.toDict())
 
+
+@lru_cache(maxsize=INTERN_CACHE_SIZE)
+def _internRule(rule):
+    # Rules equal to a cached one get the cached one
+    return rule
+
+
+def _getLowerBound(refDate, now):
+    """Returns the date after which the next occurence must be searched.
+
+    An rrule only returns occurences which are not before its start date,
+    which defaults to the time the rrule has been created. Since compiled
+    rrules are cached, enforce the "not before now" constraint here"""
+    lowerBound = now.replace(microsecond=0) - timedelta(microseconds=1)
+    if refDate is None or refDate < lowerBound:
+        return lowerBound
+    return refDate
+
+
+def _getNextDaily(hour, minute, date):
+    nextDate = date.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if nextDate <= date:
+        nextDate += timedelta(days=1)
+    return nextDate
+
+
+def _getNextWeekly(weekdays, hour, minute, date):
+    nextDate = _getNextDaily(hour, minute, date)
+    while nextDate.weekday() not in weekdays:
+        nextDate += timedelta(days=1)
+    return nextDate
+
+
+def _getNextMonthly(day, hour, minute, date):
+    year, month = date.year, date.month
+    while True:
+        # Like rrule, skip months which do not have this day
+        if day <= monthrange(year, month)[1]:
+            nextDate = datetime(year, month, day, hour, minute)
+            if nextDate > date:
+                return nextDate
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
 # vi: ts=4 sw=4 et
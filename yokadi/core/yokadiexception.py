@@ -15,4 +15,11 @@ class YokadiException(Exception):
 class BadUsageException(YokadiException):
     """Exception when user does not pass correct arguments to a command"""
     pass
+
+
+class InputRequiredException(Exception):
+    """Exception when a command needs to read user input, but this process
+    cannot read it. Raised by commands running in the Yokadi server: the
+    client then runs the command itself"""
+    pass
 # vi: ts=4 sw=4 et
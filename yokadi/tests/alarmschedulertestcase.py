@@ -0,0 +1,163 @@
+# -*- coding: UTF-8 -*-
+"""
+Alarm scheduler test cases
+@author: Aurélien Gâteau <mail@agateau.com>
+@license: GPL v3 or later
+"""
+import os
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from yokadi.core import db, dbutils
+from yokadi.core.alarmscheduler import AlarmRunner, AlarmScheduler, DELAY_ALARM, DUE_ALARM, \
+    getPendingDueDates
+from yokadi.tests.yokaditestcase import YokadiTestCase
+
+
+NOW = datetime(2024, 3, 1, 12, 0)
+
+
+class AlarmSchedulerTestCase(YokadiTestCase):
+    def setUp(self):
+        YokadiTestCase.setUp(self)
+        self.scheduler = AlarmScheduler(delta=timedelta(hours=8), suspend=timedelta(hours=1))
+
+    def testEmpty(self):
+        self.scheduler.update([])
+        self.assertIsNone(self.scheduler.getNextDate())
+        self.assertEqual(self.scheduler.popAlarms(NOW), [])
+
+    def testAlarmSequence(self):
+        dueDate = NOW + timedelta(hours=10)
+        self.scheduler.update([(1, dueDate)])
+
+        # Nothing to do until 8 hours before the due date
+        self.assertEqual(self.scheduler.getNextDate(), NOW + timedelta(hours=2))
+        self.assertEqual(self.scheduler.popAlarms(NOW), [])
+
+        date = NOW + timedelta(hours=2)
+        for delay in range(8):
+            self.assertEqual(self.scheduler.getNextDate(), date)
+            self.assertEqual(self.scheduler.popAlarms(date), [(1, DELAY_ALARM)])
+            date += timedelta(hours=1)
+
+        # The due alarm repeats every hour
+        for delay in range(3):
+            self.assertEqual(self.scheduler.getNextDate(), dueDate + timedelta(hours=delay))
+            self.assertEqual(self.scheduler.popAlarms(self.scheduler.getNextDate()), [(1, DUE_ALARM)])
+
+    def testMissedDelayAlarm(self):
+        dueDate = NOW + timedelta(hours=1)
+        self.scheduler.update([(1, dueDate)])
+        self.assertEqual(self.scheduler.popAlarms(NOW + timedelta(hours=2)), [(1, DUE_ALARM)])
+        self.assertEqual(self.scheduler.getNextDate(), NOW + timedelta(hours=3))
+
+    def testUpdateKeepsTriggeredAlarms(self):
+        dueDate = NOW - timedelta(hours=1)
+        self.scheduler.update([(1, dueDate), (2, dueDate)])
+        self.assertEqual(sorted(self.scheduler.popAlarms(NOW)), [(1, DUE_ALARM), (2, DUE_ALARM)])
+
+        # Task 1 did not change: wait for the suspend delay. Task 2 has a new
+        # due date: start again
+        newDueDate = NOW + timedelta(minutes=30)
+        self.scheduler.update([(1, dueDate), (2, newDueDate)])
+        self.assertEqual(self.scheduler.popAlarms(NOW), [(2, DELAY_ALARM)])
+        self.assertEqual(self.scheduler.getNextDate(), newDueDate)
+        self.assertEqual(self.scheduler.popAlarms(newDueDate), [(2, DUE_ALARM)])
+        self.assertEqual(self.scheduler.popAlarms(NOW + timedelta(hours=1)), [(1, DUE_ALARM)])
+
+        # Task 1 is done: it is gone
+        self.scheduler.update([(2, newDueDate)])
+        self.assertEqual(self.scheduler.popAlarms(NOW + timedelta(hours=10)), [(2, DUE_ALARM)])
+
+
+class AlarmRunnerTestCase(YokadiTestCase):
+    def testRunInParallel(self):
+        runner = AlarmRunner(maxRunning=4, timeout=10)
+        out = StringIO()
+        start = time.monotonic()
+        with redirect_stdout(out):
+            futures = [runner.run(x, "sleep 0.5; echo hello %d" % x) for x in range(4)]
+            self.assertEqual([x.result() for x in futures], [0, 0, 0, 0])
+            runner.shutdown()
+        self.assertLess(time.monotonic() - start, 1.5)
+        for taskId in range(4):
+            self.assertIn("Command for task %d exited with code 0. Output:\nhello %d" % (taskId, taskId),
+                          out.getvalue())
+
+    def testTimeout(self):
+        runner = AlarmRunner(maxRunning=1, timeout=0.2)
+        out = StringIO()
+        with redirect_stdout(out):
+            future = runner.run(1, "sleep 10")
+            # A command is already pending for this task
+            self.assertIsNone(runner.run(1, "true"))
+            self.assertNotEqual(future.result(), 0)
+            # Once finished, the task can be alarmed again
+            self.assertEqual(runner.run(1, "true").result(), 0)
+            runner.shutdown()
+        self.assertIn("Command for task 1 killed", out.getvalue())
+
+    def testTimeoutAfterExit(self):
+        # The command exits between the timeout and the kill
+        runner = AlarmRunner(maxRunning=1, timeout=0.2)
+        out = StringIO()
+        with redirect_stdout(out), patch("os.killpg", side_effect=ProcessLookupError) as killpg:
+            self.assertEqual(runner.run(1, "sleep 0.5").result(), 0)
+            runner.shutdown()
+        self.assertEqual(killpg.call_count, 1)
+        self.assertIn("Command for task 1 exited with code 0", out.getvalue())
+
+    def testNoTimeout(self):
+        runner = AlarmRunner(maxRunning=1, timeout=None)
+        with redirect_stdout(StringIO()):
+            self.assertEqual(runner.run(1, "sleep 0.2").result(), 0)
+            runner.shutdown()
+
+    def testShutdownDropsQueuedCommands(self):
+        runner = AlarmRunner(maxRunning=1, timeout=10)
+        out = StringIO()
+        with redirect_stdout(out):
+            running = runner.run(1, "sleep 0.3")
+            queued = runner.run(2, "true")
+            runner.shutdown()
+        self.assertEqual(running.result(), 0)
+        self.assertTrue(queued.cancelled())
+        self.assertNotIn("task 2", out.getvalue())
+
+
+class DatabaseWatcherTestCase(YokadiTestCase):
+    def setUp(self):
+        YokadiTestCase.setUp(self)
+        db.connectDatabase(os.path.join(self.testHomeDir, "yokadi.db"))
+        self.session = db.getSession()
+
+    def tearDown(self):
+        self.session.close()
+        db._database.engine.dispose()
+        YokadiTestCase.tearDown(self)
+
+    def testWatcher(self):
+        watcher = dbutils.DatabaseWatcher(self.session.get_bind())
+        try:
+            self.assertTrue(watcher.hasChanged())
+            self.assertFalse(watcher.hasChanged())
+
+            dueDate = datetime.now() + timedelta(days=1)
+            task = dbutils.addTask("x", "t1", interactive=False)
+            task.dueDate = dueDate
+            self.session.commit()
+            self.assertTrue(watcher.hasChanged())
+            self.assertFalse(watcher.hasChanged())
+            self.assertEqual(list(getPendingDueDates(self.session)), [(task.id, dueDate)])
+
+            task.project.active = False
+            self.session.commit()
+            self.assertTrue(watcher.hasChanged())
+            self.assertEqual(list(getPendingDueDates(self.session)), [])
+        finally:
+            watcher.close()
+# vi: ts=4 sw=4 et
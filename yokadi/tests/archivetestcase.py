@@ -0,0 +1,211 @@
+# -*- coding: UTF-8 -*-
+"""
+Archive test cases
+@author: Aurélien Gâteau <mail@agateau.com>
+@license: GPL v3 or later
+"""
+import os
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest.mock import patch
+
+import testutils
+
+from yokadi.core import db, dbutils
+from yokadi.core.db import Config, Task, TaskKeyword, setDefaultConfig
+from yokadi.core.yokadiexception import YokadiException
+from yokadi.tests.yokaditestcase import YokadiTestCase
+from yokadi.update import update
+from yokadi.ycli import main, tui
+from yokadi.ycli.main import YokadiCmd
+
+
+class ArchiveTestCase(YokadiTestCase):
+    def setUp(self):
+        YokadiTestCase.setUp(self)
+        self.dbPath = os.path.join(self.testHomeDir, "yokadi.db")
+        self.archivePath = os.path.join(self.testHomeDir, "yokadi-archive.db")
+        db.connectDatabase(self.dbPath)
+        setDefaultConfig()
+        self.session = db.getSession()
+        self.session.commit()
+        tui.clearInputAnswers()
+        self.cmd = YokadiCmd()
+
+    def tearDown(self):
+        self.session.close()
+        db._database.engine.dispose()
+        YokadiTestCase.tearDown(self)
+
+    def addDoneTask(self, projectName, title, keywordDict=None, days=100):
+        task = dbutils.addTask(projectName, title, keywordDict, interactive=False)
+        task.setStatus("done")
+        task.doneDate = datetime.now() - timedelta(days=days)
+        return task
+
+    def testArchive(self):
+        t1 = self.addDoneTask("x", "old scheduler", {"k1": 2, "k2": None})
+        t1.description = "Some description"
+        t2 = self.addDoneTask("y", "old y")
+        t3 = self.addDoneTask("x", "recent", days=1)
+        t4 = dbutils.addTask("x", "todo", {"k1": 3}, interactive=False)
+        self.session.commit()
+        t1Id, t2Id = t1.id, t2.id
+        t1Title, t1Description = t1.title, t1.description
+
+        with patch("sys.stdout", StringIO()) as out:
+            self.cmd.do_t_archive("-d 30")
+        self.assertIn("2 tasks archived", out.getvalue())
+        self.assertTrue(os.path.exists(self.archivePath))
+        self.assertEqual(self.session.query(Task).order_by(Task.id).all(), [t3, t4])
+        self.assertEqual(self.session.query(TaskKeyword).filter(TaskKeyword.taskId.in_([t1Id, t2Id])).count(), 0)
+
+        # Normal listing only sees the main database
+        renderer = testutils.TestRenderer()
+        self.cmd.do_t_list("-a", renderer=renderer)
+        self.assertEqual(list(renderer.taskDict.keys()), ["x"])
+
+        renderer = testutils.TestRenderer()
+        self.cmd.do_t_list("--archive", renderer=renderer)
+        self.assertEqual(list(renderer.taskDict.keys()), ["x", "x (archive)", "y (archive)"])
+        archived = renderer.taskDict["x (archive)"][0]
+        self.assertEqual((archived.id, archived.title, archived.description), (t1Id, t1Title, t1Description))
+        self.assertEqual(archived.getKeywordDict(), {"k1": 2, "k2": None})
+        self.assertEqual(self.cmd.lastTaskIds, [t3.id, t4.id])
+
+        # Filters work on both databases
+        for line, expected in [
+                ("--archive @k1", {"x": ["todo"], "x (archive)": ["old scheduler"]}),
+                ("--archive -s sched", {"x (archive)": ["old scheduler"]}),
+                ("--archive -k k2", {"k2 (archive)": ["old scheduler"]}),
+                ("--archive -k k1 y", {}),
+                ]:
+            with self.subTest(line=line):
+                renderer = testutils.TestRenderer()
+                self.cmd.do_t_list(line, renderer=renderer)
+                result = dict((k, [x.title for x in v]) for k, v in renderer.taskDict.items())
+                self.assertEqual(result, expected)
+
+        # Text rendering
+        with patch("yokadi.ycli.tui.stdout", StringIO()) as out:
+            self.cmd.do_t_list("--archive")
+        self.assertIn("y (archive)", out.getvalue())
+        self.assertIn("old scheduler", out.getvalue())
+
+    def testArchiveTwice(self):
+        self.addDoneTask("x", "t1", {"k1": 1})
+        self.session.commit()
+        with patch("sys.stdout", StringIO()):
+            self.cmd.do_t_archive("-d 30")
+
+        # The id of t1 is free again: t2 gets it. It must get another one in
+        # the archive
+        t2 = self.addDoneTask("x", "t2", {"k1": 2})
+        self.session.commit()
+        self.assertEqual(t2.id, 1)
+        with patch("sys.stdout", StringIO()) as out:
+            self.cmd.do_t_archive("-d 30")
+            self.cmd.do_t_archive("-d 30")
+        self.assertIn("1 tasks archived", out.getvalue())
+        self.assertIn("No tasks need to be archived", out.getvalue())
+
+        renderer = testutils.TestRenderer()
+        self.cmd.do_t_list("--archive", renderer=renderer)
+        tasks = renderer.taskDict["x (archive)"]
+        self.assertEqual(sorted(x.title for x in tasks), ["t1", "t2"])
+        self.assertNotEqual(tasks[0].id, tasks[1].id)
+        self.assertEqual(sorted(x.getKeywordDict()["k1"] for x in tasks), [1, 2])
+
+    def testArchiveInterrupted(self):
+        self.addDoneTask("x", "t1", {"k1": 1})
+        self.session.commit()
+        filters = dbutils.getArchiveFilters(30)
+
+        # The copy to the archive database is committed before the tasks are
+        # removed from the main database
+        with patch("yokadi.ycli.tui.stderr", StringIO()) as err, \
+                patch("yokadi.core.dbutils.deleteTasks", side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, dbutils.archiveTasks, filters)
+        self.assertIn("Created archive database", err.getvalue())
+        self.session.rollback()
+        self.assertEqual(self.session.query(Task).count(), 1)
+        renderer = testutils.TestRenderer()
+        self.cmd.do_t_list("--archive -a", renderer=renderer)
+        self.assertEqual([x.title for x in renderer.taskDict["x (archive)"]], ["t1"])
+
+        # Archiving again removes the task without copying it twice
+        self.assertEqual(dbutils.archiveTasks(filters), 1)
+        self.assertEqual(self.session.query(Task).count(), 0)
+        renderer = testutils.TestRenderer()
+        self.cmd.do_t_list("--archive -a", renderer=renderer)
+        self.assertEqual([x.title for x in renderer.taskDict["x (archive)"]], ["t1"])
+
+    def testArchiveOldTasks(self):
+        self.addDoneTask("x", "t1")
+        self.session.commit()
+
+        # Disabled by default
+        self.assertEqual(dbutils.archiveOldTasks(), 0)
+        self.assertFalse(os.path.exists(self.archivePath))
+
+        self.session.query(Config).filter_by(name="ARCHIVE_DELAY").one().value = "30"
+        self.session.commit()
+        self.assertEqual(dbutils.archiveOldTasks(), 1)
+        self.assertEqual(self.session.query(Task).count(), 0)
+
+    def createOldArchive(self):
+        """Create an archive database with the previous version, and
+        disconnect from the database"""
+        self.addDoneTask("x", "t1")
+        self.session.commit()
+        with patch("sys.stdout", StringIO()):
+            self.cmd.do_t_archive("-d 30")
+        self.session.close()
+        db._database.engine.dispose()
+
+        archive = db.Database(self.archivePath, createIfNeeded=False, updateMode=True)
+        archive.setVersion(db.DB_VERSION - 1)
+        archive.engine.dispose()
+
+    def testArchiveVersionMismatch(self):
+        self.createOldArchive()
+        db.connectDatabase(self.dbPath)
+        self.session = db.getSession()
+        self.assertRaises(db.DbUserException, db.attachArchive)
+
+    def testStartWithOldArchive(self):
+        self.createOldArchive()
+        db.connectDatabase(self.dbPath)
+        self.session = db.getSession()
+        self.addDoneTask("x", "t2")
+        self.session.query(Config).filter_by(name="ARCHIVE_DELAY").one().value = "30"
+        self.session.commit()
+        self.session.close()
+        db._database.engine.dispose()
+
+        # Automatic archiving is skipped, but Yokadi still starts
+        with patch("sys.argv", ["yokadi", "--db", self.dbPath, "t_list"]), \
+                patch("sys.stdout", StringIO()), patch("yokadi.ycli.tui.stderr", StringIO()) as err:
+            self.assertEqual(main.main(), 0)
+        self.session = db.getSession()
+        self.assertIn("Old tasks have not been archived", err.getvalue())
+        self.assertEqual(self.session.query(Task).count(), 1)
+
+    def testUpdateArchive(self):
+        self.createOldArchive()
+        moduleName = "update{}to{}".format(db.DB_VERSION - 1, db.DB_VERSION)
+        with patch.object(getattr(update, moduleName), "update") as updateFunction, patch("sys.stdout", StringIO()):
+            self.assertEqual(update.update(self.dbPath), 0)
+        # Only the archive database needed to be updated
+        self.assertEqual(updateFunction.call_count, 1)
+        self.assertEqual(update.getVersion(self.archivePath), db.DB_VERSION)
+
+        db.connectDatabase(self.dbPath)
+        self.session = db.getSession()
+        self.assertTrue(db.attachArchive())
+
+    def testMemoryDatabase(self):
+        db.connectDatabase("", memoryDatabase=True)
+        self.session = db.getSession()
+        self.assertRaises(YokadiException, db.attachArchive)
+# vi: ts=4 sw=4 et
@@ -5,10 +5,15 @@ Project test cases
 @license: GPL v3 or later
 """
 
+import sys
 import unittest
+from io import StringIO
+from unittest.mock import patch
 
-from yokadi.core import db
-from yokadi.core.db import Project, setDefaultConfig
+import testutils
+
+from yokadi.core import db, dbutils
+from yokadi.core.db import Keyword, Project, setDefaultConfig
 from yokadi.ycli import completers
 
 
@@ -28,6 +33,50 @@ class CompletersTestCase(unittest.TestCase):
         result = completer("f", "t_add f", 6, 8)
         self.assertEqual(result, expected)
 
+    def testKeywordCompleter(self):
+        self.session.add_all([Keyword(name="Home"),
+                              Keyword(name="homework"),
+                              Keyword(name="office")])
+        completer = completers.KeywordCompleter(1)
+        self.assertEqual(completer("ho", "k_remove ho", 9, 11), ["Home", "homework"])
+        self.assertEqual(completer("x", "k_remove x", 9, 10), [])
+
+    def testCompletionCacheInvalidation(self):
+        self.session.add(Project(name="foo"))
+        self.session.commit()
+        completer = completers.ProjectCompleter(1)
+        self.assertEqual(completer("f", "t_add f", 6, 8), ["foo "])
+
+        # Cached: no query
+        with testutils.QueryCounter() as counter:
+            self.assertEqual(completer("fo", "t_add fo", 6, 9), ["foo "])
+        self.assertEqual(counter.count, 0)
+
+        # Commits drop the cache
+        self.session.add(Project(name="foo2"))
+        self.session.commit()
+        self.assertEqual(completer("f", "t_add f", 6, 8), ["foo ", "foo2 "])
+
+    def testTaskIdCompleter(self):
+        for idx in range(12):
+            dbutils.addTask("x", "t%d" % (idx + 1), interactive=False)
+        done = dbutils.addTask("y", "done", interactive=False)
+        done.setStatus("done")
+        self.session.commit()
+
+        with patch("sys.stdout", StringIO()) as out:
+            result = completers.taskIdCompleter(None, "1", "t_show 1", 7, 8)
+        self.assertEqual(result, ["1", "10", "11", "12"])
+        self.assertEqual(out.getvalue().splitlines(),
+                         ["", "1: x / t1", "10: x / t10", "11: x / t11", "12: x / t12"])
+
+        with patch("sys.stdout", StringIO()), patch("yokadi.ycli.completers.MAX_LISTED_TASKS", 2):
+            result = completers.taskIdCompleter(None, "", "t_show ", 7, 7)
+            self.assertEqual(len(result), 12)
+            self.assertNotIn(str(done.id), result)
+            self.assertEqual(sys.stdout.getvalue().splitlines(),
+                             ["", "1: x / t1", "2: x / t2", "(10 more tasks)"])
+
     def testCompleteParameterPosition(self):
         data = [
             (("bla", "t_add bla", 6, 10), 1),
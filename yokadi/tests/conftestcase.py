@@ -9,6 +9,8 @@ import unittest
 import sys
 from io import StringIO
 
+from sqlalchemy import text
+
 from yokadi.core import db
 from yokadi.core.db import setDefaultConfig
 from yokadi.core.yokadiexception import YokadiException
@@ -39,6 +41,19 @@ class ConfTestCase(unittest.TestCase):
         self.assertRaises(YokadiException, self.cmd.do_c_set, "ALARM_SUSPEND -1")
         self.assertRaises(YokadiException, self.cmd.do_c_set, "PURGE_DELAY -1")
 
+    def testPragmaConfig(self):
+        def getPragma(name):
+            return self.session.execute(text("pragma %s" % name)).scalar()
+
+        self.assertEqual(getPragma("temp_store"), 2)  # MEMORY
+        self.cmd.do_c_set("SQLITE_TEMP_STORE FILE")
+        self.assertEqual(getPragma("temp_store"), 1)
+
+        self.assertRaises(YokadiException, self.cmd.do_c_set, "SQLITE_TEMP_STORE BAD_VALUE")
+        self.assertRaises(YokadiException, self.cmd.do_c_set, "SQLITE_SYNCHRONOUS 1; drop table task")
+        self.assertRaises(YokadiException, self.cmd.do_c_set, "SQLITE_MMAP_SIZE -1")
+        self.cmd.do_c_set("SQLITE_CACHE_SIZE -2000")
+
     def testWrongKey(self):
         self.assertRaises(YokadiException, self.cmd.do_c_set, "BAD_KEY value")
         self.assertRaises(YokadiException, self.cmd.do_c_get, "BAD_KEY")
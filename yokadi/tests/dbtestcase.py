@@ -3,9 +3,17 @@
 @license: GPL v3 or later
 """
 
+import os
 import unittest
+from io import StringIO
+from unittest.mock import patch
 
-from yokadi.core import db
+from sqlalchemy import text
+
+from yokadi.core import db, dbutils
+from yokadi.core.db import Keyword, Project
+from yokadi.tests.testutils import QueryCounter
+from yokadi.tests.yokaditestcase import YokadiTestCase
 
 
 class DbTestCase(unittest.TestCase):
@@ -18,3 +26,92 @@ class DbTestCase(unittest.TestCase):
         db._database.setVersion(newVersion)
         version = db._database.getVersion()
         self.assertEqual(version, newVersion)
+
+    def testNameIdCache(self):
+        keyword = Keyword(name="k1")
+        project = Project(name="p1")
+        self.session.add_all([keyword, project])
+        self.session.commit()
+
+        self.assertEqual(db.getIdFromName(Keyword, "k1"), keyword.id)
+        self.assertEqual(db.getIdFromName(Project, "p1"), project.id)
+        self.assertIsNone(db.getIdFromName(Keyword, "p1"))
+        with QueryCounter() as counter:
+            self.assertEqual(db.getIdFromName(Keyword, "k1"), keyword.id)
+            self.assertIs(db.getFromName(Project, "p1"), project)
+        self.assertEqual(counter.count, 0)
+
+        # Rename
+        keyword.name = "k2"
+        self.session.commit()
+        self.assertIsNone(db.getIdFromName(Keyword, "k1"))
+        self.assertEqual(db.getIdFromName(Keyword, "k2"), keyword.id)
+
+        # Rollback
+        self.session.add(Project(name="p2"))
+        self.assertIsNotNone(db.getIdFromName(Project, "p2"))
+        self.session.rollback()
+        self.assertIsNone(db.getIdFromName(Project, "p2"))
+
+        # Delete
+        self.session.delete(project)
+        self.session.commit()
+        self.assertIsNone(db.getIdFromName(Project, "p1"))
+
+    def testTaskUpdateDate(self):
+        task = dbutils.addTask("p1", "t1", interactive=False)
+        dbutils.createMissingKeywords(["k1"], interactive=False)
+        self.session.commit()
+        self.assertIsNotNone(task.updateDate)
+
+        def checkUpdated(func):
+            oldDate = task.updateDate
+            func()
+            self.session.commit()
+            self.assertGreater(task.updateDate, oldDate)
+
+        def rename():
+            self.session.query(Keyword).filter_by(name="k1").one().name = "k2"
+
+        checkUpdated(lambda: setattr(task, "title", "t2"))
+        checkUpdated(lambda: task.setKeywordDict({"k1": 1}))
+        checkUpdated(rename)
+        checkUpdated(lambda: task.setKeywordDict({}))
+
+        # Unrelated changes do not update the date
+        oldDate = task.updateDate
+        task.project.name = "p2"
+        self.session.commit()
+        self.assertEqual(task.updateDate, oldDate)
+
+
+class DbFileTestCase(YokadiTestCase):
+    def testDefaultPragmas(self):
+        db.connectDatabase(os.path.join(self.testHomeDir, "yokadi.db"))
+        session = db.getSession()
+        self.assertEqual(session.execute(text("pragma journal_mode")).scalar(), "wal")
+        self.assertEqual(session.execute(text("pragma synchronous")).scalar(), 1)  # NORMAL
+        self.assertEqual(session.execute(text("pragma busy_timeout")).scalar(), 5000)
+        session.close()
+        db._database.engine.dispose()
+
+    def testInvalidPragmaValue(self):
+        dbPath = os.path.join(self.testHomeDir, "yokadi.db")
+        db.connectDatabase(dbPath)
+        db.setDefaultConfig()
+        session = db.getSession()
+        self.assertEqual(db.getPragmaWarnings(), [])
+        session.query(db.Config).filter_by(name="SQLITE_SYNCHRONOUS").one().value = "SOMETIMES"
+        session.commit()
+        session.close()
+        db._database.engine.dispose()
+
+        with patch("sys.stdout", StringIO()) as out:
+            db.connectDatabase(dbPath)
+        session = db.getSession()
+        self.assertEqual(db.getPragmaWarnings(), ["Ignoring invalid value 'SOMETIMES' for SQLITE_SYNCHRONOUS"])
+        self.assertEqual(out.getvalue(), "")
+        # The default value is used
+        self.assertEqual(session.execute(text("pragma synchronous")).scalar(), 1)  # NORMAL
+        session.close()
+        db._database.engine.dispose()
@@ -11,7 +11,7 @@ from datetime import datetime
 
 from yokadi.core import dbutils, db
 from yokadi.ycli import tui
-from yokadi.core.db import Keyword, Project
+from yokadi.core.db import Keyword, Project, Task, TaskKeyword
 from yokadi.core.yokadiexception import YokadiException
 
 
@@ -61,6 +61,82 @@ class DbUtilsTestCase(unittest.TestCase):
         self.assertRaises(YokadiException, dbutils.getKeywordFromName, "foo")
         self.assertEqual(k1, dbutils.getKeywordFromName("k1"))
 
+    def testAddTasks(self):
+        dbutils.addTask("p1", "existing", {"k1": None}, interactive=False)
+        entries = [
+            dict(project="p1", title="t1", keywords={"k1": 3, "k2": None}),
+            dict(project="p2", title="t2", urgency=5, status="done"),
+            dict(project="p1", title="t3", dueDate=datetime(2024, 1, 1), description="desc"),
+        ]
+
+        count = dbutils.addTasks(entries, chunkSize=2)
+        self.assertEqual(count, 3)
+
+        t1, t2, t3 = [self.session.query(Task).filter_by(title=x).one() for x in ("t1", "t2", "t3")]
+        self.assertEqual(t1.project.name, "p1")
+        self.assertEqual(t1.getKeywordDict(), {"k1": 3, "k2": None})
+        self.assertEqual(t2.project.name, "p2")
+        self.assertEqual(t2.urgency, 5)
+        self.assertEqual(t2.status, "done")
+        self.assertTrue(t2.doneDate)
+        self.assertEqual(t3.dueDate, datetime(2024, 1, 1))
+        self.assertEqual(t3.description, "desc")
+        self.assertEqual(t3.status, "new")
+        self.assertTrue(t3.uuid)
+        self.assertEqual(self.session.query(Keyword).filter_by(name="k1").count(), 1)
+
+    def testAddTasksInvalidNames(self):
+        for entry in [
+                dict(project="two words", title="t1"),
+                dict(project="", title="t1"),
+                dict(project="p1", title="t1", keywords={"k\t1": None}),
+                ]:
+            with self.subTest(entry=entry):
+                self.assertRaises(YokadiException, dbutils.addTasks, [entry])
+                self.session.rollback()
+        self.assertEqual(self.session.query(Project).count(), 0)
+
+    def testIterTaskRows(self):
+        t1 = dbutils.addTask("p1", "t1", {"k1": 3, "_k2": None}, interactive=False)
+        t1.description = "desc"
+        t1.dueDate = datetime(2024, 1, 1)
+        t2 = dbutils.addTask("p2", "t2", interactive=False)
+        t2.setStatus("done")
+        self.session.flush()
+
+        rows = list(dbutils.iterTaskRows([], [Task.id]))
+        self.assertEqual([x.id for x in rows], [t1.id, t2.id])
+        for row, task in zip(rows, (t1, t2)):
+            for field in ("title", "description", "urgency", "status", "creationDate", "dueDate", "doneDate"):
+                self.assertEqual(getattr(row, field), getattr(task, field))
+            self.assertEqual(row.project, task.project.name)
+            self.assertEqual(row.getKeywordDict(), task.getKeywordDict())
+            self.assertEqual(row.getKeywordsAsString(), task.getKeywordsAsString())
+            self.assertEqual(row.getUserKeywordsNameAsString(), task.getUserKeywordsNameAsString())
+
+        rows = dbutils.iterTaskRows([dbutils.KeywordFilter("k1")], [Task.id])
+        self.assertEqual([x.id for x in rows], [t1.id])
+
+        groups = [t2.project, t1.project]
+        result = [(group, [x.id for x in rows])
+                  for group, rows in dbutils.iterTaskGroups(Task.projectId, groups, [], [Task.id], asRows=True)]
+        self.assertEqual(result, [(t2.project, [t2.id]), (t1.project, [t1.id])])
+
+    def testDeleteTasks(self):
+        tasks = [dbutils.addTask("x", "t%d" % x, {"k1": x}, interactive=False) for x in range(5)]
+        for task in tasks[:3]:
+            task.setStatus("done")
+        self.session.commit()
+        keptIds = [x.id for x in tasks[3:]]
+
+        progress = []
+        count = dbutils.deleteTasks([Task.status == "done"], chunkSize=2, onProgress=progress.append)
+        self.session.commit()
+        self.assertEqual(count, 3)
+        self.assertEqual(progress, [2, 3])
+        self.assertEqual([x.id for x in self.session.query(Task).order_by(Task.id)], keptIds)
+        self.assertEqual(sorted(x.taskId for x in self.session.query(TaskKeyword)), keptIds)
+
     def testTaskLockManagerStaleLock(self):
         tui.addInputAnswers("y")
         t1 = dbutils.addTask("x", "t1", {})
@@ -6,8 +6,14 @@ Ical features test cases
 """
 
 
+import http.server
+import os
 import unittest
+import urllib.error
+import urllib.request
 from datetime import datetime, timedelta
+from threading import Thread
+from unittest.mock import patch
 
 import icalendar
 
@@ -16,6 +22,7 @@ from yokadi.ycli.projectcmd import getProjectFromName
 from yokadi.yical import yical
 from yokadi.core import dbutils
 from yokadi.core import db
+from yokadi.tests.yokaditestcase import YokadiTestCase
 
 
 class IcalTestCase(unittest.TestCase):
@@ -152,6 +159,43 @@ class IcalTestCase(unittest.TestCase):
 
         self.assertEqual(summaries, expected)
 
+    def testCalendarGenerator(self):
+        t1 = dbutils.addTask("p1", "t1", interactive=False)
+        t2 = dbutils.addTask("p1", "t2", {"k1": 12}, interactive=False)
+        dbutils.addTask("p2", "t3", interactive=False)
+        self.session.commit()
+
+        generator = yical.CalendarGenerator()
+        self.assertEqual(generator.generate(), yical.generateCal().to_ical())
+
+        createVTodoFromTask = yical.createVTodoFromTask
+        with patch("yokadi.yical.yical.createVTodoFromTask", wraps=createVTodoFromTask) as mock:
+            # Nothing changed
+            generator.generate()
+            self.assertEqual(mock.call_count, 0)
+
+            # Only the modified tasks are serialized again
+            t1.title = "new title"
+            t1.setStatus("started")
+            t2.setKeywordDict({"k1": 13})
+            self.session.commit()
+            data = generator.generate()
+            self.assertEqual(mock.call_count, 2)
+            self.assertEqual(data, yical.generateCal().to_ical())
+
+            # Renaming a keyword modifies its tasks
+            mock.reset_mock()
+            self.session.query(db.Keyword).filter_by(name="k1").one().name = "k2"
+            self.session.commit()
+            data = generator.generate()
+            self.assertEqual(mock.call_count, 1)
+            self.assertIn(b"CATEGORIES:k2=13", data)
+
+            # Done tasks are removed
+            t1.setStatus("done")
+            self.session.commit()
+            self.assertEqual(generator.generate(), yical.generateCal().to_ical())
+
     def testHandlerProcessVTodoModifyTask(self):
         # Create a task
         task = dbutils.addTask("p1", "t1", interactive=False)
@@ -199,3 +243,59 @@ class IcalTestCase(unittest.TestCase):
 
         # And there is only one task
         self.assertEqual(self.session.query(db.Task).count(), 1)
+
+
+class IcalServerTestCase(YokadiTestCase):
+    def setUp(self):
+        YokadiTestCase.setUp(self)
+        db.connectDatabase(os.path.join(self.testHomeDir, "yokadi.db"))
+        self.session = db.getSession()
+        yical.IcalHttpRequestHandler.calendarCache = yical.CalendarCache()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), yical.IcalHttpRequestHandler)
+        self.serverThread = Thread(target=self.server.serve_forever)
+        self.serverThread.start()
+        self.url = "http://127.0.0.1:%d/" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.serverThread.join()
+        self.session.close()
+        db._database.engine.dispose()
+        YokadiTestCase.tearDown(self)
+
+    def get(self, **headers):
+        """@return: (status, headers, body)"""
+        request = urllib.request.Request(self.url, headers=headers)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as exc:
+            return exc.code, exc.headers, b""
+
+    def testConditionalGet(self):
+        dbutils.addTask("p1", "t1", interactive=False)
+        self.session.commit()
+
+        generate = yical.CalendarGenerator.generate
+        with patch.object(yical.CalendarGenerator, "generate", autospec=True, side_effect=generate) as generateCal:
+            status, headers, body = self.get()
+            self.assertEqual(status, 200)
+            self.assertIn(b"SUMMARY:t1", body)
+            etag = headers["ETag"]
+            lastModified = headers["Last-Modified"]
+
+            # Unchanged calendar: the cached data is used
+            self.assertEqual(self.get(**{"If-None-Match": etag})[0], 304)
+            self.assertEqual(self.get(**{"If-Modified-Since": lastModified})[0], 304)
+            self.assertEqual(self.get()[2], body)
+            self.assertEqual(generateCal.call_count, 1)
+
+            # The calendar changes with the database
+            dbutils.addTask("p1", "t2", interactive=False)
+            self.session.commit()
+            status, headers, body = self.get(**{"If-None-Match": etag})
+            self.assertEqual(status, 200)
+            self.assertIn(b"SUMMARY:t2", body)
+            self.assertNotEqual(headers["ETag"], etag)
+            self.assertEqual(generateCal.call_count, 2)
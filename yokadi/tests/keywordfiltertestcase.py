@@ -35,3 +35,25 @@ class KeywordFilterTestCase(unittest.TestCase):
             resultSet = {x.title for x in query}
             expectedSet = {x.title for x in expected}
             self.assertEqual(resultSet, expectedSet)
+
+    def testCombinedFilters(self):
+        t1 = dbutils.addTask("p1", "t1", keywordDict={"k1": 1, "k2": None, "k3": None}, interactive=False)
+        t2 = dbutils.addTask("p1", "t2", keywordDict={"k1": 2, "k2": None}, interactive=False)
+        t3 = dbutils.addTask("p1", "t3", keywordDict={"k1": 1}, interactive=False)
+
+        testData = [
+            ([KeywordFilter("k%"), KeywordFilter("k1")], {t1, t2, t3}),
+            ([KeywordFilter("k1"), KeywordFilter("k2")], {t1, t2}),
+            ([KeywordFilter("k1", value=1, valueOperator="=")], {t1, t3}),
+            ([KeywordFilter("k1", value=1, valueOperator="!=")], {t2}),
+            ([KeywordFilter("k1", value=1, valueOperator="="), KeywordFilter("k2")], {t1}),
+            ([KeywordFilter("k2"), KeywordFilter("k3", negative=True)], {t2}),
+            ([KeywordFilter("k%"), dbutils.DbFilter(db.Task.title != "t1")], {t2, t3}),
+        ]
+
+        for filters, expected in testData:
+            with self.subTest(filters=filters):
+                query = self.session.query(db.Task).filter(*dbutils.getFilterConditions(filters))
+                # Filters must not multiply rows
+                titles = [x.title for x in query]
+                self.assertEqual(sorted(titles), sorted(x.title for x in expected))
@@ -70,6 +70,32 @@ class KeywordTestCase(unittest.TestCase):
         taskKeyword = self.session.query(db.TaskKeyword).filter_by(taskId=t1.id).one()
         self.assertEqual(taskKeyword.keyword.name, "k2")
 
+    def testKRemoveNoteKeyword(self):
+        t1 = dbutils.addTask("x", "t1", {db.NOTE_KEYWORD: None}, interactive=False)
+        self.assertTrue(t1.isNote(self.session))
+        tui.addInputAnswers("y")
+        self.cmd.do_k_remove(db.NOTE_KEYWORD)
+        self.assertFalse(t1.isNote(self.session))
+        self.session.expire_all()
+        self.assertEqual(self.session.query(db.Task).filter_by(noteFlag=True).count(), 0)
+
+    def testKEditToNoteKeyword(self):
+        t1 = dbutils.addTask("x", "t1", dict(k1=None), interactive=False)
+        t2 = dbutils.addTask("x", "t2", dict(k2=None), interactive=False)
+        self.assertFalse(t1.isNote(self.session))
+        tui.addInputAnswers(db.NOTE_KEYWORD)
+        self.cmd.do_k_edit("k1")
+        self.assertEqual(t1.getKeywordDict(), {db.NOTE_KEYWORD: None})
+        self.assertTrue(t1.isNote(self.session))
+        self.assertFalse(t2.isNote(self.session))
+
+        # And back
+        tui.addInputAnswers("k1")
+        self.cmd.do_k_edit(db.NOTE_KEYWORD)
+        self.assertFalse(t1.isNote(self.session))
+        self.session.expire_all()
+        self.assertEqual(self.session.query(db.Task).filter_by(noteFlag=True).count(), 0)
+
     def testKRemove_unused(self):
         self.cmd.do_k_add("kw")
         self.session.query(db.Keyword).filter_by(name="kw").one()
@@ -6,6 +6,9 @@ Mass edit test cases
 """
 
 import unittest
+from datetime import datetime
+
+import testutils
 
 from yokadi.core import db
 from yokadi.core.db import NOTE_KEYWORD
@@ -61,6 +64,35 @@ class MassEditTestCase(unittest.TestCase):
         self.assertEqual(t5.urgency, 2)
         self.assertEqual(t3.urgency, 1)
 
+    def testApplyMEditChangesInBulk(self):
+        prj = dbutils.getOrCreateProject("p1", interactive=False)
+        dbutils.createMissingKeywords(["k1", "k2"], interactive=False)
+        for idx in range(50):
+            task = dbutils.addTask("p1", "t%d" % idx, {"k1": idx, "k2": None})
+            # Urgencies match the positions of the tasks in the list
+            task.urgency = 50 - idx
+        self.session.commit()
+        oldDate = datetime(2020, 1, 1)
+        self.session.query(db.Task).update({db.Task.updateDate: oldDate})
+        self.session.commit()
+
+        oldList = massedit.createEntriesForProject(prj)
+        # Keep the first task as is, change the keywords of the others
+        newList = oldList[:1] + [x._replace(keywords={"k1": 0, "k3": None}) for x in oldList[1:]]
+
+        with testutils.QueryCounter() as counter:
+            massedit.applyChanges(prj, oldList, newList, interactive=False)
+            self.session.commit()
+        # Does not depend on the number of tasks
+        self.assertLess(counter.count, 15)
+
+        tasks = [dbutils.getTaskFromId(x.id) for x in newList]
+        self.assertEqual(tasks[0].getKeywordDict(), {"k1": 0, "k2": None})
+        self.assertEqual(tasks[0].updateDate, oldDate)
+        for task in tasks[1:]:
+            self.assertEqual(task.getKeywordDict(), {"k1": 0, "k3": None})
+            self.assertGreater(task.updateDate, oldDate)
+
     def testApplyMEditChangesUnknownIds(self):
         prj = dbutils.getOrCreateProject("p1", interactive=False)
         t1 = dbutils.addTask("p1", "Foo", {})
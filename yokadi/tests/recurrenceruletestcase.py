@@ -1,10 +1,12 @@
 import unittest
 
 from collections import namedtuple
-from datetime import datetime
+from datetime import datetime, timedelta
+from itertools import islice
 
 from dateutil import rrule
 
+from yokadi.core import recurrencerule
 from yokadi.core.recurrencerule import RecurrenceRule
 from yokadi.core.yokadiexception import YokadiException
 
@@ -126,3 +128,72 @@ class RecurrenceRuleTestCase(unittest.TestCase):
             with self.subTest(text=row.text):
                 nextDate = row.rule.getNext(REF_DATE)
                 self.assertEqual(nextDate, row.nextDate)
+
+    def testInterning(self):
+        for row in TEST_DATA:
+            with self.subTest(text=row.text):
+                rule = RecurrenceRule.fromDict(row.dct)
+                self.assertIs(RecurrenceRule.fromDict(rule.toDict()), rule)
+                self.assertIs(RecurrenceRule.fromJson(rule.toJson()), rule)
+                self.assertIs(RecurrenceRule.fromHumaneString(row.text), rule)
+                self.assertEqual(hash(rule), hash(row.rule))
+
+    def testCompiledRuleIsCached(self):
+        rule = RecurrenceRule.fromHumaneString("weekly monday 10:00")
+        compiledRule = rule._rrule()
+        self.assertIs(rule._rrule(), compiledRule)
+        self.assertEqual(rule.getNext(REF_DATE), REF_DATE.replace(day=24, hour=10, minute=0))
+        self.assertIs(rule._rrule(), compiledRule)
+
+    def testOldCompiledRuleIsRecreated(self):
+        rule = RecurrenceRule.fromHumaneString("daily 10:00")
+        compiledRule = rule._rrule()
+        # Pretend the rrule has been created a long time ago, in a long
+        # running process
+        rule._compiledRule = (compiledRule, datetime.now() - timedelta(days=2))
+        self.assertIsNot(rule._rrule(), compiledRule)
+        self.assertGreater(rule.getNext(), datetime.now())
+
+    def testInterningIsBounded(self):
+        # Rules remembered by fromJson() may no longer be the interned ones
+        self.addCleanup(RecurrenceRule.fromJson.cache_clear)
+        for minute in range(60):
+            for hour in range(24):
+                RecurrenceRule.intern(RecurrenceRule(rrule.DAILY, byhour=hour, byminute=minute))
+        self.assertLessEqual(recurrencerule._internRule.cache_info().currsize, recurrencerule.INTERN_CACHE_SIZE)
+
+    def testIterNext(self):
+        rules = [row.rule for row in TEST_DATA if row.rule] + [
+            RecurrenceRule(rrule.WEEKLY, byweekday=(1, 5), byhour=23, byminute=59),
+            RecurrenceRule(rrule.MONTHLY, bymonthday=31, byhour=0),
+        ]
+        start = datetime.now().replace(second=0, microsecond=0) + timedelta(days=1)
+        for rule in rules:
+            for refDate in (start, None, datetime(2000, 1, 1)):
+                with self.subTest(rule=rule, refDate=refDate):
+                    expected = []
+                    nextDate = refDate
+                    for _ in range(20):
+                        nextDate = rule.getNext(nextDate)
+                        expected.append(nextDate)
+                    self.assertEqual(list(islice(rule.iterNext(refDate), 20)), expected)
+        self.assertEqual(list(RecurrenceRule().iterNext()), [])
+
+    def testGetNextBatch(self):
+        rules = [row.rule for row in TEST_DATA] + [
+            RecurrenceRule(rrule.WEEKLY, byweekday=(1, 5), byhour=23, byminute=59),
+            RecurrenceRule(rrule.MONTHLY, bymonthday=31, byhour=0),
+        ]
+        # Do not use REF_DATE here: getNext() is too slow for far away dates
+        start = datetime.now().replace(second=0, microsecond=0) + timedelta(days=1)
+        refDates = [start + timedelta(days=x, hours=x * 5, minutes=x * 7) for x in range(0, 400, 7)]
+        # Dates in the past and None must behave like getNext()
+        refDates += [None, datetime(2000, 1, 1)]
+
+        batchRules = [x for x in rules for _ in refDates]
+        batchRefDates = refDates * len(rules)
+        nextDates = RecurrenceRule.getNextBatch(batchRules, batchRefDates)
+
+        for rule, refDate, nextDate in zip(batchRules, batchRefDates, nextDates):
+            with self.subTest(rule=rule, refDate=refDate):
+                self.assertEqual(nextDate, rule.getNext(refDate))
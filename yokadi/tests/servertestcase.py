@@ -0,0 +1,127 @@
+# -*- coding: UTF-8 -*-
+"""
+Yokadi server test cases
+@author: Aurélien Gâteau <mail@agateau.com>
+@license: GPL v3 or later
+"""
+import os
+import sys
+from io import StringIO
+from threading import Event, Thread
+from unittest.mock import patch
+
+from yokadi.core import basepaths, db, dbutils
+from yokadi.core.db import Project, Task, setDefaultConfig
+from yokadi.tests.yokaditestcase import YokadiTestCase
+from yokadi.ycli import client, tui
+from yokadi.ycli.main import YokadiCmd
+from yokadi.ycli.server import YokadiServer
+
+
+class ServerTestCase(YokadiTestCase):
+    def setUp(self):
+        YokadiTestCase.setUp(self)
+        os.environ["XDG_RUNTIME_DIR"] = os.path.join(self.testHomeDir, "run")
+        os.mkdir(os.environ["XDG_RUNTIME_DIR"])
+        self.dbPath = basepaths.getDbPath(basepaths.getDataDir())
+        os.makedirs(os.path.dirname(self.dbPath))
+        db.connectDatabase(self.dbPath)
+        setDefaultConfig()
+        db.getSession().commit()
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.shutdown()
+            self.serverThread.join()
+            self.server.server_close()
+        db.getSession().close()
+        db._database.engine.dispose()
+        tui.setInteractive(sys.stdin.isatty())
+        YokadiTestCase.tearDown(self)
+
+    def startServer(self):
+        ready = Event()
+
+        def run():
+            # The command must use the session of the server thread
+            self.server = YokadiServer(basepaths.getServerSocketPath(), YokadiCmd(), self.dbPath)
+            ready.set()
+            self.server.serve_forever()
+            db.getSession().close()
+
+        self.serverThread = Thread(target=run)
+        self.serverThread.start()
+        ready.wait()
+
+    def forwardCommand(self, *argv):
+        out = StringIO()
+        returnCode = client.forwardCommand(list(argv), stdout=out, stderr=out)
+        return returnCode, out.getvalue()
+
+    def testGetCommandArgs(self):
+        for argv, expected in [
+                ([], None),
+                (["t_list"], ["t_list"]),
+                (["t_add", "x", "t1"], ["t_add", "x", "t1"]),
+                (["--datadir", "foo", "t_list"], None),
+                (["t_list", "-a"], None),
+                (["--", "t_list", "-a"], ["t_list", "-a"]),
+                ]:
+            with self.subTest(argv=argv):
+                self.assertEqual(client.getCommandArgs(argv), expected)
+
+    def testForwardCommand(self):
+        # No server
+        self.assertEqual(self.forwardCommand("t_list"), (None, ""))
+
+        self.startServer()
+        returnCode, output = self.forwardCommand("t_add", "x", "t1")
+        self.assertEqual(returnCode, 0)
+        self.assertEqual(output, "t_add x t1\nAdded project 'x'\nAdded task 't1' (id=1)\n")
+
+        returnCode, output = self.forwardCommand("--", "t_list", "-a")
+        self.assertEqual(returnCode, 0)
+        self.assertTrue(output.startswith("t_list -a\n"))
+        self.assertIn("t1", output)
+
+        # Changes done outside of the server are visible
+        session = db.getSession()
+        session.query(Task).one().title = "renamed"
+        session.commit()
+        returnCode, output = self.forwardCommand("t_list")
+        self.assertIn("renamed", output)
+
+        # Errors are reported by the server
+        returnCode, output = self.forwardCommand("t_show", "12")
+        self.assertEqual(returnCode, 0)
+        self.assertIn("Task 12 does not exist", output)
+
+    def testInputRequired(self):
+        self.startServer()
+        with patch("sys.stdin") as stdinMock:
+            stdinMock.isatty.return_value = True
+            # Creating the project requires a confirmation: the command must
+            # run in the client
+            self.assertEqual(self.forwardCommand("t_add", "x", "t1"), (None, ""))
+        session = db.getSession()
+        self.assertEqual(session.query(Project).count(), 0)
+        self.assertEqual(session.query(Task).count(), 0)
+
+    def testInputRequiredAfterOutput(self):
+        task = dbutils.addTask("x", "old", interactive=False)
+        task.setStatus("done")
+        db.getSession().commit()
+        self.startServer()
+        with patch("sys.stdin") as stdinMock:
+            stdinMock.isatty.return_value = True
+            # t_purge lists the tasks, then asks for a confirmation: the
+            # output must be dropped and the command must run in the client
+            self.assertEqual(self.forwardCommand("--", "t_purge", "-d", "0"), (None, ""))
+        self.assertEqual(db.getSession().query(Task).count(), 1)
+
+    def testOtherDatabase(self):
+        self.startServer()
+        os.environ["XDG_DATA_HOME"] = os.path.join(self.testHomeDir, "other")
+        self.assertEqual(self.forwardCommand("t_list"), (None, ""))
+# vi: ts=4 sw=4 et
@@ -0,0 +1,55 @@
+# -*- coding: UTF-8 -*-
+"""
+Startup test cases
+@author: Aurélien Gâteau <mail@agateau.com>
+@license: GPL v3 or later
+"""
+import os
+import re
+import subprocess
+import sys
+from io import StringIO
+from unittest.mock import patch
+
+from yokadi.core import db
+from yokadi.tests.yokaditestcase import YokadiTestCase
+from yokadi.ycli import main
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+
+# Modules which must not be imported by a one-shot t_list. See also
+# scripts/benchstartup
+DEFERRED_MODULES = (
+    "colorama",
+    "icalendar",
+    "readline",
+    "xml.dom.minidom",
+    "yokadi.update.update",
+    "yokadi.ycli.csvlistrenderer",
+    "yokadi.ycli.htmllistrenderer",
+    "yokadi.ycli.massedit",
+    "yokadi.ycli.server",
+    "yokadi.ycli.taskimport",
+    "yokadi.ycli.xmllistrenderer",
+)
+
+
+class StartupTestCase(YokadiTestCase):
+    def testDeferredImports(self):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = ROOT_DIR
+        env["XDG_RUNTIME_DIR"] = os.path.join(self.testHomeDir, "run")
+        proc = subprocess.run([sys.executable, "-X", "importtime", os.path.join(ROOT_DIR, "bin", "yokadi"), "t_list"],
+                              env=env, stdin=subprocess.DEVNULL, capture_output=True, text=True, check=True)
+        modules = set(re.findall(r"^import time:.*\| *(\S+)$", proc.stderr, re.MULTILINE))
+        self.assertIn("yokadi.ycli.main", modules)
+        self.assertEqual(modules.intersection(DEFERRED_MODULES), set())
+
+    def testOneShotKeyboardInterrupt(self):
+        with patch("sys.argv", ["yokadi", "t_list"]), patch("sys.stdout", StringIO()) as out, \
+                patch.object(main.YokadiCmd, "onecmd", side_effect=KeyboardInterrupt):
+            self.assertEqual(main.main(), 1)
+        db.getSession().close()
+        db._database.engine.dispose()
+        self.assertIn("Break !", out.getvalue())
+# vi: ts=4 sw=4 et
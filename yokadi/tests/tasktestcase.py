@@ -5,16 +5,24 @@ Task test cases
 @author: Sébastien Renard <sebastien.renard@digitalfox.org>
 @license: GPL v3 or later
 """
+import os
 import unittest
+from datetime import datetime, timedelta
+from io import StringIO
+from tempfile import TemporaryDirectory
 from unittest.mock import patch
 
+from sqlalchemy import desc
+
 import testutils
 
 from yokadi.ycli import tui
 from yokadi.ycli.main import YokadiCmd
+from yokadi.ycli.textlistrenderer import TextListRenderer
 from yokadi.core import db
 from yokadi.core import dbutils
-from yokadi.core.db import Task, TaskLock, Keyword, setDefaultConfig, Project, TaskKeyword
+from yokadi.core.db import NOTE_KEYWORD, Task, TaskLock, Keyword, setDefaultConfig, Project, TaskKeyword
+from yokadi.core.recurrencerule import RecurrenceRule
 from yokadi.core.yokadiexception import YokadiException, BadUsageException
 
 
@@ -246,6 +254,144 @@ class TaskTestCase(unittest.TestCase):
 
         self.assertEqual(list(renderer.taskDict.keys()), sorted(keywordNames, key=lambda x: x.lower()))
 
+    def testRenderListLimit(self):
+        # Given two projects with three tasks each
+        for projectName in "x", "y":
+            for urgency in range(3):
+                dbutils.addTask(projectName, "%s%d" % (projectName, urgency), interactive=False).urgency = urgency
+        self.session.flush()
+        projectList = self.session.query(Project).all()
+
+        # When I render the list with a limit
+        renderer = testutils.TestRenderer()
+        self.cmd._renderList(renderer, projectList, filters=[], order=[desc(Task.urgency)], limit=2)
+
+        # Then the limit is applied to each project
+        result = {k: [x.title for x in v] for k, v in renderer.taskDict.items()}
+        self.assertEqual(result, {"x": ["x2", "x1"], "y": ["y2", "y1"]})
+
+    def testSearch(self):
+        t1 = dbutils.addTask("x", "Fix the scheduler", interactive=False)
+        t2 = dbutils.addTask("x", "Plan meeting", keywordDict={"schedule": None}, interactive=False)
+        t3 = dbutils.addTask("y", "Other", interactive=False)
+        t3.description = "The scheduler is broken"
+        t4 = dbutils.addTask("y", "Schedule release", interactive=False)
+        t4.setStatus("done")
+        self.session.commit()
+
+        renderer = testutils.TestRenderer()
+        self.cmd.do_t_list("-s sched", renderer=renderer)
+        self.assertEqual(sorted(x.id for x in renderer.tasks), [t1.id, t2.id, t3.id])
+
+        renderer = testutils.TestRenderer()
+        self.cmd.do_t_list("-s sched -s fix", renderer=renderer)
+        self.assertEqual([x.id for x in renderer.tasks], [t1.id])
+
+        with patch("yokadi.ycli.tui.stdout", StringIO()) as out:
+            # Title matches come first
+            self.cmd.do_t_search("sched")
+            self.assertEqual(self.cmd.lastTaskIds, [t1.id, t2.id, t3.id])
+            self.assertIn("Fix the scheduler", out.getvalue())
+
+            # Both title matches come first, whatever their order
+            self.cmd.do_t_search("-a -n 2 sched")
+            self.assertEqual(sorted(self.cmd.lastTaskIds), [t1.id, t4.id])
+
+            # Phrases
+            self.cmd.do_t_search('"is broken"')
+            self.assertEqual(self.cmd.lastTaskIds, [t3.id])
+            self.cmd.do_t_search('"broken scheduler"')
+            self.assertEqual(self.cmd.lastTaskIds, [])
+
+    def testTagenda(self):
+        dayStart = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        t1 = dbutils.addTask("x", "t1", interactive=False)
+        t1.dueDate = dayStart + timedelta(days=2, hours=12)
+        t2 = dbutils.addTask("x", "daily", interactive=False)
+        t2.setRecurrenceRule(RecurrenceRule.fromHumaneString("daily 10:00"))
+        t3 = dbutils.addTask("y", "late", interactive=False)
+        t3.dueDate = dayStart - timedelta(days=3)
+        t4 = dbutils.addTask("y", "done", interactive=False)
+        t4.dueDate = dayStart + timedelta(days=1)
+        t4.setStatus("done")
+        t5 = dbutils.addTask("y", "later", interactive=False)
+        t5.dueDate = dayStart + timedelta(days=10)
+        self.session.commit()
+
+        renderer = testutils.TestRenderer()
+        self.cmd.do_t_agenda("-d 4", renderer=renderer)
+        dueDates = [x.dueDate for x in renderer.tasks]
+        self.assertEqual(dueDates, sorted(dueDates))
+        # One occurrence per day of the daily task, starting from its due date
+        expected = [t2.dueDate + timedelta(days=x) for x in range(5)]
+        expected = [x for x in expected if x < dayStart + timedelta(days=4)]
+        self.assertEqual([x.dueDate for x in renderer.tasks if x.id == t2.id], expected)
+        self.assertEqual(renderer.tasks[0].id, t3.id)
+        self.assertEqual(set(x.id for x in renderer.tasks), {t1.id, t2.id, t3.id})
+        self.assertEqual(self.cmd.lastTaskIds[0], t3.id)
+        self.assertEqual(sorted(self.cmd.lastTaskIds), [t1.id, t2.id, t3.id])
+
+        renderer = testutils.TestRenderer()
+        self.cmd.do_t_agenda("-d 4 x", renderer=renderer)
+        self.assertEqual(set(x.id for x in renderer.tasks), {t1.id, t2.id})
+
+        with patch("yokadi.ycli.tui.stdout", StringIO()) as out:
+            self.cmd.do_t_agenda("--days 30")
+            output = out.getvalue()
+        for text in ("Overdue", "Next week", "Next month", "later"):
+            self.assertIn(text, output)
+
+        self.assertRaises(BadUsageException, self.cmd.do_t_agenda, "-d 0")
+        # Past the max date, and past the max timedelta
+        self.assertRaises(BadUsageException, self.cmd.do_t_agenda, "-d 10000000")
+        self.assertRaises(BadUsageException, self.cmd.do_t_agenda, "-d 1000000000000")
+
+    def testTpurge(self):
+        oldDate = datetime.now() - timedelta(days=100)
+        t1 = dbutils.addTask("x", "old", {"kw1": 2}, interactive=False)
+        t1.setStatus("done")
+        t1.doneDate = oldDate
+        self.session.add(TaskLock(task=t1, pid=1, updateDate=oldDate))
+        t2 = dbutils.addTask("x", "recent", interactive=False)
+        t2.setStatus("done")
+        t3 = dbutils.addTask("x", "todo", interactive=False)
+        self.session.commit()
+        t1Id = t1.id
+
+        # Dry runs do not remove anything
+        with patch("sys.stdout", StringIO()) as out:
+            self.cmd.do_t_purge("--dry-run")
+        self.assertIn("%d: old" % t1Id, out.getvalue())
+        with patch("sys.stdout", StringIO()) as out:
+            self.cmd.do_t_purge("--dry-run --count")
+        self.assertIn("1 tasks would be removed", out.getvalue())
+        self.assertEqual(self.session.query(Task).count(), 3)
+
+        with patch("sys.stdout", StringIO()) as out:
+            self.cmd.do_t_purge("-f --vacuum")
+        self.assertIn("1 tasks deleted", out.getvalue())
+
+        self.assertEqual(self.session.query(Task).order_by(Task.id).all(), [t2, t3])
+        self.assertEqual(self.session.query(TaskKeyword).filter_by(taskId=t1Id).count(), 0)
+        self.assertEqual(self.session.query(TaskLock).count(), 0)
+        self.assertEqual(dbutils.searchTasks(["old"]).count(), 0)
+
+    def testTlistQueryCount(self):
+        def countListQueries():
+            self.session.commit()
+            self.session.expire_all()
+            renderer = TextListRenderer(StringIO(), termWidth=80)
+            with testutils.QueryCounter() as counter:
+                self.cmd.do_t_list("", renderer=renderer)
+            return counter.count
+
+        dbutils.addTask("x", "t0", keywordDict={"kw1": None, "kw2": 12}, interactive=False)
+        oneTaskCount = countListQueries()
+
+        for x in range(1, 10):
+            dbutils.addTask("x", "t%d" % x, keywordDict={"kw1": None, "kw2": x}, interactive=False)
+        self.assertEqual(countListQueries(), oneTaskCount)
+
     def testTlist(self):
         tui.addInputAnswers("y")
         self.cmd.do_t_add("x t1")
@@ -269,7 +415,7 @@ class TaskTestCase(unittest.TestCase):
         renderer = testutils.TestRenderer()
         self.cmd.do_t_list("-u 0", renderer=renderer)
         # Then the task with a negative urgency is not listed
-        self.assertEqual(renderer.tasks, [t1])
+        self.assertEqual([x.id for x in renderer.tasks], [t1.id])
 
     def testNlist(self):
         tui.addInputAnswers("y")
@@ -331,6 +477,145 @@ class TaskTestCase(unittest.TestCase):
             else:
                 self.assertNotEqual(kwDict, dict(lala=None, toto=None))
 
+    def testTApplyBatch(self):
+        for i in range(5):
+            dbutils.addTask("x", "t%d" % i, interactive=False)
+        dbutils.addTask("y", "t5", interactive=False)
+        self.session.commit()
+
+        # Queries to load the tasks and their keywords, then to update them
+        with testutils.QueryCounter() as counter, patch("yokadi.ycli.tui.stderr", StringIO()) as err:
+            self.cmd.do_t_apply("1-4 9 t_urgency 20")
+        self.assertEqual(counter.count, 3)
+        self.assertIn("do not exist: 9", err.getvalue())
+        self.assertEqual([x.urgency for x in self.session.query(Task).order_by(Task.id)], [20, 20, 20, 20, 0, 0])
+
+        self.cmd.do_t_apply("--chunk 2 1,2,3 t_mark_done")
+        self.assertEqual([x.status for x in self.session.query(Task).order_by(Task.id)],
+                         ["done", "done", "done", "new", "new", "new"])
+
+        self.cmd.do_k_add("k1")
+        self.cmd.do_t_apply("1 2 t_add_keywords @k1=3")
+        self.cmd.do_t_apply("2 3 t_add_keywords @k1=4")
+        self.assertEqual([self.session.get(Task, x).getKeywordDict() for x in (1, 2, 3)],
+                         [dict(k1=3), dict(k1=4), dict(k1=4)])
+
+        tui.addInputAnswers("y")
+        self.cmd.do_t_apply("5-6 t_project z")
+        self.assertEqual([x.project.name for x in self.session.query(Task).order_by(Task.id)],
+                         ["x", "x", "x", "x", "z", "z"])
+
+        self.cmd.do_t_apply("1-2 t_due 23/02/2030 10:00")
+        self.assertEqual(self.session.get(Task, 2).dueDate, datetime(2030, 2, 23, 10, 0))
+
+        # Tasks are listed before asking for confirmation
+        tui.addInputAnswers("n")
+        with patch("sys.stdout", StringIO()) as out:
+            self.cmd.do_t_apply("5,6 t_remove")
+        self.assertIn("5: t4\n6: t5\n", out.getvalue())
+        self.assertEqual(self.session.query(Task).count(), 6)
+
+        # Projects without tasks are removed
+        self.cmd.do_t_apply("5,6 t_remove -f")
+        self.assertEqual(self.session.query(Task).count(), 4)
+        self.assertEqual(self.session.query(Project).filter_by(name="z").count(), 0)
+
+        # Invalid arguments do not change anything
+        self.assertRaises(BadUsageException, self.cmd.do_t_apply, "1 t_urgency high")
+        self.assertRaises(BadUsageException, self.cmd.do_t_apply, "--chunk 0 1 t_urgency 3")
+        self.assertEqual(self.session.get(Task, 1).urgency, 20)
+
+    def testImportCsv(self):
+        # Given tasks exported as CSV
+        t1 = dbutils.addTask("x", "t1", keywordDict={"kw1": None, "kw2": 12}, interactive=False)
+        t1.description = "Some description"
+        t1.urgency = 10
+        dbutils.addTask("y", "t2", interactive=False).setStatus("started")
+        self.session.commit()
+        with TemporaryDirectory() as tempDir:
+            path = os.path.join(tempDir, "tasks.csv")
+            self.cmd.do_t_list("--output %s" % path)
+
+            # When I import them
+            self.cmd.do_t_import(path)
+
+        # Then the tasks are duplicated
+        imported = self.session.query(Task).filter(Task.id > 2).order_by(Task.id).all()
+        self.assertEqual([(x.project.name, x.title, x.status) for x in imported],
+                         [("x", "t1", "new"), ("y", "t2", "started")])
+        self.assertEqual(imported[0].getKeywordDict(), {"kw1": None, "kw2": 12})
+        self.assertEqual(imported[0].description, "Some description")
+        self.assertEqual(imported[0].urgency, 10)
+        self.assertEqual(imported[0].creationDate, t1.creationDate)
+
+    def testImportJson(self):
+        with TemporaryDirectory() as tempDir:
+            path = os.path.join(tempDir, "tasks.json")
+            with open(path, "w") as fp:
+                fp.write('{"title": "t1", "keywords": ["kw1"]}\n')
+                fp.write('{"title": "t2", "project": "y", "dueDate": "2024-01-01 10:00"}\n')
+            self.assertRaises(YokadiException, self.cmd.do_t_import, path)
+            self.cmd.do_t_import("--project x " + path)
+
+            with open(path, "w") as fp:
+                fp.write('{"title": "t3", "project": "y", "status": "bad"}\n')
+            self.assertRaises(YokadiException, self.cmd.do_t_import, path)
+
+        tasks = self.session.query(Task).order_by(Task.id).all()
+        self.assertEqual([(x.project.name, x.title) for x in tasks], [("x", "t1"), ("y", "t2")])
+        self.assertEqual(tasks[0].getKeywordDict(), {"kw1": None})
+        self.assertEqual(tasks[1].dueDate, datetime(2024, 1, 1, 10, 0))
+
+    def testImportInvalidEntries(self):
+        with TemporaryDirectory() as tempDir:
+            path = os.path.join(tempDir, "tasks.json")
+            for line in [
+                    '{"title": "t1", "project": "x", "urgency": [1]}',
+                    '{"title": "t1", "project": "x", "dueDate": 12}',
+                    '{"title": "t1", "project": "two words"}',
+                    '{"title": "t1", "project": 12}',
+                    '{"title": "t1", "project": "x", "keywords": ["k 1"]}',
+                    '{"title": "t1", "project": "x", "keywords": [["k1"]]}',
+                    ]:
+                with self.subTest(line=line):
+                    with open(path, "w") as fp:
+                        fp.write(line + "\n")
+                    with self.assertRaisesRegex(YokadiException, "^Line 1: "):
+                        self.cmd.do_t_import(path)
+        self.assertEqual(self.session.query(Task).count(), 0)
+        self.assertEqual(self.session.query(Project).count(), 0)
+
+    def testImportReportsCreatedItems(self):
+        with TemporaryDirectory() as tempDir:
+            path = os.path.join(tempDir, "tasks.json")
+            with open(path, "w") as fp:
+                fp.write('{"title": "t1", "project": "x", "keywords": ["k1"]}\n')
+            with patch("yokadi.ycli.tui.stderr", StringIO()) as err:
+                self.cmd.do_t_import(path)
+        self.assertIn("Added project 'x'", err.getvalue())
+        self.assertIn("Added keyword 'k1'", err.getvalue())
+
+    def testImportNote(self):
+        with TemporaryDirectory() as tempDir:
+            path = os.path.join(tempDir, "tasks.json")
+            with open(path, "w") as fp:
+                fp.write('{"title": "note", "project": "x", "keywords": ["%s"]}\n' % NOTE_KEYWORD)
+                fp.write('{"title": "task", "project": "x"}\n')
+            self.cmd.do_t_import(path)
+
+        note = self.session.query(Task).filter_by(title="note").one()
+        self.assertTrue(note.noteFlag)
+        self.assertTrue(note.isNote(self.session))
+
+        renderer = testutils.TestRenderer()
+        self.cmd.do_t_list("", renderer=renderer)
+        self.assertEqual([x.title for x in renderer.taskDict["x"]], ["task"])
+
+        with patch("yokadi.ycli.tui.stdout", StringIO()) as out:
+            self.cmd.do_n_list("")
+        self.assertIn("note", out.getvalue())
+        self.assertNotIn("task", out.getvalue())
+
     def testReorderFailsOnInvalidInputs(self):
         self.assertRaises(BadUsageException, self.cmd.do_t_reorder, "unknown_project")
         self.assertRaises(BadUsageException, self.cmd.do_t_reorder, "too much args")
@@ -355,10 +640,13 @@ class TaskTestCase(unittest.TestCase):
         self.cmd.do_t_to_note(1)
         task = self.session.get(Task, 1)
         self.assertTrue(task.isNote(self.session))
+        self.assertEqual(task.getKeywordDict(), {NOTE_KEYWORD: None})
+        self.assertEqual(self.session.query(Task).filter(Task.noteFlag == True).all(), [task])  # noqa
 
     def testToTask(self):
         tui.addInputAnswers("y")
         self.cmd.do_n_add("x t1")
+        self.assertTrue(self.session.get(Task, 1).isNote(self.session))
 
         self.cmd.do_n_to_task(1)
         task = self.session.get(Task, 1)
@@ -368,6 +656,8 @@ class TaskTestCase(unittest.TestCase):
         self.cmd.do_n_to_task(1)
         task = self.session.get(Task, 1)
         self.assertFalse(task.isNote(self.session))
+        self.assertEqual(task.getKeywordDict(), {})
+        self.assertEqual(self.session.query(Task).filter(Task.noteFlag == True).all(), [])  # noqa
 
     @patch("yokadi.ycli.tui.editText")
     def testReorder(self, editTextMock):
@@ -28,10 +28,12 @@ from projecttestcase import ProjectTestCase  # noqa: F401, E402
 from completerstestcase import CompletersTestCase  # noqa: F401, E402
 from tasktestcase import TaskTestCase  # noqa: F401, E402
 from bugtestcase import BugTestCase  # noqa: F401, E402
+from servertestcase import ServerTestCase  # noqa: F401, E402
+from startuptestcase import StartupTestCase  # noqa: F401, E402
 from aliastestcase import AliasTestCase  # noqa: F401, E402
 from textlistrenderertestcase import TextListRendererTestCase  # noqa: F401, E402
 if hasIcalendar:
-    from icaltestcase import IcalTestCase  # noqa: F401, E402
+    from icaltestcase import IcalTestCase, IcalServerTestCase  # noqa: F401, E402
 from keywordtestcase import KeywordTestCase  # noqa: F401, E402
 from tuitestcase import TuiTestCase  # noqa: F401, E402
 from helptestcase import HelpTestCase  # noqa: F401, E402
@@ -41,7 +43,10 @@ from basepathstestcase import BasePathsUnixTestCase, BasePathsWindowsTestCase  #
 from keywordfiltertestcase import KeywordFilterTestCase  # noqa: F401, E402
 from recurrenceruletestcase import RecurrenceRuleTestCase  # noqa: F401, E402
 from argstestcase import ArgsTestCase  # noqa: F401, E402
-from dbtestcase import DbTestCase  # noqa: F401, E402
+from dbtestcase import DbTestCase, DbFileTestCase  # noqa: F401, E402
+from alarmschedulertestcase import AlarmSchedulerTestCase, AlarmRunnerTestCase  # noqa: F401, E402
+from alarmschedulertestcase import DatabaseWatcherTestCase  # noqa: F401, E402
+from archivetestcase import ArchiveTestCase  # noqa: F401, E402
 
 
 def main():
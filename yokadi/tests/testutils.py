@@ -8,6 +8,10 @@ from collections import OrderedDict
 
 import os
 
+from sqlalchemy import event
+
+from yokadi.core import db
+
 
 def multiLinesAssertEqual(test, str1, str2):
     lst1 = str1.splitlines()
@@ -41,6 +45,27 @@ class TestRenderer(object):
         pass
 
 
+class QueryCounter(object):
+    """
+    A context manager which counts the SQL statements executed on the current
+    database while it is active. The result is stored in `count`.
+    """
+    def __init__(self):
+        self.count = 0
+        self.engine = db._database.engine
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._onExecute)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        event.remove(self.engine, "before_cursor_execute", self._onExecute)
+        return False
+
+    def _onExecute(self, *args):
+        self.count += 1
+
+
 class EnvironSaver(object):
     """
     This class saves and restore the environment.
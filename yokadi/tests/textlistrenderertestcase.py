@@ -82,5 +82,35 @@ class TextListRendererTestCase(unittest.TestCase):
             "3 │A longer task name*│0  │N│0m      │        \n"
         self.assertMultiLineEqual(out, expected)
 
+    def testStreamRendering(self):
+        dbutils.getOrCreateKeyword("k1", interactive=False)
+        dbutils.getOrCreateKeyword("_k2", interactive=False)
+        dbutils.addTask("x", "t1", {}, interactive=False)
+        dbutils.addTask("x", "t2", {"k1": None, "_k2": 12}, interactive=False)
+        longTask = dbutils.addTask("y", "A longer task name", {}, interactive=False)
+        longTask.description = "And it has a description"
+        self.session.commit()
+        projects = self.session.query(db.Project).order_by(db.Project.name).all()
+        order = [db.Task.id]
+
+        bufferedOut = StringIO()
+        renderer = TextListRenderer(bufferedOut, termWidth=80)
+        for project, taskList in dbutils.iterTaskGroups(db.Task.projectId, projects, [], order):
+            renderer.addTaskList(project.name, taskList)
+        renderer.end()
+
+        streamedOut = StringIO()
+        renderer = TextListRenderer(streamedOut, termWidth=80, stream=True)
+        maxWidths = dbutils.getTaskGroupsMaxWidths(db.Task.projectId, projects, [], order)
+        self.assertEqual(maxWidths, (len(longTask.title) + 1, longTask.id))
+        renderer.setMaxWidths(*maxWidths)
+        for project, taskList in dbutils.iterTaskGroups(db.Task.projectId, projects, [], order, lazy=True):
+            renderer.addTaskList(project.name, taskList)
+            # Tasks have been printed already
+            self.assertIn(project.name, streamedOut.getvalue())
+        renderer.end()
+
+        self.assertMultiLineEqual(streamedOut.getvalue(), bufferedOut.getvalue())
+
 
 # vi: ts=4 sw=4 et
@@ -30,6 +30,10 @@ from yokadi.update import update8to9  # noqa
 from yokadi.update import update9to10  # noqa
 from yokadi.update import update10to11  # noqa
 from yokadi.update import update11to12  # noqa
+from yokadi.update import update12to13  # noqa
+from yokadi.update import update13to14  # noqa
+from yokadi.update import update14to15  # noqa
+from yokadi.update import update15to16  # noqa
 
 
 def getVersion(fileName):
@@ -80,6 +84,7 @@ def err(message):
 
 
 def update(dbPath, newDbPath=None, inplace=True):
+    """Update the database dbPath and, if it exists, its archive database"""
     # Check paths
     if not os.path.exists(dbPath):
         err("'{}' does not exist.".format(dbPath))
@@ -89,13 +94,34 @@ def update(dbPath, newDbPath=None, inplace=True):
         err("'{}' already exists.".format(newDbPath))
         return 1
 
+    archivePath = db.getArchivePathForDb(dbPath)
+    if not os.path.exists(archivePath):
+        archivePath = None
+    if inplace or archivePath is None:
+        newArchivePath = None
+    else:
+        newArchivePath = db.getArchivePathForDb(newDbPath)
+        if os.path.exists(newArchivePath):
+            err("'{}' already exists.".format(newArchivePath))
+            return 1
+
+    updateFile(dbPath, newDbPath, inplace)
+    if archivePath is not None:
+        print("Updating archive database {}".format(archivePath))
+        updateFile(archivePath, newArchivePath, inplace)
+    return 0
+
+
+def updateFile(dbPath, newDbPath, inplace):
+    """Update the database file dbPath. Used for the main and the archive
+    databases, which share the same schema"""
     # Check version
     version = getVersion(dbPath)
     print("Found version %d" % version)
 
     if version == db.DB_VERSION:
         print("Nothing to do")
-        return 0
+        return
 
     if inplace:
         destDir = os.path.dirname(dbPath)
@@ -103,6 +129,11 @@ def update(dbPath, newDbPath=None, inplace=True):
         destDir = os.path.dirname(newDbPath)
 
     with TemporaryDirectory(prefix="yokadi-update-", dir=destDir) as tempDir:
+        # Make sure changes still in the WAL file are written to the DB
+        conn = sqlite3.connect(dbPath)
+        conn.execute("pragma wal_checkpoint(truncate)")
+        conn.close()
+
         # Copy the DB
         workDbPath = os.path.join(tempDir, "work.db")
         shutil.copy(dbPath, workDbPath)
@@ -136,8 +167,6 @@ def update(dbPath, newDbPath=None, inplace=True):
         else:
             os.rename(recreatedDbPath, newDbPath)
 
-    return 0
-
 
 def main():
     # Parse args
@@ -0,0 +1,32 @@
+"""
+Update from version 12 to version 13 of Yokadi DB
+
+- Add indexes on the task columns used to filter tasks
+- Add an index on task_keyword to look up tasks by keyword
+
+@author: Aurélien Gâteau <mail@agateau.com>
+@license: GPL v3 or newer
+"""
+from yokadi.update import updateutils
+
+
+INDEXES = (
+    "create index if not exists ix_task_project_id_status on task(project_id, status)",
+    "create index if not exists ix_task_status_done_date on task(status, done_date)",
+    "create index if not exists ix_task_due_date_not_done on task(due_date) where status != 'done'",
+    "create index if not exists ix_task_keyword_keyword_id_task_id on task_keyword(keyword_id, task_id)",
+)
+
+
+def createIndexes(cursor):
+    for sql in INDEXES:
+        cursor.execute(sql)
+
+
+def update(cursor):
+    createIndexes(cursor)
+
+
+if __name__ == "__main__":
+    updateutils.main(update)
+# vi: ts=4 sw=4 et
@@ -0,0 +1,24 @@
+"""
+Update from version 13 to version 14 of Yokadi DB
+
+- Add an update_date column to Task
+
+@author: Aurélien Gâteau <mail@agateau.com>
+@license: GPL v3 or newer
+"""
+from yokadi.update import updateutils
+
+
+def addUpdateDateColumn(cursor):
+    cursor.execute("alter table task add column update_date datetime")
+    # The real modification date is unknown, use the most recent known date
+    cursor.execute("update task set update_date = max(creation_date, coalesce(done_date, creation_date))")
+
+
+def update(cursor):
+    addUpdateDateColumn(cursor)
+
+
+if __name__ == "__main__":
+    updateutils.main(update)
+# vi: ts=4 sw=4 et
@@ -0,0 +1,21 @@
+"""
+Update from version 14 to version 15 of Yokadi DB
+
+- Add the task_fts full-text index and the triggers keeping it up to date.
+  They are created with the other tables when the database is recreated, and
+  the triggers fill the index while the content is imported, so there is
+  nothing to do here
+
+@author: Aurélien Gâteau <mail@agateau.com>
+@license: GPL v3 or newer
+"""
+from yokadi.update import updateutils
+
+
+def update(cursor):
+    pass
+
+
+if __name__ == "__main__":
+    updateutils.main(update)
+# vi: ts=4 sw=4 et
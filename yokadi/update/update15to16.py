@@ -0,0 +1,27 @@
+"""
+Update from version 15 to version 16 of Yokadi DB
+
+- Add an is_note column to Task, set for the tasks with the _note keyword.
+  The keyword is kept
+
+@author: Aurélien Gâteau <mail@agateau.com>
+@license: GPL v3 or newer
+"""
+from yokadi.update import updateutils
+
+
+def addIsNoteColumn(cursor):
+    cursor.execute("alter table task add column is_note boolean not null default 0")
+    cursor.execute("update task set is_note = 1 where id in ("
+                   " select task_keyword.task_id from task_keyword"
+                   " join keyword on keyword.id = task_keyword.keyword_id"
+                   " where keyword.name = '_note')")
+
+
+def update(cursor):
+    addIsNoteColumn(cursor)
+
+
+if __name__ == "__main__":
+    updateutils.main(update)
+# vi: ts=4 sw=4 et
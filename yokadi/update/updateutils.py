@@ -18,8 +18,13 @@ class UpdateCanceledError(UpdateError):
 
 
 def getTableList(cursor):
-    cursor.execute("select name from sqlite_master where type='table' and name!='sqlite_sequence'")
-    return [x[0] for x in cursor.fetchall()]
+    """Returns the list of regular tables. Virtual tables and their shadow
+    tables are skipped: they are filled by triggers"""
+    cursor.execute("select name, sql from sqlite_master where type='table' and name!='sqlite_sequence'")
+    rows = cursor.fetchall()
+    virtualTables = [name for name, sql in rows if sql.upper().startswith("CREATE VIRTUAL TABLE")]
+    return [name for name, sql in rows
+            if not any(name == x or name.startswith(x + "_") for x in virtualTables)]
 
 
 def getTableColumnList(cursor, table):
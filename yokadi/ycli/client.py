@@ -0,0 +1,88 @@
+# -*- coding: UTF-8 -*-
+"""
+Client of the Yokadi server (see yokadi.ycli.server).
+
+Sends one-shot commands to a running server, which avoids paying the startup
+cost of Yokadi for each of them. This module is imported before anything
+else: it must not import SQLAlchemy or the command modules.
+
+Messages are JSON objects, one per line.
+
+@author: Aurélien Gâteau <mail@agateau.com>
+@license: GPL v3 or later
+"""
+import json
+import os
+import shutil
+import socket
+import sys
+
+from yokadi.core import basepaths
+
+
+def sendMessage(stream, **kwargs):
+    """Write a message to a binary stream. Does not flush the stream"""
+    stream.write(json.dumps(kwargs).encode("utf-8") + b"\n")
+
+
+def getCommandArgs(argv):
+    """Returns the arguments of the one-shot command of a yokadi command line,
+    or None if there is no command or if the command line contains options
+    for yokadi itself
+    @param argv: command line arguments, without the program name"""
+    if argv[:1] == ["--"]:
+        argv = argv[1:]
+    elif any(x.startswith("-") for x in argv):
+        return None
+    return argv or None
+
+
+def forwardCommand(argv, stdout=None, stderr=None):
+    """Run the one-shot command of argv in the Yokadi server, if one is
+    running for the default database
+    @param argv: command line arguments, without the program name
+    @param stdout, stderr: text streams receiving the output of the command.
+    Default to sys.stdout and sys.stderr
+    @return: the exit code of the command, or None if the command must run in
+    this process"""
+    args = getCommandArgs(argv)
+    if args is None or not hasattr(socket, "AF_UNIX"):
+        return None
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(basepaths.getServerSocketPath())
+    except OSError:
+        # No server
+        sock.close()
+        return None
+
+    dbPath = os.path.abspath(basepaths.getDbPath(basepaths.getDataDir()))
+    commandLine = " ".join(args)
+    echoed = False
+    with sock, sock.makefile("rwb") as stream:
+        sendMessage(stream, line=commandLine, dbPath=dbPath, cwd=os.getcwd(),
+                    interactive=sys.stdin.isatty(), isatty=stdout.isatty(),
+                    columns=shutil.get_terminal_size().columns)
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            kind = message["type"]
+            if kind == "fallback":
+                return None
+            if not echoed:
+                # Like main(), print the command line first. Not done if the
+                # command falls back to main()
+                print(commandLine, file=stdout)
+                echoed = True
+            if kind == "stdout":
+                stdout.write(message["text"])
+            elif kind == "stderr":
+                stderr.write(message["text"])
+            elif kind == "exit":
+                return message["code"]
+    print("Error: connection to the Yokadi server lost", file=stderr)
+    return 1
+# vi: ts=4 sw=4 et
@@ -8,21 +8,29 @@ Standard codes for shell colors.
 
 import sys
 
-if sys.stdout.isatty():
-    BOLD = '\033[01m'
-    RED = '\033[31m'
-    GREEN = '\033[32m'
-    ORANGE = '\033[33m'
-    PURPLE = '\033[35m'
-    CYAN = '\033[36m'
-    GREY = '\033[37m'
-    RESET = '\033[0;0m'
-else:
-    BOLD = ''
-    RED = ''
-    GREEN = ''
-    ORANGE = ''
-    PURPLE = ''
-    CYAN = ''
-    GREY = ''
-    RESET = ''
+
+def setEnabled(enabled):
+    """Enable or disable colors. By default colors are enabled if stdout is a
+    terminal"""
+    global BOLD, RED, GREEN, ORANGE, PURPLE, CYAN, GREY, RESET
+    if enabled:
+        BOLD = '\033[01m'
+        RED = '\033[31m'
+        GREEN = '\033[32m'
+        ORANGE = '\033[33m'
+        PURPLE = '\033[35m'
+        CYAN = '\033[36m'
+        GREY = '\033[37m'
+        RESET = '\033[0;0m'
+    else:
+        BOLD = ''
+        RED = ''
+        GREEN = ''
+        ORANGE = ''
+        PURPLE = ''
+        CYAN = ''
+        GREY = ''
+        RESET = ''
+
+
+setEnabled(sys.stdout.isatty())
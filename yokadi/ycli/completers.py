@@ -5,6 +5,11 @@ Implementation of completers for various Yokadi objects.
 @author: Aurélien Gâteau <mail@agateau.com>
 @license: GPL v3 or later
 """
+from bisect import bisect_left
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
 from yokadi.ycli.basicparseutils import parseParameters, simplifySpaces
 from yokadi.core import db
 from yokadi.core.db import Config, Keyword, Project, Task
@@ -17,14 +22,91 @@ def computeCompleteParameterPosition(text, line, begidx, endidx):
     return before.count(" ") + 1
 
 
+# Maximum number of tasks listed by taskIdCompleter
+MAX_LISTED_TASKS = 50
+
+_CACHE_KEY = "completionCache"
+
+
+def _getStartingWith(sortedKeys, values, prefix):
+    """Return the values whose key starts with prefix
+    @param sortedKeys: sorted list of str
+    @param values: list of values, in the same order as sortedKeys"""
+    start = bisect_left(sortedKeys, prefix)
+    end = start
+    while end < len(sortedKeys) and sortedKeys[end].startswith(prefix):
+        end += 1
+    return values[start:end]
+
+
+class CompletionCache(object):
+    """Names of projects, keywords and config keys, and ids of the tasks which
+    are not done, loaded once and kept sorted so that completing a prefix is a
+    binary search instead of a query.
+
+    Use getCompletionCache() to get it. The cache is dropped when the session
+    commits or rolls back, and after each command."""
+    def __init__(self, session):
+        self._session = session
+        self._names = {}  # field => (sorted lower case names, names)
+        self._taskIds = None  # sorted ids as str
+        self._taskInfos = None  # id as str => (project name, task title)
+
+    def getNamesStartingWith(self, field, text):
+        """Return the values of field starting with text, ignoring case
+        @param field: a unique name column, like Project.name"""
+        if field not in self._names:
+            names = sorted((x for x, in self._session.query(field)), key=str.lower)
+            self._names[field] = [x.lower() for x in names], names
+        keys, names = self._names[field]
+        return _getStartingWith(keys, names, text.lower())
+
+    def getTaskIdsStartingWith(self, text):
+        """Return the ids of the tasks which are not done and whose id starts
+        with text, as str, in alphabetical order"""
+        if self._taskIds is None:
+            query = self._session.query(Task.id, Project.name, Task.title).join(Project) \
+                .filter(Task.status != "done")
+            self._taskInfos = dict((str(taskId), (projectName, title)) for taskId, projectName, title in query)
+            self._taskIds = sorted(self._taskInfos)
+        return _getStartingWith(self._taskIds, self._taskIds, text)
+
+    def getTaskInfo(self, taskId):
+        """@param taskId: id returned by getTaskIdsStartingWith()
+        @return: (project name, task title)"""
+        return self._taskInfos[taskId]
+
+
+def getCompletionCache():
+    """Return the completion cache of the current session, creating it if
+    needed"""
+    session = db.getSession()
+    cache = session.info.get(_CACHE_KEY)
+    if cache is None:
+        cache = CompletionCache(session)
+        session.info[_CACHE_KEY] = cache
+    return cache
+
+
+def clearCompletionCache():
+    """Drop the completion cache of the current session, to see the changes
+    done by other processes"""
+    db.getSession().info.pop(_CACHE_KEY, None)
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_soft_rollback")
+def _clearSessionCompletionCache(session, *args):
+    session.info.pop(_CACHE_KEY, None)
+
+
 def getItemPropertiesStartingWith(item, field, text):
-    """Return a list of item.field starting with text
-    @param item: the object item, example : Task, Project, Keyword...
-    @param field: the item's field lookup : Project.q.name, Task.q.title, Keyword.q.name. Don't forget the magic q
+    """Return a list of item.field starting with text, ignoring case
+    @param item: the object item, example : Project, Keyword, Config
+    @param field: the item's unique name field : Project.name, Keyword.name, Config.name
     @param text: The begining of the text as a str
     @return: list of matching strings"""
-    session = db.getSession()
-    return [x.name for x in session.query(item).filter(field.like(str(text) + "%"))]
+    return getCompletionCache().getNamesStartingWith(field, str(text))
 
 
 class ProjectCompleter(object):
@@ -81,14 +163,15 @@ def confCompleter(cmd, text, line, begidx, endidx):
 
 def taskIdCompleter(cmd, text, line, begidx, endidx):
     # TODO: filter on parameter position
-    # TODO: potential performance issue with lots of tasks, find a better way to do it
-    session = db.getSession()
-    tasks = [x for x in session.query(Task).filter(Task.status != 'done') if str(x.id).startswith(text)]
+    cache = getCompletionCache()
+    ids = cache.getTaskIdsStartingWith(text)
     print()
-    for task in tasks:
+    for taskId in sorted(ids, key=int)[:MAX_LISTED_TASKS]:
         # Move that in a renderer class ?
-        print("%s: %s / %s" % (task.id, task.project.name, task.title))
-    return [str(x.id) for x in tasks]
+        print("%s: %s / %s" % ((taskId,) + cache.getTaskInfo(taskId)))
+    if len(ids) > MAX_LISTED_TASKS:
+        print("(%d more tasks)" % (len(ids) - MAX_LISTED_TASKS))
+    return ids
 
 
 def recurrenceCompleter(cmd, text, line, begidx, endidx):
@@ -53,6 +53,9 @@ class ConfCmd(object):
         else:
             if self.checkParameterValue(name, value):
                 p[0].value = value
+                session.commit()
+                if name in db.PRAGMA_CONFIG_KEYS:
+                    db.reloadPragmas()
                 tui.info("Parameter updated")
             else:
                 raise YokadiException("Parameter value is incorrect")
@@ -65,13 +68,15 @@ class ConfCmd(object):
         @param value: parameter value
         @return: True if parameter is ok, else False"""
         # Positive int parameters
-        if name in ("ALARM_DELAY", "ALARM_SUSPEND", "PURGE_DELAY"):
+        if name in ("ALARM_DELAY", "ALARM_SUSPEND", "PURGE_DELAY", "ARCHIVE_DELAY"):
             try:
                 value = int(value)
                 assert value >= 0
                 return True
             except (ValueError, AssertionError):
                 return False
+        elif name in db.PRAGMA_CONFIG_KEYS:
+            return db.checkPragmaValue(name, value)
         else:
             # No check for this parameter, so tell everything is fine
             return True
@@ -63,7 +63,7 @@ class HtmlListRenderer(object):
         @param sectionName: name of the task groupement section
         @type sectionName: unicode
         @param taskList: list of tasks to display
-        @type taskList: list of db.Task instances
+        @type taskList: list of db.Task or dbutils.TaskRow instances
         """
         TASK_FIELDS = [
             TaskField("Id", lambda x: str(x.id)),
@@ -12,7 +12,7 @@ from yokadi.core import dbutils
 from yokadi.ycli import tui
 
 from yokadi.core import db
-from yokadi.core.db import Keyword
+from yokadi.core.db import Keyword, NOTE_KEYWORD
 from yokadi.core.yokadiexception import BadUsageException
 from yokadi.ycli.completers import KeywordCompleter
 
@@ -59,6 +59,8 @@ class KeywordCmd(object):
             print("The keyword {} is used by the following tasks: {}".format(keyword.name, taskList))
             if not tui.confirm("Do you really want to remove this keyword"):
                 return
+        if keyword.name == NOTE_KEYWORD:
+            dbutils.setNoteFlag(keyword, False)
         session.delete(keyword)
         session.commit()
         print("Keyword {} has been removed".format(keyword.name))
@@ -80,6 +82,8 @@ class KeywordCmd(object):
         if len(lst) == 0:
             # Simple case: newName does not exist, just rename the existing keyword
             keyword.name = newName
+            if NOTE_KEYWORD in (oldName, newName):
+                dbutils.setNoteFlag(keyword, newName == NOTE_KEYWORD)
             session.commit()
             print("Keyword %s has been renamed to %s" % (oldName, newName))
             return
@@ -11,34 +11,35 @@ Command line oriented, sqlite powered, todo list
 import locale
 import os
 import platform
+import signal
 import sys
 
-import readline
-
 import traceback
 from cmd import Cmd
 from argparse import ArgumentParser
 
 import sqlalchemy
-from colorama import just_fix_windows_console
 
 import yokadi
 
 from yokadi.core import db
+from yokadi.core import dbutils
 from yokadi.core import basepaths
 from yokadi.core import fileutils
-from yokadi.update import update
 
 from yokadi.ycli import tui, commonargs
+from yokadi.ycli.completers import clearCompletionCache
 from yokadi.ycli.aliascmd import AliasCmd, resolveAlias
 from yokadi.ycli.confcmd import ConfCmd
 from yokadi.ycli.keywordcmd import KeywordCmd
 from yokadi.ycli.projectcmd import ProjectCmd
 from yokadi.ycli.taskcmd import TaskCmd
-from yokadi.core.yokadiexception import YokadiException, BadUsageException
+from yokadi.core.yokadiexception import YokadiException, BadUsageException, InputRequiredException
 from yokadi.core.yokadioptionparser import YokadiOptionParserNormalExitException
 
-readline.parse_and_bind("set show-all-if-ambiguous on")
+# Modules only needed by some code paths, such as readline, colorama or the
+# list renderers, are imported when they are used, to keep one-shot commands
+# fast. scripts/benchstartup checks the startup time
 
 
 # TODO: move YokadiCmd to a separate module in ycli package
@@ -52,7 +53,6 @@ class YokadiCmd(TaskCmd, ProjectCmd, KeywordCmd, ConfCmd, AliasCmd, Cmd):
         ConfCmd.__init__(self)
         self.prompt = "yokadi> "
         self.historyPath = basepaths.getHistoryPath()
-        self.loadHistory()
 
     def emptyline(self):
         """Executed when input is empty. Reimplemented to do nothing."""
@@ -69,6 +69,12 @@ class YokadiCmd(TaskCmd, ProjectCmd, KeywordCmd, ConfCmd, AliasCmd, Cmd):
         else:
             raise YokadiException("Unknown command. Use 'help' to see all available commands")
 
+    def postcmd(self, stop, line):
+        # Completion must see the changes done by other processes while the
+        # command was typed
+        clearCompletionCache()
+        return stop
+
     def completedefault(self, text, line, begidx, endidx):
         """Default completion command.
         Try to see if command is an alias and find the
@@ -97,6 +103,9 @@ class YokadiCmd(TaskCmd, ProjectCmd, KeywordCmd, ConfCmd, AliasCmd, Cmd):
             return Cmd.onecmd(self, line)
         except YokadiOptionParserNormalExitException:
             pass
+        except InputRequiredException:
+            # Handled by the Yokadi server
+            raise
         except UnicodeDecodeError as e:
             tui.error("Unicode decoding error. Please check you locale and terminal settings (%s)." % e)
         except UnicodeEncodeError as e:
@@ -131,6 +140,8 @@ class YokadiCmd(TaskCmd, ProjectCmd, KeywordCmd, ConfCmd, AliasCmd, Cmd):
 
     def loadHistory(self):
         """Tries to load previous history list from disk"""
+        import readline
+        readline.parse_and_bind("set show-all-if-ambiguous on")
         try:
             readline.read_history_file(self.historyPath)
         except Exception:
@@ -139,6 +150,7 @@ class YokadiCmd(TaskCmd, ProjectCmd, KeywordCmd, ConfCmd, AliasCmd, Cmd):
 
     def writeHistory(self):
         """Writes shell history to disk"""
+        import readline
         try:
             fileutils.createParentDirs(self.historyPath)
             # Open r/w and close file to create one if needed
@@ -190,19 +202,25 @@ def createArgumentParser():
                         dest="update", action="store_true",
                         help="Update database to the latest version")
 
+    parser.add_argument("--serve",
+                        dest="serve", action="store_true",
+                        help="Run a server in the foreground, which runs the commands of other yokadi invocations."
+                             " Avoids paying the startup cost of Yokadi for each command")
+
     parser.add_argument('cmd', nargs='*')
     return parser
 
 
 def main():
     locale.setlocale(locale.LC_ALL, os.environ.get("LANG", "C"))
-    just_fix_windows_console()
+    if sys.platform == "win32":
+        from colorama import just_fix_windows_console
+        just_fix_windows_console()
 
     parser = createArgumentParser()
     args = parser.parse_args()
     dataDir, dbPath = commonargs.processArgs(args)
 
-    basepaths.migrateOldHistory()
     try:
         basepaths.migrateOldDb(dbPath)
     except basepaths.MigrationException as exc:
@@ -210,6 +228,7 @@ def main():
         return 1
 
     if args.update:
+        from yokadi.update import update
         return update.update(dbPath)
 
     try:
@@ -217,15 +236,45 @@ def main():
     except db.DbUserException as exc:
         print(exc)
         return 1
+    for message in db.getPragmaWarnings():
+        tui.warning(message)
 
     if args.createOnly:
         return 0
     db.setDefaultConfig()  # Set default config parameters
+    # Archiving cannot start inside a transaction
+    db.getSession().commit()
+    try:
+        count = dbutils.archiveOldTasks()
+    except db.DbUserException as exc:
+        # Do not prevent using Yokadi because of the archive database
+        tui.warning("Old tasks have not been archived: %s" % exc)
+        count = 0
+    if count:
+        tui.info("Archived %d tasks done more than ARCHIVE_DELAY days ago" % count)
 
     cmd = YokadiCmd()
 
+    if args.serve:
+        from yokadi.ycli import server
+        # Make sure the socket is removed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve(cmd, dbPath)
+        except KeyboardInterrupt:
+            pass
+        except YokadiException as exc:
+            tui.error(str(exc))
+            return 1
+        return 0
+
+    # One-shot commands do not use the history of the interactive shell
+    oneShot = len(args.cmd) > 0
+    if not oneShot:
+        basepaths.migrateOldHistory()
+        cmd.loadHistory()
     try:
-        if len(args.cmd) > 0:
+        if oneShot:
             print(" ".join(args.cmd))
             cmd.onecmd(" ".join(args.cmd))
         else:
@@ -233,8 +282,9 @@ def main():
     except KeyboardInterrupt:
         print("\n\tBreak ! (the nice way to quit is 'quit' or 'EOF' (ctrl-d)")
         return 1
-    # Save history
-    cmd.writeHistory()
+    if not oneShot:
+        # Save history
+        cmd.writeHistory()
     return 0
 
 
@@ -8,13 +8,12 @@ Database utilities.
 from collections import namedtuple
 from datetime import datetime
 
-from sqlalchemy import desc
+from sqlalchemy import bindparam, delete, desc, insert, update
 
 from yokadi.core import db
-from yokadi.core.db import Task, NOTE_KEYWORD
+from yokadi.core.db import NOTE_KEYWORD, Keyword, Task, TaskKeyword
 from yokadi.core.yokadiexception import YokadiException
 from yokadi.core import dbutils
-from yokadi.core.dbutils import KeywordFilter
 from yokadi.ycli import parseutils
 
 
@@ -143,10 +142,9 @@ def parseMEditText(text):
 def createEntriesForProject(project):
     session = db.getSession()
     lst = session.query(Task).filter(Task.projectId == project.id,
-                                     Task.status != 'done')
-
-    lst = KeywordFilter(NOTE_KEYWORD, negative=True).apply(lst)
-    lst = lst.order_by(desc(Task.urgency))
+                                     Task.status != 'done',
+                                     Task.noteFlag == False)  # noqa
+    lst = dbutils.eagerLoadTaskRelations(lst.order_by(desc(Task.urgency)))
     return [createEntryForTask(x) for x in lst]
 
 
@@ -158,8 +156,12 @@ def applyChanges(project, oldList, newList, interactive=True):
     """
     Modify a project so that its task list is newList
 
-    @param project: the project name
-    @param oldList: a list of Task instances
+    Tasks and keywords are loaded with a few IN queries. Only the fields and
+    the keyword associations which changed are written, keyword associations
+    are inserted and deleted in bulk.
+
+    @param project: the project
+    @param oldList: a list of MEditEntry, as returned by createEntriesForProject()
     @param newList: a list of MEditEntry
     @param interactive: whether to confirm creation of new keywords
     """
@@ -174,27 +176,94 @@ def applyChanges(project, oldList, newList, interactive=True):
         raise YokadiException("Unknown id(s): %s" % idString)
 
     # Check keywords
-    for entry in newList:
-        for name in entry.keywords:
-            dbutils.getOrCreateKeyword(name, interactive=interactive)
+    names = sorted(set(name for entry in newList for name in entry.keywords))
+    dbutils.createMissingKeywords(names, interactive=interactive)
+    keywordIds = dict(session.query(Keyword.name, Keyword.id).filter(Keyword.name.in_(names)))
+    unknownNames = [x for x in names if x not in keywordIds]
+    if unknownNames:
+        raise YokadiException("Unknown keyword(s): %s" % ", ".join(unknownNames))
 
     # Remove tasks whose lines have been deleted
-    for id in oldIds.difference(newIds):
-        task = dbutils.getTaskFromId(id)
-        session.delete(task)
+    deletedIds = sorted(oldIds.difference(newIds))
+    for start in range(0, len(deletedIds), dbutils.ID_QUERY_CHUNK_SIZE):
+        dbutils.deleteTasks([Task.id.in_(deletedIds[start:start + dbutils.ID_QUERY_CHUNK_SIZE])])
 
     # Update existing tasks, add new ones
+    tasks, _ = dbutils.getTasksFromIds([x.id for x in newList if x.id is not None])
+    taskDict = dict((x.id, x) for x in tasks)
+    now = datetime.now()
+    removedTaskKeywords = []
+    changedTaskKeywords = []
+    addedTaskKeywordRows = []
+    keywordChangedTasks = []
     nbTasks = len(newList)
     for pos, newEntry in enumerate(newList):
-        if newEntry.id:
-            task = dbutils.getTaskFromId(newEntry.id)
-        else:
-            task = Task(creationDate=datetime.now().replace(second=0, microsecond=0), project=project)
+        urgency = nbTasks - pos
+        if newEntry.id is None:
+            task = Task(creationDate=now.replace(second=0, microsecond=0), project=project,
+                        title=newEntry.title, urgency=urgency)
             session.add(task)
-        task.title = newEntry.title
-        task.setKeywordDict(newEntry.keywords)
-        task.setStatus(newEntry.status)
-        task.urgency = nbTasks - pos
+            task.setKeywordDict(newEntry.keywords)
+            task.setStatus(newEntry.status)
+            continue
+
+        task = taskDict[newEntry.id]
+        if task.title != newEntry.title:
+            task.title = newEntry.title
+        if task.status != newEntry.status:
+            task.setStatus(newEntry.status)
+        if task.urgency != urgency:
+            task.urgency = urgency
+
+        taskKeywords = dict((x.keyword.name, x) for x in task.taskKeywords)
+        keywordChanged = False
+        for name, taskKeyword in taskKeywords.items():
+            if name not in newEntry.keywords:
+                removedTaskKeywords.append(taskKeyword)
+                keywordChanged = True
+        for name, value in newEntry.keywords.items():
+            taskKeyword = taskKeywords.get(name)
+            if taskKeyword is None:
+                addedTaskKeywordRows.append(dict(task_id=task.id, keyword_id=keywordIds[name], value=value))
+                keywordChanged = True
+            elif taskKeyword.value != value:
+                changedTaskKeywords.append((taskKeyword, value))
+                keywordChanged = True
+        if keywordChanged:
+            keywordChangedTasks.append(task)
+            task.noteFlag = NOTE_KEYWORD in newEntry.keywords
+            # The bulk statements below are not seen by the before_flush
+            # handler which maintains update dates
+            task.updateDate = now
+
+    _writeTaskKeywordChanges(session, removedTaskKeywords, changedTaskKeywords, addedTaskKeywordRows)
+
+    # Make the session forget about the rows changed by the bulk statements
+    for taskKeyword in removedTaskKeywords:
+        session.expunge(taskKeyword)
+    for taskKeyword, _ in changedTaskKeywords:
+        session.expire(taskKeyword)
+    for task in keywordChangedTasks:
+        session.expire(task, ["taskKeywords"])
+
+
+def _writeTaskKeywordChanges(session, removedTaskKeywords, changedTaskKeywords, addedTaskKeywordRows):
+    """Write keyword association changes with set-based statements
+    @param removedTaskKeywords: list of TaskKeyword instances to delete
+    @param changedTaskKeywords: list of (TaskKeyword instance, new value)
+    @param addedTaskKeywordRows: list of dicts, rows of the task_keyword table"""
+    table = TaskKeyword.__table__
+    removedIds = [x.id for x in removedTaskKeywords]
+    for start in range(0, len(removedIds), dbutils.ID_QUERY_CHUNK_SIZE):
+        chunk = removedIds[start:start + dbutils.ID_QUERY_CHUNK_SIZE]
+        session.execute(delete(table).where(table.c.id.in_(chunk)))
+    if changedTaskKeywords:
+        statement = update(table).where(table.c.id == bindparam("taskKeywordId")) \
+            .values(value=bindparam("newValue"))
+        session.execute(statement, [dict(taskKeywordId=x.id, newValue=v) for x, v in changedTaskKeywords])
+    if addedTaskKeywordRows:
+        # Use a Core insert, like dbutils.addTasks()
+        session.execute(insert(table), addedTaskKeywordRows)
 
 
 # vi: ts=4 sw=4 et
@@ -76,6 +76,10 @@ def warnIfKeywordDoesNotExist(keywordFilters):
     session = db.getSession()
     doesNotExist = False
     for keyword in [k.name for k in keywordFilters]:
+        # Filters can contain LIKE wildcards, only query when the name is not
+        # an existing keyword
+        if db.getIdFromName(Keyword, keyword) is not None:
+            continue
         if session.query(Keyword).filter(Keyword.name.like(keyword)).count() == 0:
             tui.error("Keyword %s is unknown." % keyword)
             doesNotExist = True
@@ -17,7 +17,7 @@ class PlainListRenderer(object):
         @param sectionName: name of the task groupement section
         @type sectionName: unicode
         @param taskList: list of tasks to display
-        @type taskList: list of db.Task instances
+        @type taskList: list of db.Task or dbutils.TaskRow instances
         """
 
         if not self.first:
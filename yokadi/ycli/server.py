@@ -0,0 +1,175 @@
+# -*- coding: UTF-8 -*-
+"""
+Yokadi server. Keeps a YokadiCmd and its database session alive, and runs the
+one-shot commands sent by yokadi.ycli.client on a Unix socket.
+
+Commands run one at a time. Their output is kept until they finish, then sent
+back to the client. If a command needs to prompt the user, its output is
+dropped, nothing is changed and the client runs the command itself.
+
+@author: Aurélien Gâteau <mail@agateau.com>
+@license: GPL v3 or later
+"""
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+
+from yokadi.core import basepaths
+from yokadi.core import db
+from yokadi.core import fileutils
+from yokadi.core.yokadiexception import InputRequiredException, YokadiException
+from yokadi.ycli import colors
+from yokadi.ycli import tui
+from yokadi.ycli.client import sendMessage
+
+
+class ClientOutputStream(io.TextIOBase):
+    """Text stream queuing what is written as messages for the client"""
+    def __init__(self, messages, name, isatty):
+        """
+        @param messages: list receiving the messages, shared by the output
+        streams of a command so that the order of the output is kept
+        """
+        self._messages = messages
+        self._name = name
+        self._isatty = isatty
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return self._isatty
+
+    def write(self, text):
+        if text:
+            self._messages.append(dict(type=self._name, text=text))
+        return len(text)
+
+
+class NoInputStream(io.TextIOBase):
+    """Replaces stdin while a command runs: the input of the client cannot be
+    read"""
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        raise InputRequiredException()
+
+    def readline(self, size=-1):
+        raise InputRequiredException()
+
+
+class CommandRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        if request["dbPath"] != self.server.dbPath:
+            # The client wants another database
+            sendMessage(self.wfile, type="fallback")
+            return
+
+        # The output is kept until the command finishes: a command may print
+        # something, then prompt the user. In this case the client runs the
+        # command again, it must not have received anything
+        messages = []
+        try:
+            with self.server.clientContext(request, messages):
+                self.server.cmd.onecmd(request["line"])
+        except InputRequiredException:
+            sendMessage(self.wfile, type="fallback")
+            return
+        finally:
+            # Commands commit their changes. Also make sure the next command
+            # sees the changes done by other processes
+            db.getSession().rollback()
+        for message in messages:
+            sendMessage(self.wfile, **message)
+        sendMessage(self.wfile, type="exit", code=0)
+
+
+class YokadiServer(socketserver.UnixStreamServer):
+    def __init__(self, socketPath, cmd, dbPath):
+        """
+        @param socketPath: path of the Unix socket to listen on
+        @param cmd: the YokadiCmd instance running the commands
+        @param dbPath: path of the database of cmd. Clients using another
+        database run their commands themselves
+        """
+        self.cmd = cmd
+        self.dbPath = os.path.abspath(dbPath)
+        socketserver.UnixStreamServer.__init__(self, socketPath, CommandRequestHandler)
+        os.chmod(socketPath, 0o600)
+
+    @contextmanager
+    def clientContext(self, request, messages):
+        """Make the command behave as if it was running in the client
+        process
+        @param messages: list receiving the output of the command, as messages
+        for the client"""
+        os.chdir(request["cwd"])
+        os.environ["COLUMNS"] = str(request["columns"])
+        colors.setEnabled(request["isatty"])
+        tui.setInteractive(request["interactive"], inputAvailable=False)
+        self._resetCommandState()
+
+        stdout = ClientOutputStream(messages, "stdout", request["isatty"])
+        stderr = ClientOutputStream(messages, "stderr", request["isatty"])
+        oldStreams = tui.stdout, tui.stderr, sys.stdin
+        tui.stdout, tui.stderr, sys.stdin = stdout, stderr, NoInputStream()
+        try:
+            with redirect_stdout(stdout), redirect_stderr(stderr):
+                yield
+        finally:
+            tui.stdout, tui.stderr, sys.stdin = oldStreams
+            tui.setInteractive(sys.stdin.isatty())
+            colors.setEnabled(sys.stdout.isatty())
+
+    def _resetCommandState(self):
+        """One-shot commands must not depend on the ones which ran before"""
+        cmd = self.cmd
+        cmd.lastTaskId = None
+        cmd.lastProjectName = None
+        cmd.lastTaskIds = []
+        cmd.kFilters = []
+        cmd.pFilter = ""
+        # Aliases may have been changed by another process
+        cmd._updateAliasDict()
+
+
+def removeStaleSocket(socketPath):
+    """Remove the socket left by a server which did not exit cleanly. Raises
+    YokadiException if a server is still listening on it"""
+    if not os.path.exists(socketPath):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketPath)
+    except OSError:
+        os.unlink(socketPath)
+        return
+    finally:
+        sock.close()
+    raise YokadiException("A Yokadi server is already listening on %s" % socketPath)
+
+
+def serve(cmd, dbPath):
+    """Run commands sent by clients until the process is stopped"""
+    if not hasattr(socket, "AF_UNIX"):
+        raise YokadiException("The Yokadi server is not supported on this platform")
+    socketPath = basepaths.getServerSocketPath()
+    fileutils.createParentDirs(socketPath, mode=0o700)
+    removeStaleSocket(socketPath)
+    server = YokadiServer(socketPath, cmd, dbPath)
+    print("Yokadi server listening on %s" % socketPath)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socketPath)
+# vi: ts=4 sw=4 et
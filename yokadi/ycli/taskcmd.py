@@ -6,11 +6,13 @@ Task related commands.
 @author: Sébastien Renard <sebastien.renard@digitalfox.org>
 @license: GPL v3 or later
 """
+import importlib
 import os
-import readline
 import re
+import shlex
+import sys
 from datetime import datetime, timedelta
-from sqlalchemy import or_, desc
+from sqlalchemy import desc, func, select
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 
 from yokadi.core.db import Keyword, Project, Task, TaskKeyword, NOTE_KEYWORD
@@ -19,30 +21,37 @@ from yokadi.core import dbutils
 from yokadi.core import db
 from yokadi.core import ydateutils
 from yokadi.core.recurrencerule import RecurrenceRule
-from yokadi.ycli import massedit
 from yokadi.ycli.basicparseutils import parseOneWordName
 from yokadi.ycli import parseutils
 from yokadi.ycli import tui
 from yokadi.ycli.completers import ProjectCompleter, projectAndKeywordCompleter, \
     taskIdCompleter, recurrenceCompleter, dueDateCompleter
-from yokadi.core.dbutils import DbFilter, KeywordFilter
+from yokadi.core.dbutils import DbFilter, TextFilter
 from yokadi.core.yokadiexception import YokadiException, BadUsageException
 from yokadi.ycli.textlistrenderer import TextListRenderer
-from yokadi.ycli.xmllistrenderer import XmlListRenderer
-from yokadi.ycli.csvlistrenderer import CsvListRenderer
-from yokadi.ycli.htmllistrenderer import HtmlListRenderer
-from yokadi.ycli.plainlistrenderer import PlainListRenderer
 from yokadi.core.yokadioptionparser import YokadiOptionParser
 
+# Format name => (module, class) of the renderer. Renderers are imported when
+# they are used, some of them import large modules
 gRendererClassDict = dict(
-    text=TextListRenderer,
-    xml=XmlListRenderer,
-    csv=CsvListRenderer,
-    html=HtmlListRenderer,
-    plain=PlainListRenderer,
+    text=("yokadi.ycli.textlistrenderer", "TextListRenderer"),
+    xml=("yokadi.ycli.xmllistrenderer", "XmlListRenderer"),
+    csv=("yokadi.ycli.csvlistrenderer", "CsvListRenderer"),
+    html=("yokadi.ycli.htmllistrenderer", "HtmlListRenderer"),
+    plain=("yokadi.ycli.plainlistrenderer", "PlainListRenderer"),
 )
 
 
+def getRendererClass(name):
+    """Returns the renderer class for the format name"""
+    moduleName, className = gRendererClassDict[name]
+    return getattr(importlib.import_module(moduleName), className)
+
+
+# Default delay (in days) of t_archive when ARCHIVE_DELAY is 0
+DEFAULT_ARCHIVE_DELAY = 365
+
+
 class TaskCmd(object):
     def __init__(self):
         self.lastTaskId = None  # Last id created, used
@@ -51,9 +60,7 @@ class TaskCmd(object):
         self.kFilters = []  # Permanent keyword filters (List of KeywordFilter)
         self.pFilter = ""  # Permanent project filter (name of project)
         self.session = db.getSession()
-        for name in bugutils.PROPERTY_NAMES:
-            dbutils.getOrCreateKeyword(name, interactive=False)
-        dbutils.getOrCreateKeyword(NOTE_KEYWORD, interactive=False)
+        dbutils.createMissingKeywords(list(bugutils.PROPERTY_NAMES) + [NOTE_KEYWORD], interactive=False)
         self.session.commit()
 
     def _parser_t_add(self, cmd):
@@ -184,10 +191,14 @@ class TaskCmd(object):
         if len(tokens) != 2:
             raise BadUsageException("You must provide a taskId and an urgency value")
         task = self.getTaskFromId(tokens[0])
+        self.apply_t_urgency([task], tokens[1])
+        self.session.commit()
+
+    def apply_t_urgency(self, tasks, line):
         try:
             # Do not use isdigit(), so that we can set negative urgency. This
             # make it possible to stick tasks to the bottom of the list.
-            urgency = int(tokens[1])
+            urgency = int(line)
         except ValueError:
             raise BadUsageException("Task urgency must be a digit")
 
@@ -198,8 +209,8 @@ class TaskCmd(object):
             tui.warning("Min urgency is -99")
             urgency = -99
 
-        task.urgency = urgency
-        self.session.commit()
+        for task in tasks:
+            task.urgency = urgency
 
     complete_t_set_urgency = taskIdCompleter
     complete_t_urgency = taskIdCompleter
@@ -225,22 +236,42 @@ class TaskCmd(object):
 
     complete_t_mark_new = taskIdCompleter
 
+    def apply_t_mark_started(self, tasks, line):
+        self._setTasksStatus(tasks, line, "started")
+
+    def apply_t_mark_done(self, tasks, line):
+        self._setTasksStatus(tasks, line, "done")
+
+    def apply_t_mark_new(self, tasks, line):
+        self._setTasksStatus(tasks, line, "new")
+
     def _t_set_status(self, line, status):
         task = self.getTaskFromId(line)
-        task.setStatus(status)
+        self._setTasksStatus([task], "", status)
         self.session.commit()
-        if task.recurrence and status == "done":
-            print("Task '%s' next occurrence is scheduled at %s" % (task.title, task.dueDate))
-            print("To *really* mark this task done and forget it, remove its recurrence first"
-                  " with t_recurs %s none" % task.id)
-        else:
-            print("Task '%s' marked as %s" % (task.title, status))
+
+    def _setTasksStatus(self, tasks, line, status):
+        if line.strip():
+            raise BadUsageException("Got unexpected arguments: %s" % line.strip())
+        for task in tasks:
+            task.setStatus(status)
+            if task.recurrence and status == "done":
+                print("Task '%s' next occurrence is scheduled at %s" % (task.title, task.dueDate))
+                print("To *really* mark this task done and forget it, remove its recurrence first"
+                      " with t_recurs %s none" % task.id)
+            else:
+                print("Task '%s' marked as %s" % (task.title, status))
 
     def do_t_apply(self, line):
         """Apply a command to several tasks.
-        t_apply <id1>[,<id2>,[<id3>]...]] <command> <args>
+        t_apply [--chunk <size>] <id1>[,<id2>,[<id3>]...]] <command> <args>
         Use x-y to select task range from x to y
-        Use __ to select all tasks previously selected with t_list"""
+        Use __ to select all tasks previously selected with t_list
+
+        t_mark_started, t_mark_done, t_mark_new, t_urgency, t_project, t_due,
+        t_add_keywords and t_remove are applied to all tasks at once, in a
+        single transaction. Use --chunk to commit the changes every <size>
+        tasks instead. Other commands are executed once per task."""
         ids = []
         if "__" in line:
             if self.lastTaskIds:
@@ -252,11 +283,17 @@ class TaskCmd(object):
         if len(tokens) < 2:
             raise BadUsageException("Give at least a task id and a command")
 
+        tokens = [x for x in tokens if x]
+        chunkSize = None
+        if tokens[0] == "--chunk":
+            if len(tokens) < 2 or not tokens[1].isdigit() or int(tokens[1]) == 0:
+                raise BadUsageException("--chunk must be followed by a positive number")
+            chunkSize = int(tokens[1])
+            tokens = tokens[2:]
+
         idScan = True  # Indicate we are parsing ids
         cmdTokens = []  # Command that we want to apply
         for token in tokens:
-            if token == "":
-                continue
             if idScan:
                 result = rangeId.match(token)
                 if result:
@@ -273,10 +310,28 @@ class TaskCmd(object):
         if not cmdTokens:
             raise BadUsageException("Give a command to apply")
         cmd = cmdTokens.pop(0)
-        for taskId in ids:
-            line = " ".join([cmd, str(taskId), " ".join(cmdTokens)])
-            print("Executing: %s" % line)
-            self.onecmd(line.strip())
+        applyMethod = getattr(self, "apply_" + cmd, None)
+        if applyMethod is None:
+            for taskId in ids:
+                line = " ".join([cmd, str(taskId), " ".join(cmdTokens)])
+                print("Executing: %s" % line)
+                self.onecmd(line.strip())
+            return
+
+        line = " ".join(cmdTokens)
+        chunkSize = chunkSize or max(len(ids), 1)
+        for start in range(0, len(ids), chunkSize):
+            tasks, missingIds = dbutils.getTasksFromIds(ids[start:start + chunkSize])
+            if missingIds:
+                tui.error("These tasks do not exist: %s" % ", ".join(str(x) for x in missingIds))
+            if not tasks:
+                continue
+            try:
+                applyMethod(tasks, line)
+            except YokadiException:
+                self.session.rollback()
+                raise
+            self.session.commit()
 
     complete_t_apply = taskIdCompleter
 
@@ -296,14 +351,33 @@ class TaskCmd(object):
         if not args.force:
             if not tui.confirm("Remove task '%s'" % task.title):
                 return
-        project = task.project
-        self.session.delete(task)
-        print("Task '%s' removed" % (task.title))
-
-        # Delete project with no associated tasks
-        if self.session.query(Task).filter_by(project=project).count() == 0:
-            self.session.delete(project)
+        self._removeTasks([task])
         self.session.commit()
+
+    def apply_t_remove(self, tasks, line):
+        force = parseutils.simplifySpaces(line)
+        if force not in ("", "-f"):
+            raise BadUsageException("Got unexpected arguments: %s" % force)
+        if not force:
+            print("The following tasks will be removed:")
+            for task in tasks:
+                print("%s: %s" % (task.id, task.title))
+            if not tui.confirm("Remove %d tasks" % len(tasks)):
+                return
+        self._removeTasks(tasks)
+
+    def _removeTasks(self, tasks):
+        projects = []
+        for task in tasks:
+            if task.project not in projects:
+                projects.append(task.project)
+            self.session.delete(task)
+            print("Task '%s' removed" % (task.title))
+
+        # Delete projects with no associated tasks
+        for project in projects:
+            if self.session.query(Task).filter_by(project=project).count() == 0:
+                self.session.delete(project)
     complete_t_remove = taskIdCompleter
 
     def parser_t_purge(self):
@@ -316,27 +390,125 @@ class TaskCmd(object):
         parser.add_argument("-d", "--delay", dest="delay", default=delay,
                             type=int, help="Delay (in days) after which done tasks are destroyed."
                                            " Default is %d." % delay)
+        parser.add_argument("-n", "--dry-run", dest="dryRun", default=False, action="store_true",
+                            help="Only show the tasks which would be removed")
+        parser.add_argument("-c", "--count", dest="count", default=False, action="store_true",
+                            help="Only show the number of tasks instead of listing them")
+        parser.add_argument("--vacuum", dest="vacuum", default=False, action="store_true",
+                            help="Give the space freed by the removed tasks back to the file system."
+                                 " This can take a while on big databases")
         return parser
 
     def do_t_purge(self, line):
+        def showProgress(count):
+            if tui.stderr.isatty():
+                print("\rRemoved %d/%d tasks" % (count, total), end="", file=tui.stderr, flush=True)
+
         parser = self.parser_t_purge()
         args = parser.parse_args(line)
         filters = []
         filters.append(Task.status == "done")
         filters.append(Task.doneDate < (datetime.now() - timedelta(days=args.delay)))
-        tasks = self.session.query(Task).filter(*filters)
-        if tasks.count() == 0:
+        total = self.session.query(func.count(Task.id)).filter(*filters).scalar()
+        if total == 0:
             print("No tasks need to be purged")
             return
-        print("The following tasks will be removed:")
-        print("\n".join(["%s: %s" % (task.id, task.title) for task in tasks]))
+        if args.count:
+            print("%d tasks %s removed" % (total, "would be" if args.dryRun else "will be"))
+        else:
+            print("The following tasks %s removed:" % ("would be" if args.dryRun else "will be"))
+            for taskId, title in self.session.query(Task.id, Task.title).filter(*filters).order_by(Task.id):
+                print("%s: %s" % (taskId, title))
+        if args.dryRun:
+            return
         if args.force or tui.confirm("Do you really want to remove those tasks (this action cannot be undone)?"):
-            self.session.delete(tasks)
+            count = dbutils.deleteTasks(filters, onProgress=showProgress)
             self.session.commit()
-            print("Tasks deleted")
+            # Deleted tasks may still be in the identity map
+            self.session.expire_all()
+            if tui.stderr.isatty():
+                print(file=tui.stderr)
+            print("%d tasks deleted" % count)
+            if args.vacuum:
+                dbutils.vacuumDatabase()
         else:
             print("Purge canceled")
 
+    def parser_t_archive(self):
+        parser = YokadiOptionParser()
+        parser.usage = "t_archive [options]"
+        parser.description = "Move old done tasks to the archive database, to keep the main database small. " \
+                             "Archived tasks can be listed with 't_list --archive'. Set the ARCHIVE_DELAY " \
+                             "configuration key to archive tasks automatically when Yokadi starts."
+        delay = int(db.getConfigKey("ARCHIVE_DELAY", environ=False)) or DEFAULT_ARCHIVE_DELAY
+        parser.add_argument("-d", "--delay", dest="delay", default=delay,
+                            type=int, help="Delay (in days) after which done tasks are archived."
+                                           " Default is %d." % delay)
+        return parser
+
+    def do_t_archive(self, line):
+        args = self.parser_t_archive().parse_args(line)
+        if args.delay < 0:
+            raise BadUsageException("Delay cannot be negative")
+        filters = dbutils.getArchiveFilters(args.delay)
+        # Do not create the archive database for nothing
+        if self.session.query(Task.id).filter(*filters).first() is None:
+            print("No tasks need to be archived")
+            return
+        count = dbutils.archiveTasks(filters)
+        # Archived tasks may still be in the identity map
+        self.session.expire_all()
+        print("%d tasks archived" % count)
+
+    def parser_t_import(self):
+        from yokadi.ycli import taskimport
+        parser = YokadiOptionParser()
+        parser.usage = "t_import [options] [<file>]"
+        parser.description = "Import tasks from a CSV file, using the format of 't_list --format csv', or from a" \
+                             " file containing one JSON object per line, with the same fields. Missing projects" \
+                             " and keywords are created. Reads from standard input if <file> is '-' or omitted."
+        parser.add_argument("-f", "--format", dest="format",
+                            choices=taskimport.FORMATS,
+                            help="format of the file. Defaults to the file extension, or json.",
+                            metavar="<format>")
+        parser.add_argument("-p", "--project", dest="project",
+                            help="project of the tasks which do not define one",
+                            metavar="<project>")
+        parser.add_argument("--chunk", dest="chunk", default=1000, type=int,
+                            help="number of tasks imported per transaction (default: 1000)",
+                            metavar="<size>")
+        parser.add_argument("file", nargs="?", default="-", metavar="<file>")
+        return parser
+
+    def do_t_import(self, line):
+        from yokadi.ycli import taskimport
+        parser = self.parser_t_import()
+        args = parser.parse_args(line)
+
+        fmt = args.format
+        if fmt is None:
+            ext = os.path.splitext(args.file)[1][1:]
+            fmt = ext if ext in taskimport.FORMATS else "json"
+        readEntries = taskimport.readCsvEntries if fmt == "csv" else taskimport.readJsonEntries
+
+        if args.file == "-":
+            inFile = sys.stdin
+        else:
+            try:
+                inFile = open(args.file, encoding="utf-8", newline="")
+            except IOError as exc:
+                raise YokadiException("Cannot open %s: %s" % (args.file, exc))
+
+        try:
+            count = dbutils.addTasks(readEntries(inFile, args.project), chunkSize=max(args.chunk, 1))
+        except YokadiException as exc:
+            self.session.rollback()
+            raise YokadiException("%s. Tasks of the previous chunks, if any, have been imported." % exc)
+        finally:
+            if inFile is not sys.stdin:
+                inFile.close()
+        print("Imported %d tasks" % count)
+
     def parser_t_list(self):
         parser = YokadiOptionParser()
         parser.usage = "t_list [options] <project_or_keyword_filter>"
@@ -392,8 +564,8 @@ class TaskCmd(object):
 
         parser.add_argument("-s", "--search", dest="search",
                             action="append",
-                            help="only list tasks whose title or description match <value>. You can repeat this"
-                                 " option to search on multiple words.",
+                            help="only list tasks whose title, description or keywords contain a word starting"
+                                 " with <value>. You can repeat this option to search on multiple words.",
                             metavar="<value>")
 
         formatList = ["auto"] + list(gRendererClassDict.keys())
@@ -405,6 +577,11 @@ class TaskCmd(object):
                             help="Output task list to <file>",
                             metavar="<file>")
 
+        parser.add_argument("--archive", dest="archive",
+                            default=False, action="store_true",
+                            help="also list the tasks of the archive database (see t_archive), in their own"
+                                 " sections. Implies --all unless another status option is given")
+
         parser.add_argument("filter", nargs="*", metavar="<project_or_keyword_filter>")
 
         return parser
@@ -460,14 +637,12 @@ class TaskCmd(object):
                 if word.startswith("@"):
                     tui.warning("Maybe you want keyword search (without -s option) "
                                 "instead of plain text search?")
-                condition = or_(Task.title.like("%" + word + "%"),
-                                Task.description.like("%" + word + "%"))
-                filters.append(DbFilter(condition))
+            filters.append(TextFilter(args.search))
 
         return args, projectList, filters
 
     def _renderList(self, renderer, projectList, filters, order,
-                    limit=None, groupKeyword=None):
+                    limit=None, groupKeyword=None, archive=False):
         """
         Render a list using renderer, according to the restrictions set by the
         other parameters
@@ -477,58 +652,78 @@ class TaskCmd(object):
         @param order: ordering in sqlalchemy format (example: desc(Task.urgency))
         @param limit: limit number tasks (int) or None for no limit
         @param groupKeyword: keyword used for grouping (as unicode string) or None
+        @param archive: if True, also render the tasks of the archive database
         """
-        def applyFilters(lst):
-            for filter in filters:
-                lst = filter.apply(lst)
-            return lst
-
         if groupKeyword:
             if groupKeyword.startswith("@"):
                 groupKeyword = groupKeyword[1:]
             keywords = self.session.query(Keyword).filter(Keyword.name.like(groupKeyword))
-
-            for keyword in sorted(keywords, key=lambda x: x.name.lower()):
-                if str(keyword.name).startswith("_") and not groupKeyword.startswith("_"):
-                    # BUG: cannot filter on db side because sqlobject does not
-                    # understand ESCAPE needed with _. Need to test it with
-                    # sqlalchemy
-                    continue
-                taskList = self.session.query(Task).filter(TaskKeyword.keywordId == keyword.id)
-                taskList = taskList.outerjoin(TaskKeyword, Task.taskKeywords)
-                taskList = applyFilters(taskList)
-                taskList = taskList.order_by(*order).limit(limit).distinct()
-                taskList = list(taskList)
-                if projectList:
-                    taskList = [x for x in taskList if x.project in projectList]
-                if len(taskList) > 0:
-                    self.lastTaskIds.extend([t.id for t in taskList])  # Keep selected id for further use
-                    renderer.addTaskList(str(keyword), taskList)
-            renderer.end()
+            # BUG: cannot filter on db side because sqlobject does not
+            # understand ESCAPE needed with _. Need to test it with
+            # sqlalchemy
+            keywords = [x for x in keywords if not x.name.startswith("_") or groupKeyword.startswith("_")]
+            keywords.sort(key=lambda x: x.name.lower())
+            if projectList:
+                # Filter on names, so that the filter also works on the
+                # archive database
+                projectIds = select(Project.id).where(Project.name.in_([x.name for x in projectList]))
+                filters = filters + [DbFilter(Task.projectId.in_(projectIds))]
+
+            self._renderGroups(renderer, TaskKeyword.keywordId, keywords, filters, order, limit, archive)
         else:
             hiddenProjectNames = []
+            activeProjects = []
             for project in sorted(projectList, key=lambda x: x.name.lower()):
-                if not project.active:
+                if project.active:
+                    activeProjects.append(project)
+                else:
                     hiddenProjectNames.append(project.name)
-                    continue
-                taskList = self.session.query(Task).filter(Task.project == project)
-                taskList = taskList.outerjoin(TaskKeyword, Task.taskKeywords)
-                taskList = applyFilters(taskList)
-                taskList = taskList.order_by(*order).limit(limit).distinct()
-                taskList = list(taskList)
-                if len(taskList) > 0:
-                    self.lastTaskIds.extend([t.id for t in taskList])  # Keep selected id for further use
-                    renderer.addTaskList(str(project), taskList)
-            renderer.end()
+
+            self._renderGroups(renderer, Task.projectId, activeProjects, filters, order, limit, archive)
 
             if len(hiddenProjectNames) > 0:
                 tui.info("hidden projects: %s" % ", ".join(hiddenProjectNames))
 
+    def _renderGroups(self, renderer, groupColumn, groups, filters, order, limit, archive=False):
+        """Render tasks of groups, see dbutils.iterTaskGroups() for the
+        parameters. If archive is True, the archived tasks of the groups are
+        rendered afterwards, in their own sections"""
+        def recordIds(taskList):
+            # Keep selected id for further use
+            for task in taskList:
+                self.lastTaskIds.append(task.id)
+                yield task
+
+        # List of (groups, archive)
+        sources = [(groups, False)]
+        if archive and db.attachArchive():
+            groupClass = Project if groupColumn is Task.projectId else Keyword
+            sources.append((dbutils.getArchiveGroups(groupClass, [x.name for x in groups]), True))
+
+        stream = isinstance(renderer, TextListRenderer) and renderer.stream
+        if stream:
+            for sourceGroups, sourceArchive in sources:
+                renderer.setMaxWidths(*dbutils.getTaskGroupsMaxWidths(groupColumn, sourceGroups, filters, order,
+                                                                      limit, archive=sourceArchive))
+        for sourceGroups, sourceArchive in sources:
+            for group, taskList in dbutils.iterTaskGroups(groupColumn, sourceGroups, filters, order, limit,
+                                                          lazy=stream, asRows=True, archive=sourceArchive):
+                sectionName = str(group)
+                if sourceArchive:
+                    # Archived task ids cannot be used by other commands
+                    sectionName += " (archive)"
+                elif stream:
+                    taskList = recordIds(taskList)
+                else:
+                    self.lastTaskIds.extend([t.id for t in taskList])
+                renderer.addTaskList(sectionName, taskList)
+        renderer.end()
+
     def do_t_list(self, line, renderer=None):
 
         def selectRendererClass():
             if args.format != "auto":
-                return gRendererClassDict[args.format]
+                return getRendererClass(args.format)
 
             defaultRendererClass = TextListRenderer
             if not args.output:
@@ -538,7 +733,9 @@ class TaskCmd(object):
             if not ext:
                 return defaultRendererClass
 
-            return gRendererClassDict.get(ext[1:], defaultRendererClass)
+            if ext[1:] not in gRendererClassDict:
+                return defaultRendererClass
+            return getRendererClass(ext[1:])
 
         # Reset last tasks id list
         self.lastTaskIds = []
@@ -547,7 +744,7 @@ class TaskCmd(object):
         args, projectList, filters = self._parseListLine(self.parser_t_list(), line)
 
         # Skip notes
-        filters.append(KeywordFilter(NOTE_KEYWORD, negative=True))
+        filters.append(DbFilter(Task.noteFlag == False))  # noqa
 
         # Handle t_list specific options
         order = [desc(Task.urgency), Task.creationDate]
@@ -557,7 +754,7 @@ class TaskCmd(object):
             if args.done != "all":
                 minDate = ydateutils.parseMinDate(args.done)
                 filters.append(DbFilter(Task.doneDate >= minDate))
-        elif args.status == "all":
+        elif args.status == "all" or (args.archive and args.status is None):
             pass
         elif args.status == "started":
             filters.append(DbFilter(Task.status == "started"))
@@ -585,10 +782,13 @@ class TaskCmd(object):
         # Instantiate renderer
         if renderer is None:
             rendererClass = selectRendererClass()
-            renderer = rendererClass(out)
+            if rendererClass is TextListRenderer:
+                renderer = TextListRenderer(out, stream=True)
+            else:
+                renderer = rendererClass(out)
 
         # Fill the renderer
-        self._renderList(renderer, projectList, filters, order, limit, args.keyword)
+        self._renderList(renderer, projectList, filters, order, limit, args.keyword, args.archive)
     complete_t_list = projectAndKeywordCompleter
 
     def parser_n_list(self):
@@ -602,8 +802,8 @@ class TaskCmd(object):
 
         parser.add_argument("-s", "--search", dest="search",
                             action="append",
-                            help="only list notes whose title or description match <value>."
-                                 " You can repeat this option to search on multiple words.",
+                            help="only list notes whose title, description or keywords contain a word starting"
+                                 " with <value>. You can repeat this option to search on multiple words.",
                             metavar="<value>")
 
         parser.add_argument("-k", "--keyword", dest="keyword",
@@ -616,13 +816,107 @@ class TaskCmd(object):
     def do_n_list(self, line):
         args, projectList, filters = self._parseListLine(self.parser_n_list(), line)
 
-        filters.append(KeywordFilter(NOTE_KEYWORD))
+        filters.append(DbFilter(Task.noteFlag == True))  # noqa
         order = [Task.creationDate, ]
-        renderer = TextListRenderer(tui.stdout, renderAsNotes=True)
+        renderer = TextListRenderer(tui.stdout, renderAsNotes=True, stream=True)
         self._renderList(renderer, projectList, filters, order, limit=None,
                          groupKeyword=args.keyword)
     complete_n_list = projectAndKeywordCompleter
 
+    def parser_t_agenda(self):
+        parser = YokadiOptionParser()
+        parser.usage = "t_agenda [options] <project_or_keyword_filter>"
+        parser.description = "List the tasks which are due in the next days, sorted by due date, including the " \
+                             "future occurrences of recurrent tasks. Overdue tasks are listed first."
+        parser.add_argument("-d", "--days", dest="days",
+                            type=int, default=7,
+                            help="number of days to show, including today (default: %(default)s)",
+                            metavar="<days>")
+        parser.add_argument("-s", "--search", dest="search",
+                            action="append",
+                            help="only list tasks whose title, description or keywords contain a word starting"
+                                 " with <value>. You can repeat this option to search on multiple words.",
+                            metavar="<value>")
+        parser.add_argument("filter", nargs="*", metavar="<project_or_keyword_filter>")
+        return parser
+
+    def do_t_agenda(self, line, renderer=None):
+        def recordIds(taskList):
+            # Recurrent tasks appear several times, only keep their id once
+            for task in taskList:
+                if task.id not in knownIds:
+                    knownIds.add(task.id)
+                    self.lastTaskIds.append(task.id)
+                yield task
+
+        self.lastTaskIds = []
+        knownIds = set()
+        args, projectList, filters = self._parseListLine(self.parser_t_agenda(), line)
+        if args.days < 1:
+            raise BadUsageException("Number of days must be at least 1")
+
+        activeProjects = [x for x in projectList if x.active]
+        try:
+            endDate = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=args.days)
+        except OverflowError:
+            raise BadUsageException("Number of days is too large")
+        filters.append(DbFilter(Task.noteFlag == False))  # noqa
+        filters.append(DbFilter(Task.projectId.in_([x.id for x in activeProjects])))
+
+        if renderer is None:
+            renderer = TextListRenderer(tui.stdout, splitOnDueDate=True, stream=True)
+        stream = isinstance(renderer, TextListRenderer) and renderer.stream
+        if stream:
+            # Occurrences of recurrent tasks do not change the widths
+            widthFilters = filters + [DbFilter(Task.status != "done"), DbFilter(Task.dueDate < endDate)]
+            renderer.setMaxWidths(*dbutils.getTaskGroupsMaxWidths(Task.projectId, activeProjects, widthFilters, []))
+
+        taskList = recordIds(dbutils.iterTaskOccurrences(filters, endDate))
+        if not stream:
+            taskList = list(taskList)
+        renderer.addTaskList("Agenda for the next %d day(s)" % args.days, taskList)
+        renderer.end()
+    complete_t_agenda = projectAndKeywordCompleter
+
+    def parser_t_search(self):
+        parser = YokadiOptionParser()
+        parser.usage = "t_search [options] <word>..."
+        parser.description = "Search tasks by title, description and keywords, most relevant first. " \
+                             "Words are matched as prefixes: 'sched' matches 'scheduler'. " \
+                             "Use double quotes to search for a phrase. Ex.: t_search \"release notes\" draft"
+        parser.add_argument("-a", "--all", dest="all",
+                            default=False, action="store_true",
+                            help="include done tasks")
+        parser.add_argument("-n", "--limit", dest="limit",
+                            type=int, default=20,
+                            help="show at most <limit> tasks (default: %(default)s)",
+                            metavar="<limit>")
+        parser.add_argument("words", nargs="+", metavar="<word>")
+        return parser
+
+    def do_t_search(self, line):
+        args = self.parser_t_search().parse_args(line)
+        text = " ".join(args.words)
+        try:
+            words = shlex.split(text)
+        except ValueError:
+            # Unbalanced quotes
+            words = text.replace('"', " ").split()
+
+        query = dbutils.searchTasks(words)
+        query = query.filter(Task.noteFlag == False)  # noqa
+        if not args.all:
+            query = query.filter(Task.status != "done")
+        tasks = query.limit(args.limit).all()
+
+        self.lastTaskIds = [x.id for x in tasks]
+        if not tasks:
+            tui.info("No matching task")
+            return
+        renderer = TextListRenderer(tui.stdout)
+        renderer.addTaskList("Search results", tasks)
+        renderer.end()
+
     def do_t_reorder(self, line):
         """Reorder tasks of a project.
         It works by starting an editor with the task list: you can then change
@@ -664,6 +958,7 @@ class TaskCmd(object):
         - adjust urgency
         - delete tasks
         """
+        from yokadi.ycli import massedit
         if not line:
             raise BadUsageException("Missing parameters")
         projectName = parseOneWordName(line)
@@ -771,6 +1066,8 @@ class TaskCmd(object):
         """Code shared by t_edit and bug_edit.
         if keywordEditor is not None it will be called after editing the task.
         Returns the modified task if OK, None if cancelled"""
+        import readline
+
         def editComplete(text, state):
             """ Specific completer for the edit prompt.
             This subfunction should stay here because it needs to access to cmd members"""
@@ -847,16 +1144,21 @@ class TaskCmd(object):
         tokens = parseutils.simplifySpaces(line).split(" ")
         if len(tokens) != 2:
             raise YokadiException("You should give two arguments: <task id> <project>")
-        projectName = tokens[1]
+        task = self.getTaskFromId(tokens[0])
+        self.apply_t_project([task], tokens[1])
+        self.session.commit()
+
+    def apply_t_project(self, tasks, line):
+        projectName = parseutils.simplifySpaces(line)
+        if not projectName or " " in projectName:
+            raise YokadiException("You should give one project name")
         projectName = self._realProjectName(projectName)
         project = dbutils.getOrCreateProject(projectName)
         if not project:
             return
 
-        task = self.getTaskFromId(tokens[0])
-        task.project = project
-        self.session.commit()
-        if task.project:
+        for task in tasks:
+            task.project = project
             print("Moved task '%s' to project '%s'" % (task.title, projectName))
 
     complete_t_set_project = ProjectCompleter(2)
@@ -895,14 +1197,21 @@ class TaskCmd(object):
             raise YokadiException("Give a task id and time, date or date & time")
         taskId, line = line.strip().split(" ", 1)
         task = self.getTaskFromId(taskId)
+        self.apply_t_due([task], line)
+        self.session.commit()
 
+    def apply_t_due(self, tasks, line):
+        line = parseutils.simplifySpaces(line)
         if line.lower() == "none":
-            task.dueDate = None
-            print("Due date for task '%s' reset" % task.title)
+            dueDate = None
         else:
-            task.dueDate = ydateutils.parseHumaneDateTime(line)
-            print("Due date for task '%s' set to %s" % (task.title, task.dueDate.ctime()))
-        self.session.commit()
+            dueDate = ydateutils.parseHumaneDateTime(line)
+        for task in tasks:
+            task.dueDate = dueDate
+            if dueDate is None:
+                print("Due date for task '%s' reset" % task.title)
+            else:
+                print("Due date for task '%s' set to %s" % (task.title, dueDate.ctime()))
     complete_t_set_due = dueDateCompleter
     complete_t_due = dueDateCompleter
 
@@ -914,7 +1223,11 @@ class TaskCmd(object):
         if len(tokens) < 2:
             raise YokadiException("You should give at least two arguments: <task id> <keyword>")
         task = dbutils.getTaskFromId(tokens[0])
-        garbage, keywordFilters = parseutils.extractKeywords(tokens[1])
+        self.apply_t_add_keywords([task], tokens[1])
+        self.session.commit()
+
+    def apply_t_add_keywords(self, tasks, line):
+        garbage, keywordFilters = parseutils.extractKeywords(line)
         newKwDict = parseutils.keywordFiltersToDict(keywordFilters)
         if garbage:
             raise YokadiException("Cannot parse line, got garbage (%s). Maybe you forgot to add @ before keyword ?"
@@ -924,10 +1237,8 @@ class TaskCmd(object):
             # User cancel keyword creation
             return
 
-        kwDict = task.getKeywordDict()
-        kwDict.update(newKwDict)
-        task.setKeywordDict(kwDict)
-        self.session.commit()
+        for task in tasks:
+            task.updateKeywordDict(newKwDict)
 
     def do_t_recurs(self, line):
         """Make a task recurs
@@ -0,0 +1,119 @@
+# -*- coding: UTF-8 -*-
+"""
+Readers for t_import. They turn CSV or JSON lines files into the dicts
+expected by dbutils.addTasks().
+
+@author: Aurélien Gâteau <mail@agateau.com>
+@license: GPL v3 or later
+"""
+import csv
+import json
+from datetime import datetime
+
+from yokadi.core import dbutils
+from yokadi.core.db import Keyword, Project
+from yokadi.core.yokadiexception import YokadiException
+
+FORMATS = ("csv", "json")
+
+STATUSES = ("new", "started", "done")
+
+DATE_FIELDS = ("creationDate", "dueDate", "doneDate")
+
+
+def readCsvEntries(fileObj, defaultProject=None):
+    """Read tasks from a CSV file using the same format as CsvListRenderer
+    @return: a generator of dicts"""
+    reader = csv.DictReader(fileObj, dialect="excel")
+    # Line 1 is the header
+    for lineNumber, row in enumerate(reader, 2):
+        # CsvListRenderer writes None values as "None"
+        row = dict((k, None if v in ("", "None") else v) for k, v in row.items())
+        if row.get("keywords"):
+            row["keywords"] = _parseKeywordString(lineNumber, row["keywords"])
+        yield _checkEntry(lineNumber, row, defaultProject)
+
+
+def readJsonEntries(fileObj, defaultProject=None):
+    """Read tasks from a file containing one JSON object per line
+    @return: a generator of dicts"""
+    for lineNumber, line in enumerate(fileObj, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as exc:
+            raise YokadiException("Line %d: invalid JSON (%s)" % (lineNumber, exc))
+        if not isinstance(row, dict):
+            raise YokadiException("Line %d: expected a JSON object" % lineNumber)
+        keywords = row.get("keywords")
+        if isinstance(keywords, list):
+            try:
+                row["keywords"] = dict((x, None) for x in keywords)
+            except TypeError:
+                raise YokadiException("Line %d: keywords must be a dict or a list of names" % lineNumber)
+        yield _checkEntry(lineNumber, row, defaultProject)
+
+
+def _parseKeywordString(lineNumber, text):
+    """Parse a string created by Task.getKeywordsAsString()"""
+    dct = {}
+    for token in text.split(", "):
+        name, _, value = token.partition("=")
+        if value in ("", "None"):
+            value = None
+        else:
+            try:
+                value = int(value)
+            except ValueError:
+                raise YokadiException("Line %d: value of %s keyword must be an integer (got %s)"
+                                      % (lineNumber, name, value))
+        dct[name] = value
+    return dct
+
+
+def _checkEntry(lineNumber, row, defaultProject):
+    if not row.get("title"):
+        raise YokadiException("Line %d: missing title" % lineNumber)
+
+    if not row.get("project"):
+        if not defaultProject:
+            raise YokadiException("Line %d: missing project. Use --project to define a default one" % lineNumber)
+        row["project"] = defaultProject
+    _checkName(lineNumber, Project, row["project"])
+
+    if row.get("status") and row["status"] not in STATUSES:
+        raise YokadiException("Line %d: invalid status '%s'" % (lineNumber, row["status"]))
+
+    if row.get("urgency") is not None:
+        try:
+            row["urgency"] = int(row["urgency"])
+        except (TypeError, ValueError):
+            raise YokadiException("Line %d: urgency must be an integer" % lineNumber)
+
+    for field in DATE_FIELDS:
+        if row.get(field):
+            try:
+                row[field] = datetime.fromisoformat(row[field])
+            except (TypeError, ValueError):
+                raise YokadiException("Line %d: invalid %s '%s'" % (lineNumber, field, row[field]))
+
+    keywords = row.get("keywords") or {}
+    if not isinstance(keywords, dict):
+        raise YokadiException("Line %d: keywords must be a dict or a list" % lineNumber)
+    for name, value in keywords.items():
+        _checkName(lineNumber, Keyword, name)
+        if value is not None and not isinstance(value, int):
+            raise YokadiException("Line %d: value of %s keyword must be an integer (got %s)"
+                                  % (lineNumber, name, value))
+    row["keywords"] = keywords
+    return row
+
+
+def _checkName(lineNumber, cls, name):
+    try:
+        dbutils.checkItemName(cls, name)
+    except YokadiException as exc:
+        raise YokadiException("Line %d: %s" % (lineNumber, exc))
+# vi: ts=4 sw=4 et
@@ -17,7 +17,11 @@ VLINE = "│"
 HLINE = "─"
 CROSS = "┼"
 
-LINE_COLOR = C.CYAN
+
+# Used to split tasks sorted by due date: (number of days after the start of
+# today, text printed before the first task due before this limit)
+DUE_DATE_SPLITTERS = [(0, "Overdue"), (1, "Today"), (7, "Next week"), (30, "Next month"), (30 * 4, "Next quarter"),
+                      (365, "Next year")]
 
 
 def colorizer(value, reverse=False):
@@ -156,18 +160,26 @@ class DueDateFormater(object):
 
 
 class TextListRenderer(object):
-    def __init__(self, out, termWidth=None, renderAsNotes=False, splitOnDate=False):
+    def __init__(self, out, termWidth=None, renderAsNotes=False, splitOnDate=False, stream=False,
+                 splitOnDueDate=False):
         """
         @param out: output target
         @param termWidth: terminal width (int)
-        @param renderAsNotes: whether to display task as notes (with dates) instead of tasks (with age). (boot)"""
+        @param renderAsNotes: whether to display task as notes (with dates) instead of tasks (with age). (boot)
+        @param splitOnDueDate: whether to insert separators between tasks
+        due today, next week... Tasks must be sorted by due date
+        @param stream: if True, tasks are printed as soon as they are added
+        instead of in end(). setMaxWidths() must then be called before
+        adding tasks, since column widths cannot be computed from the tasks"""
         self.out = out
+        self.stream = stream
         self.termWidth = termWidth or tui.getTermWidth()
         self.taskLists = []
         self.maxTitleWidth = len("Title")
         self.today = datetime.today().replace(microsecond=0)
         self.firstHeader = True
         self.splitOnDate = splitOnDate
+        self.splitOnDueDate = splitOnDueDate
 
         if self.termWidth < 100:
             dueColumnWidth = 8
@@ -199,13 +211,27 @@ class TextListRenderer(object):
 
         self.maxId = 0
 
+    def setMaxWidths(self, maxTitleWidth, maxId):
+        """Define the column widths. Must be called before adding tasks in
+        stream mode
+        @param maxTitleWidth: width of the longest title, as computed by
+        addTaskList()
+        @param maxId: biggest task id"""
+        self.maxTitleWidth = max(self.maxTitleWidth, maxTitleWidth)
+        self.maxId = max(self.maxId, maxId)
+        self._setupColumns()
+
     def addTaskList(self, sectionName, taskList):
-        """Store tasks for this section
+        """Store tasks for this section, or print them in stream mode
         @param sectionName: name of the task groupment section
         @type sectionName: unicode
-        @param taskList: list of tasks to display
-        @type taskList: list of db.Task instances
+        @param taskList: list of tasks to display. In stream mode, it can be
+        any iterable
+        @type taskList: list of db.Task or dbutils.TaskRow instances
         """
+        if self.stream:
+            self._renderTaskList(sectionName, taskList)
+            return
         self.taskLists.append((sectionName, taskList))
         # Find max title width
         for task in taskList:
@@ -220,36 +246,51 @@ class TextListRenderer(object):
             self.maxId = max(self.maxId, task.id)
 
     def end(self):
-        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        if self.stream:
+            return
+        self._setupColumns()
+        for sectionName, taskList in self.taskLists:
+            self._renderTaskList(sectionName, taskList)
+
+    def _setupColumns(self):
+        self.dayStart = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
         # Adjust idColumn
         self.idColumn.width = max(2, len(str(self.maxId)))
 
         # Adjust titleColumn
         self.titleColumn.width = self.maxTitleWidth
-        totalWidth = sum([x.width for x in self.columns]) + len(self.columns) - 1
-        if totalWidth >= self.termWidth:
-            self.titleColumn.width = self.termWidth - (totalWidth - self.titleColumn.width)
+        self.totalWidth = sum([x.width for x in self.columns]) + len(self.columns) - 1
+        if self.totalWidth >= self.termWidth:
+            self.titleColumn.width = self.termWidth - (self.totalWidth - self.titleColumn.width)
         self.titleColumn.formater = TitleFormater(self.titleColumn.width)
 
-        # Print table
-        for sectionName, taskList in self.taskLists:
-            dateSplitters = [(1, "day"), (7, "week"), (30, "month"), (30 * 4, "quarter"), (365, "year")]
-            splitterRange, splitterName = dateSplitters.pop()
-            splitterText = None
-            self._renderTaskListHeader(sectionName)
-            for task in taskList:
-                while self.splitOnDate and task.creationDate > today - timedelta(splitterRange):
-                    splitterText = "Last %s" % splitterName
-                    if len(dateSplitters) > 0:
-                        splitterRange, splitterName = dateSplitters.pop()
-                    else:
-                        self.splitOnDate = False
-
-                if splitterText:
-                    print(C.GREEN + splitterText.center(totalWidth) + C.RESET, file=self.out)
-                    splitterText = None
-
-                self._renderTaskListRow(task)
+    def _renderTaskList(self, sectionName, taskList):
+        dateSplitters = [(1, "day"), (7, "week"), (30, "month"), (30 * 4, "quarter"), (365, "year")]
+        splitterRange, splitterName = dateSplitters.pop()
+        splitterText = None
+        self._renderTaskListHeader(sectionName)
+        dueDateSplitters = list(DUE_DATE_SPLITTERS)
+        lastDueDateSplitterText = None
+        for task in taskList:
+            while self.splitOnDate and task.creationDate > self.dayStart - timedelta(splitterRange):
+                splitterText = "Last %s" % splitterName
+                if len(dateSplitters) > 0:
+                    splitterRange, splitterName = dateSplitters.pop()
+                else:
+                    self.splitOnDate = False
+
+            if self.splitOnDueDate and task.dueDate:
+                while dueDateSplitters and task.dueDate >= self.dayStart + timedelta(dueDateSplitters[0][0]):
+                    dueDateSplitters.pop(0)
+                text = dueDateSplitters[0][1] if dueDateSplitters else "Later"
+                if text != lastDueDateSplitterText:
+                    splitterText = lastDueDateSplitterText = text
+
+            if splitterText:
+                print(C.GREEN + splitterText.center(self.totalWidth) + C.RESET, file=self.out)
+                splitterText = None
+
+            self._renderTaskListRow(task)
 
     def _renderTaskListHeader(self, sectionName):
         """
@@ -267,15 +308,15 @@ class TextListRenderer(object):
         print(C.CYAN + sectionName.center(width) + C.RESET, file=self.out)
 
         # header titles
-        line = (LINE_COLOR + VLINE + C.RESET).join(cells)
+        line = (C.CYAN + VLINE + C.RESET).join(cells)
         print(line, file=self.out)
 
         # header separator line
         cells = [HLINE * len(x) for x in cells]
-        print(LINE_COLOR + CROSS.join(cells) + C.RESET, file=self.out)
+        print(C.CYAN + CROSS.join(cells) + C.RESET, file=self.out)
 
     def _renderTaskListRow(self, task):
         cells = [column.createCell(task) for column in self.columns]
-        sep = LINE_COLOR + VLINE + C.RESET
+        sep = C.CYAN + VLINE + C.RESET
         print(sep.join(cells), file=self.out)
 # vi: ts=4 sw=4 et
@@ -7,7 +7,6 @@ Helper functions to build CLI applications
 """
 
 import os
-import readline
 import subprocess
 import sys
 import tempfile
@@ -20,7 +19,7 @@ from collections import namedtuple
 from getpass import getpass
 
 from yokadi.ycli import colors
-from yokadi.core.yokadiexception import YokadiException
+from yokadi.core.yokadiexception import InputRequiredException, YokadiException
 
 # Number of seconds between checks for end of process
 PROC_POLL_INTERVAL = 0.5
@@ -39,6 +38,10 @@ stderr = sys.stderr
 
 _isInteractive = sys.stdin.isatty()
 
+# False if the user input cannot be read by this process, see
+# yokadi.ycli.server
+_isInputAvailable = True
+
 
 def isInteractive():
     if _answers:
@@ -47,9 +50,21 @@ def isInteractive():
     return _isInteractive
 
 
+def setInteractive(interactive, inputAvailable=True):
+    """Override the interactive mode, which is detected from stdin by default
+    @param interactive: whether the user can be prompted
+    @param inputAvailable: whether this process can read the user input.
+    If False, prompting raises InputRequiredException"""
+    global _isInteractive, _isInputAvailable
+    _isInteractive = interactive
+    _isInputAvailable = inputAvailable
+
+
 def _checkIsInteractive():
     if not isInteractive():
         raise YokadiException("This command cannot be used in non-interactive mode")
+    if not _answers and not _isInputAvailable:
+        raise InputRequiredException()
 
 
 def editText(text, onChanged=None, lockManager=None, prefix="yokadi-", suffix=".md"):
@@ -114,6 +129,7 @@ def reinjectInRawInput(line):
     @param line: The default text
     """
     assert isinstance(line, str)
+    import readline
 
     # Set readline.pre_input_hook to feed it with our line
     # (Code copied from yagtd)
@@ -133,6 +149,9 @@ def editLine(line, prompt="edit> ", echo=True):
     @param prompt: change prompt
     @param echo: whether to echo user text or not"""
     _checkIsInteractive()
+    # Imported here because it is not needed by most one-shot commands.
+    # Importing it enables line editing in input()
+    import readline
     if line:
         reinjectInRawInput(line)
 
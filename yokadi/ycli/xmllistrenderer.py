@@ -23,7 +23,7 @@ class XmlListRenderer(object):
         @param sectionName: name of the task groupement section
         @type sectionName: unicode
         @param taskList: list of tasks to display
-        @type taskList: list of db.Task instances
+        @type taskList: list of db.Task or dbutils.TaskRow instances
         """
 
         sectionElement = self.doc.createElement("section")
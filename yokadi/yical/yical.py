@@ -20,9 +20,12 @@ if not hasattr(icalendar.Calendar, "from_ical"):
     print("Your version of icalendar is outdated: you need icalendar > 3.0.")
     sys.exit(1)
 
+import hashlib
 import http.server
-from threading import Thread
+from email.utils import formatdate, parsedate_to_datetime
+from threading import Lock, Thread
 import re
+import time
 
 from yokadi.core import db
 from yokadi.core.db import Task, Project
@@ -50,27 +53,84 @@ YOKADI_ICAL_ATT_MAPPING = {"title": "summary",
                            "description": "description"}
 
 
-def generateCal():
-    """Generate an ical calendar from yokadi database
+# Maximum number of tasks loaded by a single query. Stays below the default
+# SQLite limit on the number of bound parameters
+TASK_LOAD_CHUNK_SIZE = 900
+
+
+def createCalendar():
+    """Create an empty calendar
     @return: icalendar.Calendar object"""
-    session = db.getSession()
     cal = icalendar.Calendar()
     cal.add("prodid", '-//Yokadi calendar //yokadi.github.io//')
     cal.add("version", "2.0")
+    return cal
+
+
+def createVTodoFromProject(project):
+    vTodo = icalendar.Todo()
+    vTodo.add("summary", project.name)
+    vTodo["uid"] = PROJECT_UID % project.id
+    return vTodo
+
+
+def generateCal():
+    """Generate an ical calendar from yokadi database
+    @return: icalendar.Calendar object"""
+    session = db.getSession()
+    cal = createCalendar()
     # Add projects
     for project in session.query(Project).filter(Project.active == True):  # noqa
-        vTodo = icalendar.Todo()
-        vTodo.add("summary", project.name)
-        vTodo["uid"] = PROJECT_UID % project.id
-        cal.add_component(vTodo)
+        cal.add_component(createVTodoFromProject(project))
     # Add tasks
-    for task in session.query(Task).filter(Task.status != "done"):
+    query = session.query(Task).filter(Task.status != "done").order_by(Task.id)
+    for task in dbutils.eagerLoadTaskRelations(query):
         vTodo = createVTodoFromTask(task)
         cal.add_component(vTodo)
 
     return cal
 
 
+class CalendarGenerator(object):
+    """Generates the same data as generateCal().to_ical(), but keeps the
+    serialized VTODO of each task and only creates it again when the
+    updateDate of the task changes"""
+    def __init__(self):
+        # taskId => (updateDate, serialized VTODO)
+        self._taskTodos = {}
+
+    def generate(self):
+        """@return: the serialized calendar, as bytes"""
+        session = db.getSession()
+        # Serialize an empty calendar and insert the VTODOs before its end
+        calData = createCalendar().to_ical()
+        end = b"END:VCALENDAR\r\n"
+        assert calData.endswith(end)
+        parts = [calData[:-len(end)]]
+
+        for project in session.query(Project).filter(Project.active == True):  # noqa
+            parts.append(createVTodoFromProject(project).to_ical())
+
+        updateDates = session.query(Task.id, Task.updateDate).filter(Task.status != "done").order_by(Task.id).all()
+        self._updateTaskTodos(session, updateDates)
+        parts.extend(self._taskTodos[id][1] for id, _ in updateDates)
+
+        parts.append(end)
+        return b"".join(parts)
+
+    def _updateTaskTodos(self, session, updateDates):
+        currentIds = set(id for id, _ in updateDates)
+        for id in set(self._taskTodos).difference(currentIds):
+            del self._taskTodos[id]
+
+        modifiedIds = [id for id, updateDate in updateDates
+                       if self._taskTodos.get(id, (None,))[0] != updateDate]
+        for start in range(0, len(modifiedIds), TASK_LOAD_CHUNK_SIZE):
+            query = session.query(Task).filter(Task.id.in_(modifiedIds[start:start + TASK_LOAD_CHUNK_SIZE]))
+            for task in dbutils.eagerLoadTaskRelations(query):
+                self._taskTodos[task.id] = (task.updateDate, createVTodoFromTask(task).to_ical())
+
+
 def createVTodoFromTask(task):
     """Create a VTodo object from a yokadi task
     @param task: yokadi task (db.Task object)
@@ -145,16 +205,79 @@ def updateTaskFromVTodo(task, vTodo):
         task.setKeywordDict(newKwDict)
 
 
+class CalendarCache(object):
+    """Keeps the serialized calendar until the database changes"""
+    def __init__(self):
+        self._lock = Lock()
+        self._watcher = None
+        self._generator = CalendarGenerator()
+        self.data = None
+        self.etag = None
+        # Timestamp of the last change of data
+        self.lastModified = None
+
+    def get(self):
+        """Returns the calendar, regenerating it if the database changed
+        @return: (data, etag, lastModified)"""
+        with self._lock:
+            if self._watcher is None:
+                self._watcher = dbutils.DatabaseWatcher(db.getSession().get_bind())
+            if self._watcher.hasChanged() or self.data is None:
+                self._update()
+            return self.data, self.etag, self.lastModified
+
+    def _update(self):
+        data = self._generator.generate()
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        if etag != self.etag:
+            self.data = data
+            self.etag = etag
+            # HTTP dates have a resolution of one second
+            self.lastModified = int(time.time())
+
+
 class IcalHttpRequestHandler(http.server.BaseHTTPRequestHandler):
     """Simple Ical http request handler that only implement GET method"""
     newTask = {}  # Dict recording new task origin UID
+    calendarCache = None  # Set by YokadiIcalServer
+
+    def handle(self):
+        try:
+            http.server.BaseHTTPRequestHandler.handle(self)
+        finally:
+            # Each request is handled in its own thread, release the session
+            # created for it
+            db.getSession().remove()
 
     def do_GET(self):
         """Serve a GET request with complete todolist ignoring path"""
+        data, etag, lastModified = self.calendarCache.get()
+        if self._isNotModified(etag, lastModified):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
         self.send_response(200)
+        self.send_header("Content-Type", "text/calendar; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(lastModified, usegmt=True))
         self.end_headers()
-        cal = generateCal()
-        self.wfile.write(cal.to_ical())
+        self.wfile.write(data)
+
+    def _isNotModified(self, etag, lastModified):
+        """Check the conditional headers of the request. If-None-Match takes
+        precedence over If-Modified-Since"""
+        ifNoneMatch = self.headers.get("If-None-Match")
+        if ifNoneMatch is not None:
+            return ifNoneMatch.strip() == "*" or etag in [x.strip() for x in ifNoneMatch.split(",")]
+        ifModifiedSince = self.headers.get("If-Modified-Since")
+        if ifModifiedSince is not None:
+            try:
+                return parsedate_to_datetime(ifModifiedSince).timestamp() >= lastModified
+            except (TypeError, ValueError):
+                return False
+        return False
 
     def do_PUT(self):
         """Receive a todolist for updating"""
@@ -225,7 +348,8 @@ class YokadiIcalServer(Thread):
     def run(self):
         """Method executed when the thread object start() method is called"""
         print("IcalServer starting...")
-        icalServer = http.server.HTTPServer((self.address, self.port), IcalHttpRequestHandler)
+        IcalHttpRequestHandler.calendarCache = CalendarCache()
+        icalServer = http.server.ThreadingHTTPServer((self.address, self.port), IcalHttpRequestHandler)
         icalServer.serve_forever()
         print("IcalServer crash. Oups !")
 
@@ -9,10 +9,9 @@ Yokadi daemon. Used to monitor due tasks and warn user.
 
 import sys
 import os
-import time
 from datetime import datetime, timedelta
 from signal import SIGTERM, SIGHUP, signal
-from subprocess import Popen
+from threading import Event
 from argparse import ArgumentParser
 
 from yokadi.core import fileutils
@@ -29,14 +28,18 @@ from yokadi.core.daemon import Daemon
 from yokadi.core import basepaths
 from yokadi.yical.yical import YokadiIcalServer
 
-from yokadi.core import db
-from yokadi.core.db import Project, Task, getConfigKey
+from yokadi.core import db, dbutils
+from yokadi.core.alarmscheduler import AlarmRunner, AlarmScheduler, DELAY_ALARM, DUE_ALARM, \
+    getPendingDueDates
+from yokadi.core.db import Task, getConfigKey
 from yokadi.ycli import commonargs
 
 
-# Daemon polling delay (in seconds)
+# Maximum delay between two checks for database changes (in seconds)
 PROCESS_INTERVAL = 30
-EVENTLOOP_INTERVAL = 1
+
+# Maximum number of alarm commands running at the same time
+MAX_RUNNING_ALARMS = 8
 
 # Ical daemon default port
 DEFAULT_TCP_ICAL_PORT = 8000
@@ -44,6 +47,9 @@ DEFAULT_TCP_ICAL_PORT = 8000
 # Event sender to main loop
 event = [True, ""]
 
+# Set to wake up the main loop when event changes
+wakeUpEvent = Event()
+
 
 def sigTermHandler(signal, stack):
     """Handler when yokadid receive SIGTERM"""
@@ -51,6 +57,7 @@ def sigTermHandler(signal, stack):
     print("End of yokadi Daemon")
     event[0] = False
     event[1] = "SIGTERM"
+    wakeUpEvent.set()
 
 
 def sigHupHandler(signal, stack):
@@ -58,62 +65,60 @@ def sigHupHandler(signal, stack):
     print("Receive SIGHUP. Reloading configuration")
     event[0] = False
     event[1] = "SIGHUP"
+    wakeUpEvent.set()
 
 
-def eventLoop():
-    """Main event loop"""
+def eventLoop(runner):
+    """Main event loop. Sleeps until the next alarm, waking up every
+    PROCESS_INTERVAL seconds to check if the database has changed
+    @param runner: AlarmRunner used to run the alarm commands"""
     delta = timedelta(hours=float(getConfigKey("ALARM_DELAY")))
     suspend = timedelta(hours=float(getConfigKey("ALARM_SUSPEND")))
-    cmdDelayTemplate = getConfigKey("ALARM_DELAY_CMD")
-    cmdDueTemplate = getConfigKey("ALARM_DUE_CMD")
+    cmdTemplates = {
+        DELAY_ALARM: getConfigKey("ALARM_DELAY_CMD"),
+        DUE_ALARM: getConfigKey("ALARM_DUE_CMD"),
+    }
     session = db.getSession()
-    # For the two following dict, task id is key, and value is (duedate, triggerdate)
-    triggeredDelayTasks = {}
-    triggeredDueTasks = {}
-    activeTaskFilter = [Task.status != "done",
-                        Task.projectId == Project.id,
-                        Project.active == True]  # noqa
-
-    def process(now):
-        delayTasks = session.query(Task).filter(Task.dueDate < now + delta,
-                                                Task.dueDate > now,
-                                                *activeTaskFilter)
-        dueTasks = session.query(Task).filter(Task.dueDate < now,
-                                              *activeTaskFilter)
-        processTasks(delayTasks, triggeredDelayTasks, cmdDelayTemplate, suspend)
-        processTasks(dueTasks, triggeredDueTasks, cmdDueTemplate, suspend)
-
-    nextProcessTime = datetime.today().replace(microsecond=0)
-    while event[0]:
-        now = datetime.today().replace(microsecond=0)
-        if now > nextProcessTime:
-            process(now)
-            nextProcessTime = now + timedelta(seconds=PROCESS_INTERVAL)
-        time.sleep(EVENTLOOP_INTERVAL)
-
-
-def processTasks(tasks, triggeredTasks, cmdTemplate, suspend):
-    """Process a list of tasks and trigger action if needed
-    @param tasks: list of tasks
-    @param triggeredTasks: dict of tasks that has been triggered. Dict can be updated
-    @param cmdTemplate: command line template to execute if task trigger
-    @param suspend: timedelta beetween to task trigger"""
-    now = datetime.now()
-    for task in tasks:
-        if task.id in triggeredTasks and triggeredTasks[task.id][0] == task.dueDate:
-            # This task with the same dueDate has already been triggered
-            if now - triggeredTasks[task.id][1] < suspend:
-                # Task has been trigger recently, skip to next
-                continue
-        print("Task %s is due soon" % task.title)
-        cmd = cmdTemplate.replace("{ID}", str(task.id))
-        cmd = cmd.replace("{TITLE}", task.title.replace('"', '\"'))
-        cmd = cmd.replace("{PROJECT}", task.project.name.replace('"', '\"'))
-        cmd = cmd.replace("{DATE}", str(task.dueDate))
-        process = Popen(cmd, shell=True)
-        process.wait()
-        # TODO: redirect stdout/stderr properly to Log (not so easy...)
-        triggeredTasks[task.id] = (task.dueDate, datetime.now())
+    scheduler = AlarmScheduler(delta, suspend)
+    watcher = dbutils.DatabaseWatcher(session.get_bind())
+    wakeUpEvent.clear()
+
+    try:
+        while event[0]:
+            if watcher.hasChanged():
+                # End the current transaction to see the changes
+                session.rollback()
+                scheduler.update(getPendingDueDates(session))
+
+            now = datetime.now()
+            for taskId, kind in scheduler.popAlarms(now):
+                task = session.get(Task, taskId)
+                if task is None:
+                    # Removed since the scheduler has been updated
+                    print("Task %d does not exist anymore, skipping alarm" % taskId)
+                    continue
+                triggerAlarm(runner, task, cmdTemplates[kind])
+
+            timeout = PROCESS_INTERVAL
+            nextDate = scheduler.getNextDate()
+            if nextDate is not None:
+                timeout = min(timeout, (nextDate - datetime.now()).total_seconds())
+            wakeUpEvent.wait(max(timeout, 0))
+    finally:
+        watcher.close()
+
+
+def triggerAlarm(runner, task, cmdTemplate):
+    """Queue the alarm command of a task. Does not wait for the command
+    @param runner: AlarmRunner used to run the command
+    @param task: the task
+    @param cmdTemplate: command line template to execute"""
+    print("Task %s is due soon" % task.title)
+    cmd = cmdTemplate.replace("{ID}", str(task.id))
+    cmd = cmd.replace("{TITLE}", task.title.replace('"', '\"'))
+    cmd = cmd.replace("{PROJECT}", task.project.name.replace('"', '\"'))
+    cmd = cmd.replace("{DATE}", str(task.dueDate))
+    runner.run(task.id, cmd)
 
 
 def killYokadid(pidFile):
@@ -177,6 +182,8 @@ class YokadiDaemon(Daemon):
     def run(self):
         db.connectDatabase(self.dbPath, createIfNeeded=False)
         print("Using %s" % self.dbPath)
+        for message in db.getPragmaWarnings():
+            print("Warning: %s" % message)
         session = db.getSession()
 
         # Basic tests :
@@ -189,13 +196,21 @@ class YokadiDaemon(Daemon):
             yokadiIcalServer = YokadiIcalServer(self.options.tcpPort, self.options.tcpListen)
             yokadiIcalServer.start()
 
+        # Databases created by older versions may lack some config keys
+        db.setDefaultConfig()
+        session.commit()
+
         # Start the main event Loop
+        timeout = float(getConfigKey("ALARM_CMD_TIMEOUT"))
+        runner = AlarmRunner(MAX_RUNNING_ALARMS, timeout if timeout > 0 else None)
         try:
             while event[1] != "SIGTERM":
-                eventLoop()
+                eventLoop(runner)
                 event[0] = True
         except KeyboardInterrupt:
             print("\nExiting...")
+        finally:
+            runner.shutdown()
 
 
 def main():